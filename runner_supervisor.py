@@ -0,0 +1,23 @@
+import os 
+import subprocess
+
+def main():
+    script_path = os.path.join('src', 'supervisor.py')
+
+    # All rigs are described in a single config file, replacing runner_relay_1..4.py
+    config_path = 'rigs.json'  # Replace with your desired config file
+
+    command = [
+        'python', script_path,
+        '--config', config_path
+    ]
+
+    try:
+        subprocess.run(command)
+    except (subprocess.SubprocessError):
+        print("[RUNNER]Error running subprocess")
+    except (KeyboardInterrupt, SystemExit):
+        print("[RUNNER]Exiting")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#Builtins
+import time
+import threading
+from collections import namedtuple, deque
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+#Locals
+from controllers import YokogawaController, DataPoint
+
+#One paired sample per tick. timestamp is the middle of the acquisition window and skew is
+#the window width: every meter sampled somewhere between the earliest trigger and the latest reply,
+#so skew is an upper bound on how far apart the individual readings can be in time.
+AlignedSample = namedtuple("AlignedSample", ["data_points", "timestamp", "skew"])
+
+class MultimeterAcquisition:
+    """
+    Triggers every multimeter at the same instant and gathers their replies in parallel.
+
+    Each meter gets its own worker thread. The workers meet at a barrier right before writing the
+    read command, so all meters are triggered together instead of one after the other, and each
+    worker then waits for its own reply until reply_timeout elapses.
+    Samples are timestamped with clock, a simulator's virtual clock makes accelerated runs integrate in
+    simulated time. Timeouts are always in real seconds.
+    """
+    def __init__(self, multimeters : list[YokogawaController], reply_timeout : float = 0.250, clock : Callable[[], float] = time.time):
+        assert multimeters, "No multimeters provided"
+        self.multimeters = multimeters
+        self.reply_timeout = reply_timeout
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(max_workers = len(multimeters), thread_name_prefix = "acquisition")
+
+    def _acquire_one(self, multimeter : YokogawaController, barrier : threading.Barrier):
+        try:
+            barrier.wait(timeout = self.reply_timeout)
+        except threading.BrokenBarrierError:
+            pass #A slow worker must not hold back the others, trigger anyway
+
+        trigger_time = self.clock()
+        multimeter.trigger()
+        line = multimeter.read_reply(deadline = time.time() + self.reply_timeout)
+        reply_time = self.clock()
+        if line is None:
+            return (DataPoint(None, None, None), trigger_time, reply_time)
+        return (multimeter.decode_reply(line, reply_time), trigger_time, reply_time)
+
+    def acquire(self) -> AlignedSample:
+        #Ports are opened in the background, meters that are not ready yet simply yield no reading
+        open_multimeters = [multimeter for multimeter in self.multimeters if multimeter.serial.is_open]
+        barrier = threading.Barrier(max(1, len(open_multimeters)))
+        futures = {multimeter: self.executor.submit(self._acquire_one, multimeter, barrier) for multimeter in open_multimeters}
+        results = [futures[multimeter].result() if multimeter in futures else (DataPoint(None, None, None), None, None)
+                   for multimeter in self.multimeters]
+
+        data_points = [data_point for data_point, _, _ in results]
+        trigger_times = [trigger_time for _, trigger_time, _ in results if trigger_time is not None]
+        reply_times = [reply_time for _, _, reply_time in results if reply_time is not None]
+        if not trigger_times:
+            return AlignedSample(data_points, None, None)
+
+        window_start = min(trigger_times)
+        window_end = max(reply_times)
+        return AlignedSample(data_points, (window_start + window_end) / 2, window_end - window_start)
+
+    def close(self):
+        self.executor.shutdown(wait = False)
+
+class YokogawaStreamReader(threading.Thread):
+    """
+    Reads a multimeter in talk-only mode, where the meter sends a reading after every conversion
+    without being asked.
+
+    The thread frames the byte stream into lines, timestamps each line when its last byte arrives and
+    keeps the decoded DataPoints in a bounded buffer, dropping the oldest when the consumer falls behind.
+    If start_command is given it is written once the port is open, otherwise the meter is expected to be
+    set to talk-only on its front panel.
+    """
+    def __init__(self, multimeter : YokogawaController, buffer_size : int = 4096, start_command : Optional[str] = None,
+                 clock : Callable[[], float] = time.time):
+        threading.Thread.__init__(self, name = f"stream-{multimeter.serial.port}")
+        self.daemon = True
+        self.multimeter = multimeter
+        self.clock = clock
+        self.start_command = start_command
+        self.samples : deque = deque(maxlen = buffer_size)
+        self.condition = threading.Condition()
+        self.received = 0
+        self.dropped = 0
+        self.running = True
+
+    def run(self):
+        serial_port = self.multimeter.serial
+        while self.running and not serial_port.is_open:
+            time.sleep(0.050) #Ports are opened in the background
+        if not self.running:
+            return
+        serial_port.reset_input_buffer()
+        if self.start_command:
+            serial_port.write(self.start_command.encode())
+
+        partial = b""
+        while self.running:
+            try:
+                chunk = serial_port.read(serial_port.in_waiting or 1)
+            except Exception as e:
+                print(f"[STREAM]Error reading {serial_port.port}: {e}")
+                time.sleep(0.100)
+                continue
+            if not chunk:
+                continue
+            arrival_time = self.clock()
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                data_point = self.multimeter.decode_reply(line, arrival_time)
+                if data_point.value is not None:
+                    self._push(data_point)
+
+    def _push(self, data_point : DataPoint):
+        with self.condition:
+            if len(self.samples) == self.samples.maxlen:
+                self.dropped += 1
+            self.samples.append(data_point)
+            self.received += 1
+            self.condition.notify_all()
+
+    def take(self) -> list[DataPoint]:
+        """Returns and removes every buffered sample, oldest first."""
+        with self.condition:
+            samples = list(self.samples)
+            self.samples.clear()
+        return samples
+
+    def wait_for_sample(self, deadline : float) -> bool:
+        with self.condition:
+            while not self.samples:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def stop(self):
+        self.running = False
+
+class StreamingAcquisition:
+    """
+    Same interface as MultimeterAcquisition for meters in talk-only mode.
+
+    acquire() waits until every streaming meter has produced a new reading, or reply_timeout elapses,
+    and pairs the newest reading of each meter. No command is sent per tick, so the loop runs at the
+    meter's own conversion rate. Older readings that arrived in the meantime are counted as superseded.
+    When no meter produced a reading, for example while their ports are closed, acquire() still returns
+    only at the deadline, so the loop does not spin.
+    """
+    def __init__(self, multimeters : list[YokogawaController], reply_timeout : float = 0.250, buffer_size : int = 4096,
+                 start_command : Optional[str] = None, clock : Callable[[], float] = time.time):
+        assert multimeters, "No multimeters provided"
+        self.multimeters = multimeters
+        self.reply_timeout = reply_timeout
+        self.superseded = 0
+        self.readers = [YokogawaStreamReader(multimeter, buffer_size, start_command, clock) for multimeter in multimeters]
+        for reader in self.readers:
+            reader.start()
+
+    def acquire(self) -> AlignedSample:
+        deadline = time.time() + self.reply_timeout
+        data_points = []
+        for reader in self.readers:
+            if reader.multimeter.serial.is_open:
+                reader.wait_for_sample(deadline)
+            samples = reader.take()
+            if samples:
+                self.superseded += len(samples) - 1
+                data_points.append(samples[-1])
+            else:
+                data_points.append(DataPoint(None, None, None))
+
+        timestamps = [data_point.timestamp for data_point in data_points if data_point.timestamp is not None]
+        if not timestamps:
+            #Closed ports are not waited for above
+            time.sleep(max(0.0, deadline - time.time()))
+            return AlignedSample(data_points, None, None)
+        window_start = min(timestamps)
+        window_end = max(timestamps)
+        return AlignedSample(data_points, (window_start + window_end) / 2, window_end - window_start)
+
+    def close(self):
+        for reader in self.readers:
+            reader.stop()
+        for reader in self.readers:
+            reader.join(timeout = 1.0)
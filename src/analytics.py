@@ -0,0 +1,201 @@
+#Builtins
+import os
+import re
+import json
+import time
+import argparse
+from collections import namedtuple
+from typing import Optional
+
+#Third party
+import numpy as np
+
+#Locals
+from itech import PowerStates
+from run_store import RunStoreReader, decode_state
+from log_segments import read_lines, log_base_path
+
+'''
+Post-run analysis of a cycle run, computed on whole NumPy arrays.
+
+A run is loaded once into three float64 columns (timestamp, voltage, current) plus the index of the first row
+of every step. It can be read from the step files written by itech.ChargeController (<step>_<state>.log, CSV,
+read across its rotated segments)
+or from a run store, where a step ends when the state changes or the accumulated energy restarts at zero.
+Every per-interval quantity is computed for all rows at once and summed per step with np.add.reduceat, so the
+cost is a few passes over the arrays; the run store is memory mapped and a 10M row run takes well under a
+second.
+
+Energy and capacity are integrated like PowerAnalyzer: the trapezoid of the average voltage times the average
+current. Intervals longer than max_gap seconds and intervals that do not move forward are not integrated.
+
+Efficiencies pair every discharge with the charge step that puts the charge back (the next one, or the
+previous one for a run ending on a discharge): coulombic = Ah out / Ah in, energy = Wh out / Wh in.
+'''
+
+STEP_FILE_PATTERN = re.compile(r"^(\d+)_(\w+)\.log$")
+#Cycle states of the relay rigs, as steps of the ITech sequence
+STATE_STEPS = {
+    "charge": PowerStates.CHARGE,
+    "precharge": PowerStates.CHARGE,
+    "recharge": PowerStates.CHARGE,
+    "discharge": PowerStates.DISCHARGE,
+    "passive": PowerStates.PASSIVE,
+    "monitor": PowerStates.PASSIVE,
+}
+
+RunArrays = namedtuple("RunArrays", ["timestamp", "voltage", "current", "starts", "states"])
+Step = namedtuple("Step", ["index", "state", "samples", "start_time", "duration", "energy_wh", "capacity_ah",
+                           "average_voltage", "end_voltage", "cc_duration", "cv_duration"])
+Cycle = namedtuple("Cycle", ["discharge_step", "charge_step", "coulombic_efficiency", "energy_efficiency"])
+
+def load_step_file(path : str) -> np.ndarray:
+    """Returns the (timestamp, voltage, current) rows of a step file as a (3, rows) array."""
+    first_line = next(read_lines(path), "")
+    if not first_line:
+        return np.empty((3, 0))
+    skip_rows = 1 if first_line.startswith("voltage") else 0
+    #Columns: voltage;current;power;ahour;whour;timestamp;is_valid
+    voltage, current, timestamp = np.loadtxt(read_lines(path), delimiter = ';', skiprows = skip_rows, usecols = (0, 1, 5), ndmin = 2, unpack = True)
+    return np.vstack((timestamp, voltage, current))
+
+def load_step_files(directory : str) -> RunArrays:
+    steps = []
+    for name in set(map(log_base_path, os.listdir(directory))): #A rotated step file is listed once, by the name of its live file
+        match = STEP_FILE_PATTERN.match(name)
+        if match and match.group(2) in STATE_STEPS:
+            steps.append((int(match.group(1)), STATE_STEPS[match.group(2)], os.path.join(directory, name)))
+    if not steps:
+        raise FileNotFoundError(f"No step files in {directory}")
+    steps.sort(key = lambda step: step[0])
+
+    arrays = [load_step_file(path) for _, _, path in steps]
+    lengths = np.array([array.shape[1] for array in arrays])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    rows = np.hstack(arrays)
+    return RunArrays(rows[0], rows[1], rows[2], starts, [state for _, state, _ in steps])
+
+def load_run_store(directory : str) -> RunArrays:
+    reader = RunStoreReader(directory)
+    columns = reader.read()
+    state, energy = columns["state"], columns["energy"]
+    if len(state) == 0:
+        raise ValueError(f"Run store {directory} is empty")
+    #A new step starts when the state changes or when the integrator was reset
+    boundaries = (state[1:] != state[:-1]) | ((energy[1:] == 0.0) & (energy[:-1] != 0.0))
+    starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1))
+    states = [STATE_STEPS[decode_state(code)] for code in state[starts]]
+    return RunArrays(columns["timestamp"], columns["voltage"], columns["current"], starts, states)
+
+def load_run(directory : str) -> RunArrays:
+    """Loads a run folder, from its run store when it has one."""
+    store_directory = os.path.join(directory, "store")
+    if os.path.isdir(store_directory):
+        return load_run_store(store_directory)
+    return load_step_files(directory)
+
+def _cc_cv_durations(timestamp : np.ndarray, current : np.ndarray, cc_tolerance : float) -> tuple[float, float]:
+    #The constant current phase ends at the last sample still within cc_tolerance of the current at the start
+    #of the step, what follows is the constant voltage taper
+    abs_current = np.abs(current)
+    cc_current = np.median(abs_current[:len(abs_current) // 10 + 1])
+    if cc_current == 0.0:
+        return 0.0, float(timestamp[-1] - timestamp[0])
+    at_cc = np.flatnonzero(abs_current >= (1.0 - cc_tolerance) * cc_current)
+    cc_end = at_cc[-1] if len(at_cc) else 0
+    return float(timestamp[cc_end] - timestamp[0]), float(timestamp[-1] - timestamp[cc_end])
+
+def analyze_steps(run : RunArrays, max_gap : Optional[float] = None, cc_tolerance : float = 0.02) -> list[Step]:
+    timestamp, voltage, current = run.timestamp, run.voltage, run.current
+    row_count = len(timestamp)
+    ends = np.append(run.starts[1:], row_count) #One past the last row of every step
+    non_empty = np.flatnonzero(ends > run.starts)
+    starts, ends = run.starts[non_empty], ends[non_empty]
+    if row_count < 2:
+        return []
+
+    #Interval k goes from row k to row k + 1. The last row of a step opens no interval of that step
+    hours = np.diff(timestamp)
+    valid = hours > 0
+    if max_gap is not None:
+        valid &= hours <= max_gap
+    valid[ends[:-1] - 1] = False
+    hours *= valid
+    hours /= 3600
+    average_voltage = voltage[1:] + voltage[:-1]
+    average_voltage /= 2
+    current_hours = current[1:] + current[:-1]
+    current_hours *= hours
+    current_hours /= 2
+    voltage_hours = average_voltage * hours
+    average_voltage *= current_hours #Now the energy of every interval
+
+    #Steps are contiguous, so every per-step total is a segmented sum. A single row step has no interval
+    first_intervals = np.minimum(starts, row_count - 2)
+    def step_sums(values : np.ndarray) -> np.ndarray:
+        return np.where(ends - starts > 1, np.add.reduceat(values, first_intervals), 0.0)
+    energy = step_sums(average_voltage)
+    capacity = step_sums(current_hours)
+    voltage_hours = step_sums(voltage_hours)
+    integrated_hours = step_sums(hours)
+
+    steps = []
+    for position, index in enumerate(non_empty):
+        first, last = starts[position], ends[position] - 1
+        cc_duration, cv_duration = _cc_cv_durations(timestamp[first:last + 1], current[first:last + 1], cc_tolerance)
+        mean_voltage = voltage_hours[position] / integrated_hours[position] if integrated_hours[position] > 0 else float(voltage[first])
+        steps.append(Step(int(index), run.states[index], int(last - first + 1), float(timestamp[first]), float(timestamp[last] - timestamp[first]),
+                          float(energy[position]), float(capacity[position]), float(mean_voltage), float(voltage[last]), cc_duration, cv_duration))
+    return steps
+
+def pair_cycles(steps : list[Step]) -> list[Cycle]:
+    charges = [step for step in steps if step.state == PowerStates.CHARGE]
+    cycles = []
+    for step in steps:
+        if step.state != PowerStates.DISCHARGE:
+            continue
+        following = [charge for charge in charges if charge.index > step.index]
+        preceding = [charge for charge in charges if charge.index < step.index]
+        charge = following[0] if following else (preceding[-1] if preceding else None)
+        if charge is None or charge.capacity_ah == 0.0 or charge.energy_wh == 0.0:
+            continue
+        cycles.append(Cycle(step.index, charge.index, abs(step.capacity_ah / charge.capacity_ah), abs(step.energy_wh / charge.energy_wh)))
+    return cycles
+
+def analyze_run(directory : str, max_gap : Optional[float] = None, cc_tolerance : float = 0.02) -> tuple[list[Step], list[Cycle]]:
+    steps = analyze_steps(load_run(directory), max_gap, cc_tolerance)
+    return steps, pair_cycles(steps)
+
+def print_report(steps : list[Step], cycles : list[Cycle]):
+    print(f"{'step':>4} {'state':>9} {'samples':>9} {'hours':>7} {'Wh':>10} {'Ah':>9} {'avg V':>7} {'end V':>7} {'CC h':>6} {'CV h':>6}")
+    for step in steps:
+        print(f"{step.index:>4} {step.state.value:>9} {step.samples:>9} {step.duration / 3600:>7.3f} {step.energy_wh:>10.4f} {step.capacity_ah:>9.4f} "
+              f"{step.average_voltage:>7.3f} {step.end_voltage:>7.3f} {step.cc_duration / 3600:>6.2f} {step.cv_duration / 3600:>6.2f}")
+    for cycle in cycles:
+        print(f"Discharge {cycle.discharge_step} / charge {cycle.charge_step}: coulombic efficiency {cycle.coulombic_efficiency * 100:.2f}%"
+              f"\tenergy efficiency {cycle.energy_efficiency * 100:.2f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Per step energy, capacity, efficiencies and CC/CV durations of a cycle run")
+    parser.add_argument("directory", help = "Run folder, e.g. logs/13S6P")
+    parser.add_argument("--max_gap", type = float, default = None, help = "Do not integrate intervals longer than this, in seconds")
+    parser.add_argument("--cc_tolerance", type = float, default = 0.02, help = "Relative drop of the current that ends the CC phase")
+    parser.add_argument("--output", default = None, help = "Also save the results to this JSON file")
+    args = parser.parse_args()
+
+    time_begin = time.perf_counter()
+    run = load_run(args.directory)
+    time_loaded = time.perf_counter()
+    steps = analyze_steps(run, args.max_gap, args.cc_tolerance)
+    cycles = pair_cycles(steps)
+    time_end = time.perf_counter()
+
+    print_report(steps, cycles)
+    print(f"{len(run.timestamp)} rows loaded in {time_loaded - time_begin:.3f}s, analyzed in {time_end - time_loaded:.3f}s")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"steps": [dict(step._asdict(), state = step.state.value) for step in steps],
+                       "cycles": [cycle._asdict() for cycle in cycles]}, file, indent = 4)
+
+if __name__ == "__main__":
+    main()
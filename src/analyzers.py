@@ -2,48 +2,174 @@
 import os
 import time
 import datetime
+from collections import deque
+from typing import Optional
 
 #Third party
 from colorama import Fore, Style, init
 
+#Locals
+from log_sink import LogSink
+from log_index import data_logger_line_timestamp
+
+class CompensatedSum:
+    """Running sum with Neumaier compensation, so millions of tiny increments do not drift."""
+    def __init__(self, value : float = 0.0):
+        self.total : float = value
+        self.compensation : float = 0.0
+
+    def add(self, value : float):
+        total = self.total + value
+        if abs(self.total) >= abs(value):
+            self.compensation += (self.total - total) + value
+        else:
+            self.compensation += (value - total) + self.total
+        self.total = total
+
+    def value(self) -> float:
+        return self.total + self.compensation
+
 class PowerAnalyzer:
-    def __init__(self):
-        self.entries = []
+    """
+    Integrates energy (Wh) and capacity (Ah) as samples stream in, keeping only the last samples it needs.
+
+    rule selects the integration rule. "trapezoid" integrates every interval as it arrives. "simpson" also
+    adds each interval as a trapezoid so totals are always current, and replaces every completed pair of
+    intervals with the (non-uniform) Simpson estimate.
+    Intervals longer than max_gap seconds are not integrated and counted as gaps. Samples whose timestamp
+    does not move forward are dropped and counted as non-monotonic.
+    history_size keeps a bounded ring buffer of recent samples, 0 keeps none.
+    Listeners (see add_listener) are given every integrated interval and told about every reset.
+    """
+    RULES = ["trapezoid", "simpson"]
+
+    def __init__(self, rule : str = "trapezoid", max_gap : Optional[float] = None, history_size : int = 0):
+        assert rule in self.RULES, f"Invalid rule: {rule}"
+        self.rule = rule
+        self.max_gap = max_gap
+        self.history : Optional[deque] = deque(maxlen = history_size) if history_size > 0 else None
         self.start_time: float = None
+        self.gap_count : int = 0
+        self.non_monotonic_count : int = 0
+        self.listeners : list = []
+        self.reset()
+
+    def reset(self):
+        self.energy_sum = CompensatedSum()
+        self.capacity_sum = CompensatedSum()
         self.total_energy: float = 0.0  # Running total of energy
         self.total_capacity: float = 0.0  # Running total of capacity
-    
+        self.last_sample : Optional[tuple] = None
+        #First interval of a Simpson pair: (voltage, current, timestamp) at its start and the trapezoids already added
+        self.pending_interval : Optional[tuple] = None
+        if self.history is not None:
+            self.history.clear()
+        for listener in self.listeners:
+            listener.on_reset()
+
+    def add_listener(self, listener):
+        """listener.on_interval(average voltage, Ah) is called for every integrated interval, listener.on_reset() on reset."""
+        self.listeners.append(listener)
+
     def add_entry(self, voltage, current, timestamp):
-        self.entries.append((voltage, current, timestamp))
         if not self.start_time:
             self.start_time = timestamp
 
-        # Calculate energy and capacity for the new entry
-        if len(self.entries) > 1:
-            previous_voltage, previous_current, previous_time = self.entries[-2]
-            current_voltage, current_current, current_time = self.entries[-1]
+        previous_sample = self.last_sample
+        if previous_sample is not None:
+            previous_voltage, previous_current, previous_time = previous_sample
+            delta_time = timestamp - previous_time
+            if delta_time <= 0:
+                self.non_monotonic_count += 1
+                return
+        
+        self.last_sample = (voltage, current, timestamp)
+        if self.history is not None:
+            self.history.append(self.last_sample)
+        if previous_sample is None:
+            return
 
-            # Calculate the time difference in hours
-            seconds_to_hours = 3600
-            delta_time = current_time - previous_time
-            delta_time_hours = delta_time / seconds_to_hours
+        if self.max_gap is not None and delta_time > self.max_gap:
+            #Do not integrate across a gap, and do not pair intervals around it
+            self.gap_count += 1
+            self.pending_interval = None
+            return
 
-            # Calculate average voltage and current
-            average_voltage = (previous_voltage + current_voltage) / 2
-            average_current = (previous_current + current_current) / 2
+        # Calculate the time difference in hours
+        seconds_to_hours = 3600
+        delta_time_hours = delta_time / seconds_to_hours
 
-            # Calculate energy in Wh and capacity in Ah
-            energy = average_voltage * average_current * delta_time_hours
-            capacity = average_current * delta_time_hours
+        # Calculate average voltage and current
+        average_voltage = (previous_voltage + voltage) / 2
+        average_current = (previous_current + current) / 2
 
-            # Update running totals
-            self.total_energy += energy
-            self.total_capacity += capacity
+        # Calculate energy in Wh and capacity in Ah
+        energy = average_voltage * average_current * delta_time_hours
+        capacity = average_current * delta_time_hours
 
-    def reset(self):
-        self.entries = []
-        self.total_energy = 0.0
-        self.total_capacity = 0.0
+        self.energy_sum.add(energy)
+        self.capacity_sum.add(capacity)
+        for listener in self.listeners:
+            listener.on_interval(average_voltage, capacity)
+
+        if self.rule == "simpson":
+            if self.pending_interval is None:
+                self.pending_interval = (previous_voltage, previous_current, previous_time, energy, capacity)
+            else:
+                self._apply_simpson_correction(previous_voltage, previous_current, previous_time, voltage, current, timestamp, energy, capacity)
+                self.pending_interval = None
+
+        # Update running totals
+        self.total_energy = self.energy_sum.value()
+        self.total_capacity = self.capacity_sum.value()
+
+    def _apply_simpson_correction(self, middle_voltage, middle_current, middle_time, voltage, current, timestamp, energy, capacity):
+        first_voltage, first_current, first_time, first_energy, first_capacity = self.pending_interval
+        h0 = (middle_time - first_time) / 3600
+        h1 = (timestamp - middle_time) / 3600
+
+        #Non-uniform Simpson weights for the two intervals
+        first_weight = (h0 + h1) / 6 * (2 - h1 / h0)
+        middle_weight = (h0 + h1) / 6 * (h0 + h1) ** 2 / (h0 * h1)
+        last_weight = (h0 + h1) / 6 * (2 - h0 / h1)
+
+        simpson_energy = (first_weight * first_voltage * first_current + middle_weight * middle_voltage * middle_current
+                          + last_weight * voltage * current)
+        simpson_capacity = first_weight * first_current + middle_weight * middle_current + last_weight * current
+
+        #Swap the two trapezoids already added for the Simpson estimate
+        self.energy_sum.add(simpson_energy - first_energy - energy)
+        self.capacity_sum.add(simpson_capacity - first_capacity - capacity)
+
+    def snapshot(self) -> dict:
+        """State needed to continue integrating where this analyzer stopped. The history is not kept."""
+        return {
+            "rule": self.rule,
+            "start_time": self.start_time,
+            "energy_sum": [self.energy_sum.total, self.energy_sum.compensation],
+            "capacity_sum": [self.capacity_sum.total, self.capacity_sum.compensation],
+            "last_sample": self.last_sample,
+            "pending_interval": self.pending_interval,
+            "gap_count": self.gap_count,
+            "non_monotonic_count": self.non_monotonic_count,
+        }
+
+    def restore(self, snapshot : dict):
+        assert snapshot["rule"] == self.rule, f"Snapshot integrates with {snapshot['rule']}, not {self.rule}"
+        self.reset()
+        self.start_time = snapshot["start_time"]
+        self.energy_sum.total, self.energy_sum.compensation = snapshot["energy_sum"]
+        self.capacity_sum.total, self.capacity_sum.compensation = snapshot["capacity_sum"]
+        self.last_sample = tuple(snapshot["last_sample"]) if snapshot["last_sample"] else None
+        self.pending_interval = tuple(snapshot["pending_interval"]) if snapshot["pending_interval"] else None
+        self.gap_count = snapshot["gap_count"]
+        self.non_monotonic_count = snapshot["non_monotonic_count"]
+        self.total_energy = self.energy_sum.value()
+        self.total_capacity = self.capacity_sum.value()
+
+    @property
+    def entries(self) -> list[tuple]:
+        return list(self.history) if self.history is not None else []
     
     def calculate_energy(self) -> float:
         return self.total_energy
@@ -52,16 +178,32 @@ class PowerAnalyzer:
         return self.total_energy, self.total_capacity
 
 class DataLogger:
-    def __init__(self, log_directories : list[str], root_folder : str = None):
+    def __init__(self, log_directories : list[str], root_folder : str = None, sink : LogSink = None, resume : bool = False):
         assert log_directories, "No log directories provided"
+        assert root_folder or not resume, "Resuming needs the folder of the interrupted run"
         self.log_directories : list[str] = log_directories
         self.root_folder : str = root_folder
+        #Resuming reuses the run folder, the log files are appended to
+        self.resume = resume
         self.log_paths : dict = self._create_default_save_paths(self.log_directories)
+        #Writes are batched by the sink, which keeps the log files open
+        self.sink : LogSink = sink if sink else LogSink()
+        self.log_files : dict[str, tuple] = {}
 
     def save_data(self, log_directory : str, data : str):
-        log_path = os.path.join(self.log_paths[log_directory], f"{log_directory}.log")
-        with open(log_path, 'a') as file:
-            file.write(data)
+        log_file = self.log_files.get(log_directory)
+        if log_file is None:
+            log_file = (os.path.join(self.log_paths[log_directory], f"{log_directory}.log"),)
+            self.log_files[log_directory] = log_file
+            #Time index for read_window, lines without a timestamp (terminal messages) are not indexed
+            self.sink.add_index(log_file[0], data_logger_line_timestamp)
+        self.sink.write(log_file, data)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        self.sink.close()
     
     def add_save_paths(self, log_directories: list[str]):
         for log_directory in log_directories:
@@ -89,8 +231,13 @@ class DataLogger:
             root_path = os.path.join(logs_path, self.root_folder)
         else:
             root_path = current_date_path
+        self.root_path : str = root_path
             
-        if not os.path.exists(root_path):
+        if self.resume:
+            if not os.path.isdir(root_path):
+                print(f"[ERROR]No folder to resume at {root_path}")
+                exit()
+        elif not os.path.exists(root_path):
             os.makedirs(root_path)
         else:
             print("[ERROR]Chosen save folder already exists!")
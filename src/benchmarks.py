@@ -0,0 +1,370 @@
+#Builtins
+import os
+import gc
+import json
+import math
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+from array import array
+from types import SimpleNamespace
+from queue import Empty
+from typing import Callable, Optional
+
+os.environ.setdefault("MPLBACKEND", "Agg") #multimeter.py and itech.py build their plot windows on import
+
+#Third party
+import serial
+
+#Locals
+from simulators import VirtualClock, BatteryModel, ITechSimulator, YokogawaSimulator, RelaySimulator, relay_rig_source
+from controllers import YokogawaController, RelayController, RelayChannel, ChargeController
+from analyzers import PowerAnalyzer, DataLogger
+from log_sink import LogSink
+from notifications import NotificationDispatcher, set_default_dispatcher
+import multimeter
+import itech
+
+'''
+End-to-end benchmarks against the simulated instruments of simulators.py.
+
+Scenarios run 1, 4 and 16 rigs at once by default:
+    multimeter  multimeter.main_loop per rig, two pty multimeters each and one shared relay board
+    itech       itech.ChargeController.execute_sequence per rig, one simulated ITech each, charge then discharge
+
+Reported per scenario:
+    samples_per_second                   sustained logged samples over all rigs
+    reply_to_flush_latency_ms            p50/p99/p999 from the instrument reply to the row being flushed to its log file
+                                         (file.flush() to the OS, not fsync, so not a durability latency)
+    cutoff_to_transition_latency_ms      from the sample that fires a cutoff to the confirmed relay / ITech state change
+    memory_growth_per_million_samples    resident memory growth after warm up, in bytes, including 8 bytes per sample
+                                         kept by the benchmark for the latencies
+
+Results are saved as JSON with the current commit so runs can be compared:
+    python benchmarks.py --output after.json --compare before.json
+'''
+
+RELAYS_PER_BOARD = 4
+
+def percentiles(values : list[float], scale : float = 1000.0) -> dict:
+    """Nearest rank p50/p99/p999 and max, in milliseconds by default."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * scale
+    return {"count": len(ordered), "p50": rank(0.50), "p99": rank(0.99), "p999": rank(0.999), "max": ordered[-1] * scale}
+
+def resident_memory() -> int:
+    """Current resident set size in bytes."""
+    gc.collect()
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource #Peak instead of current outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+@contextlib.contextmanager
+def notifications_disabled():
+    #A rig finishing or failing must not post to ntfy or play sounds during a benchmark
+    silent_dispatcher = NotificationDispatcher([])
+    previous = set_default_dispatcher(silent_dispatcher)
+    try:
+        yield
+    finally:
+        set_default_dispatcher(previous)
+        silent_dispatcher.close()
+
+class WriteLatencyRecorder:
+    """LogSink flush listener collecting, for every sample row, the time from its timestamp to the flush of its file."""
+    def __init__(self, row_timestamp : Callable[[tuple, object], Optional[float]]):
+        self.row_timestamp = row_timestamp
+        self.latencies = array('d') #8 bytes per sample, counted in the memory growth
+        self.lock = threading.Lock()
+
+    def __call__(self, batch : list, flush_time : float):
+        with self.lock:
+            for destinations, row in batch:
+                timestamp = self.row_timestamp(destinations, row)
+                if timestamp is not None:
+                    self.latencies.append(flush_time - timestamp)
+
+    def __len__(self) -> int:
+        return len(self.latencies)
+
+def multimeter_row_timestamp(destinations : tuple, row) -> Optional[float]:
+    #Sample rows are "<values>\t<epoch timestamp>\t<time>", terminal rows repeat the sample and are skipped
+    if destinations[0].endswith("terminal.log") or not isinstance(row, str):
+        return None
+    fields = row.split('\t')
+    try:
+        return float(fields[1])
+    except (IndexError, ValueError):
+        return None
+
+def itech_row_timestamp(destinations : tuple, row) -> Optional[float]:
+    #Rows of the step file and of all_sequences.log are written together, count them once
+    if isinstance(row, tuple) and len(destinations) > 1:
+        return row[5]
+    return None
+
+class TransitionTimer:
+    """Times from a cutoff event of detector to the return of transition, which is wrapped in place."""
+    def __init__(self, detector, owner, transition_name : str):
+        self.latencies : list[float] = []
+        self.detection_latencies : list[float] = []
+        self.pending : Optional[float] = None
+        detector_update = detector.update
+        transition = getattr(owner, transition_name)
+
+        def update(*args, **kwargs):
+            event = detector_update(*args, **kwargs)
+            if event:
+                self.pending = time.perf_counter()
+                self.detection_latencies.append(event.latency)
+            return event
+
+        def timed_transition(*args, **kwargs):
+            result = transition(*args, **kwargs)
+            end = time.perf_counter()
+            if self.pending is not None:
+                self.latencies.append(end - self.pending)
+                self.pending = None
+            return result
+
+        detector.update = update
+        setattr(owner, transition_name, timed_transition)
+
+def drain_queue(queue, stop_event : threading.Event):
+    #Stands in for the live plot, which empties the data queue every 100 ms
+    while not stop_event.is_set():
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        stop_event.wait(0.100)
+
+def scenario_result(name : str, rig_count : int, samples : int, sampling_time : float, recorder : WriteLatencyRecorder,
+                    timers : list[TransitionTimer], memory_growth : Optional[float]) -> dict:
+    return {
+        "scenario": name,
+        "rigs": rig_count,
+        "samples": samples,
+        "sampling_time_s": sampling_time,
+        "samples_per_second": samples / sampling_time if sampling_time > 0 else 0.0,
+        "reply_to_flush_latency_ms": percentiles(recorder.latencies),
+        "cutoff_to_transition_latency_ms": percentiles([latency for timer in timers for latency in timer.latencies]),
+        "cutoff_detection_latency_ms": percentiles([latency for timer in timers for latency in timer.detection_latencies]),
+        "memory_growth_per_million_samples": memory_growth,
+    }
+
+def run_multimeter_scenario(rig_count : int, duration : float, scale : float, directory : str, quiet : bool = False) -> dict:
+    clock = VirtualClock(scale)
+    #A relay board has four relays, every four rigs share one board as they do in the lab
+    relay_boards, relay_channels = [], []
+    for _ in range(math.ceil(rig_count / RELAYS_PER_BOARD)):
+        relay_board = RelaySimulator(relay_count = RELAYS_PER_BOARD)
+        relay_board.rig_sources = []
+        relay_board.on_change = lambda number, state, sources = relay_board.rig_sources: [source(number, state) for source in sources]
+        relay_board.start()
+        relay_channel = RelayChannel(serial.Serial(baudrate = 9600, timeout = 0.100))
+        relay_channel.serial.port = relay_board.port_name
+        relay_channel.open()
+        relay_boards.append(relay_board)
+        relay_channels.append(relay_channel)
+
+    sink = LogSink()
+    recorder = WriteLatencyRecorder(multimeter_row_timestamp)
+    sink.add_flush_listener(recorder)
+    args = SimpleNamespace(measurement_interval = 0.0, add_current_calibration = 0.0, folder = None, stream = False, runner_name = "benchmarks.py",
+                           quiet = quiet)
+
+    simulators, ports, rigs, timers = [], [], [], []
+    for index in range(rig_count):
+        #Close to full, so the precharge cutoff and the switch to discharge happen during the run
+        battery = BatteryModel(capacity_ah = 3.0, soc = 0.99, clock = clock)
+        relay_board, relay_channel = relay_boards[index // RELAYS_PER_BOARD], relay_channels[index // RELAYS_PER_BOARD]
+        relay_number = index % RELAYS_PER_BOARD + 1
+        rig_source = relay_rig_source(battery, relay_number, charge_current = 1.5, charge_voltage = 3.65, discharge_current = 1.5, discharge_voltage = 2.00)
+        rig_source(relay_number, False) #Relays start off, with the battery on the charger
+        relay_board.rig_sources.append(rig_source)
+        meters = [YokogawaSimulator(battery, "voltage"), YokogawaSimulator(battery, "current")]
+        rig_ports = [serial.Serial(meter.port_name, baudrate = 9600, timeout = 0.050) for meter in meters]
+        for meter in meters:
+            meter.start()
+        simulators.extend(meters)
+        ports.extend(rig_ports)
+
+        relay_controller = RelayController(relay_channel.serial, relay_number = relay_number, channel = relay_channel)
+        power_analyzer = PowerAnalyzer()
+        logger = DataLogger(["terminal"], os.path.join(directory, f"multimeter_{rig_count}_{index}"), sink = sink)
+        charge_controller = ChargeController(relay_controller, power_analyzer, logger)
+        charge_controller.set_charge_threshold(3.64, 0.600)
+        charge_controller.set_discharge_threshold(2.00)
+        charge_controller.set_mode("monitor")
+        timers.append(TransitionTimer(charge_controller.cutoff_detector, relay_controller, "set_relay"))
+        rigs.append(([YokogawaController(port) for port in rig_ports], relay_controller, power_analyzer, logger, charge_controller))
+
+    stop_event = threading.Event()
+    threads = [threading.Thread(target = multimeter.main_loop, args = (args, *rig, stop_event), daemon = True) for rig in rigs]
+    threads.append(threading.Thread(target = drain_queue, args = (multimeter.data_queue, stop_event), daemon = True))
+
+    warm_up = min(1.0, duration / 4)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        begin = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(warm_up)
+        sink.flush()
+        warm_memory, warm_samples = resident_memory(), len(recorder)
+        time.sleep(max(0.0, duration - warm_up))
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout = 10.0)
+        sampling_time = time.perf_counter() - begin
+        sink.flush()
+        end_memory, end_samples = resident_memory(), len(recorder)
+
+    sink.close()
+    for relay_channel in relay_channels:
+        relay_channel.close()
+    for port in ports:
+        port.close()
+    for simulator in simulators + relay_boards:
+        simulator.close()
+
+    memory_growth = (end_memory - warm_memory) / (end_samples - warm_samples) * 1e6 if end_samples > warm_samples else None
+    return scenario_result("multimeter", rig_count, end_samples, sampling_time, recorder, timers, memory_growth)
+
+def run_itech_scenario(rig_count : int, scale : float, warm_up : float = 0.5, timeout : float = 300.0) -> dict:
+    clock = VirtualClock(scale)
+    sink = LogSink()
+    recorder = WriteLatencyRecorder(itech_row_timestamp)
+    sink.add_flush_listener(recorder)
+    logger = logging.getLogger("benchmarks")
+
+    simulators, controllers, timers = [], [], []
+    for index in range(rig_count):
+        battery = BatteryModel(capacity_ah = 0.02, soc = 0.5, clock = clock)
+        simulator = ITechSimulator(battery)
+        simulator.start()
+        device = itech.ITech6018Device(*simulator.address)
+        device.start_time = 0.0 #Rows carry epoch timestamps, so the write latency can be read from them
+        controller = itech.ChargeController(device, device, logger, f"itech_{rig_count}_{index}", log_sink = sink)
+        controller.add_state(itech.PowerStates.CHARGE, current = 0.020, cutoff_voltage = 3.60, cutoff_current = 0.002)
+        controller.add_state(itech.PowerStates.DISCHARGE, current = -0.020, cutoff_voltage = 2.60, cutoff_current = None)
+        timers.append(TransitionTimer(controller.cutoff_detector, device, "complete_transition")) #set_state returns before the change is confirmed
+        simulators.append(simulator)
+        controllers.append(controller)
+
+    stop_event = threading.Event()
+    threads = [threading.Thread(target = controller.execute_sequence, daemon = True) for controller in controllers]
+    queue_thread = threading.Thread(target = drain_queue, args = (itech.data_queue, stop_event), daemon = True)
+    queue_thread.start()
+
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(warm_up)
+    sink.flush()
+    warm_memory, warm_samples = resident_memory(), len(recorder)
+    for thread in threads:
+        thread.join(timeout = max(0.0, timeout - (time.perf_counter() - begin)))
+    elapsed = time.perf_counter() - begin
+    stop_event.set()
+    sink.flush()
+    end_memory, samples = resident_memory(), len(recorder)
+    sink.close()
+    for simulator in simulators:
+        simulator.close()
+
+    memory_growth = (end_memory - warm_memory) / (samples - warm_samples) * 1e6 if samples > warm_samples else None
+    #Measured wall time, transitions included: the rate is what a run sustains
+    return scenario_result("itech", rig_count, samples, elapsed, recorder, timers, memory_growth)
+
+def compare_results(previous : dict, current : dict):
+    previous_scenarios = {(result["scenario"], result["rigs"]): result for result in previous["scenarios"]}
+    print(f"Comparing {previous.get('commit')} -> {current.get('commit')}")
+    for result in current["scenarios"]:
+        before = previous_scenarios.get((result["scenario"], result["rigs"]))
+        if not before:
+            continue
+        rate_ratio = result["samples_per_second"] / before["samples_per_second"] if before["samples_per_second"] else float("nan")
+        #Results saved before the rename call it reply_to_write_latency_ms, it measured the same flush
+        p99_before = before.get("reply_to_flush_latency_ms", before.get("reply_to_write_latency_ms", {})).get("p99", float("nan"))
+        p99_after = result["reply_to_flush_latency_ms"].get("p99", float("nan"))
+        print(f"{result['scenario']:>10} x{result['rigs']:<3} samples/s {rate_ratio:.2f}x\tflush p99 {p99_before:.1f} -> {p99_after:.1f} ms")
+
+def print_result(result : dict):
+    latency = result["reply_to_flush_latency_ms"]
+    transition = result["cutoff_to_transition_latency_ms"]
+    memory_growth = result["memory_growth_per_million_samples"]
+    print(f"{result['scenario']:>10} x{result['rigs']:<3} {result['samples_per_second']:10.1f} samples/s"
+          f"\tflush p50/p99/p999 {latency.get('p50', 0):.1f}/{latency.get('p99', 0):.1f}/{latency.get('p999', 0):.1f} ms"
+          f"\tcutoff->transition p50 {transition.get('p50', 0):.1f} ms ({transition['count']})"
+          f"\tmemory {memory_growth / 1e6 if memory_growth is not None else float('nan'):.1f} MB per million samples")
+
+def run_benchmarks(rig_counts : list[int], scenarios : list[str], duration : float, scale : float, itech_scale : float, quiet : bool = False) -> dict:
+    results = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "duration": duration,
+        "scale": scale,
+        "itech_scale": itech_scale,
+        "quiet": quiet,
+        "scenarios": [],
+    }
+    previous_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory, notifications_disabled():
+        os.chdir(directory) #itech.ChargeController logs under ./logs
+        try:
+            for rig_count in rig_counts:
+                if "multimeter" in scenarios:
+                    results["scenarios"].append(run_multimeter_scenario(rig_count, duration, scale, directory, quiet))
+                    print_result(results["scenarios"][-1])
+                if "itech" in scenarios:
+                    results["scenarios"].append(run_itech_scenario(rig_count, itech_scale))
+                    print_result(results["scenarios"][-1])
+        finally:
+            os.chdir(previous_directory)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Throughput, latency and memory benchmarks against simulated instruments")
+    parser.add_argument("--rigs", type = int, nargs = "+", default = [1, 4, 16], help = "Number of concurrent rigs of each run")
+    parser.add_argument("--scenarios", nargs = "+", default = ["multimeter", "itech"], choices = ["multimeter", "itech"])
+    parser.add_argument("--duration", type = float, default = 10.0, help = "Seconds each multimeter scenario runs")
+    parser.add_argument("--scale", type = float, default = 60.0, help = "Simulated seconds per real second of the multimeter batteries")
+    parser.add_argument("--itech_scale", type = float, default = 3600.0, help = "Simulated seconds per real second of the ITech batteries")
+    parser.add_argument("--quiet", action = "store_true", help = "Run multimeter.main_loop without per-sample printing")
+    parser.add_argument("--output", default = "benchmark_results.json", help = "JSON file to save the results to")
+    parser.add_argument("--compare", default = None, help = "Previous results to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.rigs, args.scenarios, args.duration, args.scale, args.itech_scale, args.quiet)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 4)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare_results(json.load(file), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#Builtins
+import os
+import json
+import time
+from typing import Callable
+
+'''
+Checkpoints of an interrupted run, so it can resume without reading its logs back.
+
+A checkpoint is a small JSON file in the run folder holding the controller state and the integrator totals.
+It is written next to its final name, synced and renamed over the previous one, so a reboot leaves either
+the old or the new checkpoint and never a partial one. Floats are written with repr and read back exactly.
+
+The acquisition loops call Checkpointer.maybe_save() after each sample, which costs a clock read unless
+interval seconds have passed, and save() when they stop. At most interval seconds of integration are
+lost on a crash; the samples of that window are still in the logs.
+'''
+
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+def save_checkpoint(path : str, state : dict):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w') as file:
+        json.dump({"version": CHECKPOINT_VERSION, "time": time.time(), "state": state}, file, indent = 4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+def load_checkpoint(path : str) -> dict:
+    with open(path, 'r') as file:
+        checkpoint = json.load(file)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} has unsupported checkpoint version {checkpoint.get('version')}")
+    return checkpoint["state"]
+
+class Checkpointer:
+    def __init__(self, path : str, snapshot : Callable[[], dict], interval : float = 10.0):
+        self.path = path
+        self.snapshot = snapshot
+        self.interval = interval
+        self.clock = time.monotonic
+        self.last_save = self.clock()
+        self.saves = 0
+
+    def maybe_save(self) -> bool:
+        if self.clock() - self.last_save < self.interval:
+            return False
+        self.save()
+        return True
+
+    def save(self):
+        self.last_save = self.clock()
+        try:
+            save_checkpoint(self.path, self.snapshot())
+            self.saves += 1
+        except OSError as e:
+            print(f"[CHECKPOINT]Error writing {self.path}: {e}")
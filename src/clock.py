@@ -0,0 +1,21 @@
+#Builtins
+import time
+
+'''
+Clocks for runs that go faster than real time. A VirtualClock drives the simulators, and the relay rig
+and the supervisor use the same clock with --time_scale, so they integrate in the simulators' time.
+'''
+
+class VirtualClock:
+    """Wall clock running scale times faster than real time, starting at the current time."""
+    def __init__(self, scale : float = 1.0):
+        assert scale > 0, "Scale must be positive"
+        self.scale = scale
+        self.real_origin = time.monotonic()
+        self.virtual_origin = time.time()
+
+    def time(self) -> float:
+        return self.virtual_origin + (time.monotonic() - self.real_origin) * self.scale
+
+    def sleep(self, seconds : float):
+        time.sleep(seconds / self.scale)
@@ -1,17 +1,21 @@
 #Builts-ins
 import serial
 import time
-import re
+import threading
 from collections import namedtuple
 from typing import Optional
 
 import serial.serialutil
-import chime
-import requests
 
 
 #Locals
 from analyzers import *
+from run_store import RunStoreWriter, encode_state
+from cutoffs import CutoffDetector, CutoffRule, CutoffEvent
+from decoders import decode_yokogawa, decode_power_supply_reply, find_yokogawa_unit, VOLTAGE_UNITS, CURRENT_UNITS
+from notifications import NotificationDispatcher, default_dispatcher
+from incremental_capacity import IncrementalCapacity
+from resistance import ResistanceEstimator, ResistanceEstimate, RESISTANCE_FIELDS, resistance_row
 
 
 class PowerSupplyController:
@@ -42,11 +46,7 @@ class PowerSupplyController:
         self.send_command('VOUT1?\rIOUT1?\r')
     
     def _parse_readings(self, lines):
-        if len(lines) != 2:
-            return ValueError("Could not parse the readings")
-        
-        voltage = float(lines[0].strip())
-        current = float(lines[1].strip())
+        voltage, current = decode_power_supply_reply(lines)
         power = voltage * current
         return (voltage, current, power)
 
@@ -76,40 +76,99 @@ class YokogawaController:
     def _ask_readings(self):
         self.send_command('RR,1\r\n')
 
-    def _parse_readings(self, line):
-        pattern = r"([+-]?\d+\.\d+)\s*([A-Za-z]+)"
-        match = re.search(pattern, line)
-
-        if not match:
-            raise ValueError("Could not parse the readings")
-        
-        value = match.group(1)
-        unit = match.group(2)
-        return (value, unit)
-
+    def trigger(self):
+        #Ask for a reading without waiting, the reply is collected by read_reply
+        self.serial.reset_input_buffer() #Drop leftovers of a reply that timed out so it is not paired with this tick
+        self.serial.write('RR,1\r\n'.encode())
+
+    def read_reply(self, deadline : float) -> Optional[bytes]:
+        #Accumulate partial reads until a full line arrives or the deadline passes
+        line = b""
+        while True:
+            line += self.serial.readline()
+            if line.endswith(b"\n"):
+                return line
+            if time.time() >= deadline:
+                return line if line else None
+
+    def decode_reply(self, line : bytes, timestamp : float) -> DataPoint:
+        #Values are normalized to V and A, so mV or mA ranges are not mistaken for volts or amps
+        reading = decode_yokogawa(line)
+        if reading is None:
+            return DataPoint(None, None, None)
+        return DataPoint(reading.value, reading.unit, timestamp)
 
     def read_measurements(self) -> DataPoint:
         if not self.serial.is_open:
             return DataPoint(None, None, None)
         self._ask_readings()
         line = self.serial.readline()
-        try:
-            value, unit = self._parse_readings(line.decode())
-            unit = format_unit(value, unit)
-        except ValueError as e:
-            return DataPoint(None, None, None)
-        timestamp = time.time()
-        return DataPoint(float(value), unit, timestamp)
+        return self.decode_reply(line, time.time())
     
     def close(self):
         self.serial.close()
 
+class RelayAcknowledgeError(Exception):
+    pass
+
+class RelayChannel:
+    """
+    Persistent, acknowledged connection to the relay board.
+
+    The port is opened once and kept open, so the board is not reset on every command. Each command waits
+    for the firmware reply "Relay <n> is <state>" and fails with RelayAcknowledgeError if the board rejects
+    it or does not answer within ack_timeout. A lock serializes the RelayControllers sharing the board.
+    """
+    def __init__(self, serial_connection : serial.Serial, ack_timeout : float = 0.500, retries : int = 1):
+        self.serial = serial_connection
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    def open(self):
+        if not self.serial.is_open:
+            self.serial.dtr = 0 #Do not reset the board on connect
+            self.serial.open()
+            self.serial.reset_input_buffer()
+
+    def _wait_acknowledgment(self, expected_reply : str) -> bool:
+        deadline = time.monotonic() + self.ack_timeout
+        while time.monotonic() < deadline:
+            reply = self.serial.readline().decode(errors = 'replace').strip()
+            if reply == expected_reply:
+                return True
+            if reply.startswith("Invalid"):
+                raise RelayAcknowledgeError(f"Relay board rejected the command: {reply}")
+            #Anything else, such as the boot banner, is not the reply we wait for
+        return False
+
+    def send(self, relay_number : int, state : str) -> float:
+        """Switches a relay and returns the time it took to be confirmed, in seconds."""
+        command = f"RELAY;{relay_number};{state}\r\n".encode()
+        expected_reply = f"Relay {relay_number} is {state}"
+        with self.lock:
+            self.open()
+            for attempt in range(self.retries + 1):
+                time_begin = time.monotonic()
+                self.serial.reset_input_buffer()
+                self.serial.write(command)
+                if self._wait_acknowledgment(expected_reply):
+                    return time.monotonic() - time_begin
+        raise RelayAcknowledgeError(f"No acknowledgment for relay {relay_number} {state} after {self.retries + 1} attempts")
+
+    def close(self):
+        with self.lock:
+            self.serial.close()
+
 class RelayController:
-    def __init__(self, serial_connection : serial.Serial, relay_number : int):
+    def __init__(self, serial_connection : serial.Serial, relay_number : int, channel : Optional[RelayChannel] = None):
         self.serial = serial_connection
         self.relay_number = relay_number
         assert relay_number in [1, 2, 3, 4], "Invalid relay number"
         self.relay_state = "OFF"
+        #Without a channel every command opens and closes the port and is not confirmed
+        self.channel = channel
+        self.last_transition_time : Optional[float] = None
     
     def _send_command(self, command):
 
@@ -126,36 +185,70 @@ class RelayController:
 
     def set_relay(self, state : str):
         assert state in ["ON", "OFF"], "Invalid state"
-        command = f"RELAY;{self.relay_number};{state}\r\n"
-        self._send_command(command)
+        if self.channel:
+            self.last_transition_time = self.channel.send(self.relay_number, state)
+        else:
+            command = f"RELAY;{self.relay_number};{state}\r\n"
+            self._send_command(command)
         self.relay_state = state
 
     def get_relay_state(self):
         return self.relay_state
     
     def close(self):
-        self.serial.close()
+        if self.channel:
+            self.channel.close()
+        else:
+            self.serial.close()
 
 class ChargeController():
 
     MODES = ["monitor", "cycle"]
     CYCLE_STATES = ["precharge", "discharge", "recharge"]
+    LOG_FORMATS = ["text", "binary"]
 
-    def __init__(self, relay_controller : RelayController, power_analyzer : PowerAnalyzer, logger : DataLogger) -> None:
+    def __init__(self, relay_controller : RelayController, power_analyzer : PowerAnalyzer, logger : DataLogger, log_format : str = "text",
+                 cutoff_detector : Optional[CutoffDetector] = None, notifier : Optional[NotificationDispatcher] = None,
+                 incremental_capacity : Optional[IncrementalCapacity] = None, resistance_estimator : Optional[ResistanceEstimator] = None) -> None:
+        assert log_format in self.LOG_FORMATS, f"Invalid log format: {log_format}"
         self.mode = "monitor"
         self.cycle_state = "precharge"
         self.cycle_completed = False
+        self.step_count = 0 #Mode and cycle state changes so far, numbers the dQ/dV curve of every step
         self.relay_controller = relay_controller
         self.power_analyzer = power_analyzer
         self.logger = logger
         self.max_charge_voltage = None
         self.charge_cutoff_current = None
         self.discharge_cutoff_voltage = None
-        self.recent_measurements = []
+        #Cutoffs must hold for every sample of the last second, with at least three samples
+        self.cutoff_detector = cutoff_detector if cutoff_detector else CutoffDetector(window_seconds = 1.0, min_samples = 3)
+        self.last_cutoff_event : Optional[CutoffEvent] = None
+        self.notifier = notifier #The shared dispatcher when None
 
         self.logger.add_save_paths(["monitor"])
         self.logger.add_save_paths(self.CYCLE_STATES)
 
+        #Binary logging keeps every sample in a single columnar store instead of one text file per state
+        self.run_store : Optional[RunStoreWriter] = None
+        if log_format == "binary":
+            self.run_store = RunStoreWriter(os.path.join(self.logger.root_path, "store"))
+
+        #dQ/dV of every state, written to the run folder when the analyzer is reset for the next one
+        self.incremental_capacity = incremental_capacity
+        if incremental_capacity:
+            if incremental_capacity.directory is None:
+                incremental_capacity.directory = self.logger.root_path
+            incremental_capacity.step_name = lambda: f"{self.step_count}_{self.mode if self.mode != 'cycle' else self.cycle_state}"
+            self.power_analyzer.add_listener(incremental_capacity)
+
+        #DC-IR of every current step, one row per step in <run folder>/resistance.csv
+        self.resistance_estimator = resistance_estimator
+        if resistance_estimator:
+            self.resistance_log_file = (os.path.join(self.logger.root_path, "resistance.csv"),)
+            resistance_estimator.label = lambda: self.mode if self.mode != "cycle" else self.cycle_state
+            self.logger.sink.add_csv_destination(self.resistance_log_file[0], RESISTANCE_FIELDS)
+
     def _next_cycle_state(self):
         if self.mode != "cycle":
             return
@@ -169,54 +262,72 @@ class ChargeController():
         self.relay_controller.set_relay(relay_state)
 
         self.power_analyzer.reset()
+        self.step_count += 1
+        self._update_cutoff_rule()
         
         print(f"CONTROLLER: Transitioning to {self.cycle_state}")
 
+    def _update_cutoff_rule(self):
+        if self.cycle_state == "discharge":
+            rule = CutoffRule(max_voltage = self.discharge_cutoff_voltage) if self.discharge_cutoff_voltage is not None else None
+        elif self.max_charge_voltage is not None:
+            rule = CutoffRule(min_voltage = self.max_charge_voltage, max_abs_current = self.charge_cutoff_current)
+        else:
+            rule = None
+        self.cutoff_detector.set_rule(rule)
+
     def set_charge_threshold(self, max_charge_voltage : float, charge_cutoff_current : float):
         self.max_charge_voltage = max_charge_voltage
         self.charge_cutoff_current = charge_cutoff_current
+        self._update_cutoff_rule()
 
     def set_discharge_threshold(self, discharge_cutoff_voltage : float):
         self.discharge_cutoff_voltage = discharge_cutoff_voltage
+        self._update_cutoff_rule()
 
     def watch_values(self, voltage, current, timestamp):  
         assert voltage is not None, "CHARGE CONTROLLER: Voltage is None"
         assert current is not None, "CHARGE CONTROLLER: Current is None"
 
-        self.recent_measurements.append((voltage, current, timestamp))
-        self.recent_measurements = [m for m in self.recent_measurements if timestamp - m[2] <= 1.0]
+        #Only cycle samples count towards a cutoff, monitor samples would trigger the detector before the cycle starts
+        if self.mode == "cycle":
+            cutoff_event = self.cutoff_detector.update(voltage, current, timestamp)
+            if cutoff_event:
+                self.evaluate_cycle_state(cutoff_event)
 
-        if len(self.recent_measurements) >= 3 and self.mode == "cycle":
-            self.evaluate_cycle_state()
+        if self.resistance_estimator:
+            estimate = self.resistance_estimator.update(voltage, current, timestamp)
+            if estimate:
+                self._log_resistance(estimate)
 
         power = voltage * current
-        accumulated_energy = self.power_analyzer.calculate_energy()
-
         directory = self.mode if self.mode != "cycle" else self.cycle_state
-        self._log_measurements(directory, voltage, current, power, accumulated_energy, timestamp)
-
-    def evaluate_cycle_state(self):
-        # Logic to evaluate whether to proceed to the next cycle state
-        # based on the recent measurements
-        voltages = [m[0] for m in self.recent_measurements]
-        currents = [m[1] for m in self.recent_measurements]
-
-        if self.cycle_state == "precharge":
-            if all(v >= self.max_charge_voltage for v in voltages) and all(abs(c) <= self.charge_cutoff_current for c in currents):
-                self._next_cycle_state()
-        elif self.cycle_state == "discharge":
-            if all(v <= self.discharge_cutoff_voltage for v in voltages):
-                self._next_cycle_state()
+
+        if self.run_store:
+            accumulated_energy, accumulated_capacity = self.power_analyzer.calculate_energy_capacity()
+            self.run_store.append(timestamp, voltage, current, power, accumulated_energy, accumulated_capacity, encode_state(directory))
+        else:
+            accumulated_energy = self.power_analyzer.calculate_energy()
+            self._log_measurements(directory, voltage, current, power, accumulated_energy, timestamp)
+
+    def evaluate_cycle_state(self, cutoff_event : CutoffEvent):
+        # The cutoff detector has confirmed the thresholds of the current cycle state
+        self.last_cutoff_event = cutoff_event
+        print_and_log(self.logger, f"CONTROLLER: {self.cycle_state} cutoff reached {cutoff_event.latency:.3f}s after the first qualifying sample")
+
+        if self.cycle_state in ["precharge", "discharge"]:
+            self._next_cycle_state()
         elif self.cycle_state == "recharge":
-            if all(v >= self.max_charge_voltage for v in voltages) and all(abs(c) <= self.charge_cutoff_current for c in currents):
-                self.cycle_completed = True
-                self.set_mode("monitor")
-                print("CONTROLLER: Cycle completed\nCheck the logs for more information")
-                requests.post("https://ntfy.sh/alertas-bateria", data = "Ciclo de carga completado")
-                chime.theme("pokemon")
-                chime.success()
-                time.sleep(6)
-                exit()
+            self.cycle_completed = True
+            self.set_mode("monitor")
+            print("CONTROLLER: Cycle completed\nCheck the logs for more information")
+            (self.notifier or default_dispatcher()).notify("Ciclo de carga completado", level = "success")
+            exit()
+
+    def _log_resistance(self, estimate : ResistanceEstimate):
+        print_and_log(self.logger, f"CONTROLLER: DC-IR {estimate.resistance * 1000:.2f}mOhm entering {estimate.label} "
+                                   f"({estimate.delta_voltage * 1000:.1f}mV / {estimate.delta_current:.3f}A)")
+        self.logger.sink.write(self.resistance_log_file, resistance_row(estimate))
 
     def _log_measurements(self, directory, voltage, current, power, energy, timestamp):
         #convert epoch time to human readable format
@@ -231,9 +342,35 @@ class ChargeController():
             return
         self.mode = mode
         self.power_analyzer.reset()
+        self.step_count += 1
 
         if mode == "monitor":
             self.relay_controller.set_relay("OFF")
+        else:
+            self._update_cutoff_rule() #Re-arm the detector for the cycle state
+
+    def snapshot(self) -> dict:
+        return {
+            "mode": self.mode,
+            "cycle_state": self.cycle_state,
+            "cycle_completed": self.cycle_completed,
+            "step_count": self.step_count,
+            "power_analyzer": self.power_analyzer.snapshot(),
+        }
+
+    def restore(self, snapshot : dict):
+        """Continues an interrupted run: mode, cycle state and totals as they were, relay set for the cycle state."""
+        assert snapshot["mode"] in self.MODES, f"Invalid mode: {snapshot['mode']}"
+        assert snapshot["cycle_state"] in self.CYCLE_STATES, f"Invalid cycle state: {snapshot['cycle_state']}"
+        self.mode = snapshot["mode"]
+        self.cycle_state = snapshot["cycle_state"]
+        self.cycle_completed = snapshot["cycle_completed"]
+        #The resumed step gets a curve of its own, the one written before the interruption is kept
+        self.step_count = snapshot.get("step_count", 0) + 1
+        self.power_analyzer.restore(snapshot["power_analyzer"])
+        relay_state = "ON" if self.mode == "cycle" and self.cycle_state == "discharge" else "OFF"
+        self.relay_controller.set_relay(relay_state)
+        self._update_cutoff_rule()
 
     def flip_relay(self):
         current_state = self.relay_controller.get_relay_state()
@@ -246,6 +383,11 @@ class ChargeController():
     def get_available_modes(self) -> list[str]:
         return self.MODES
 
+    def close(self):
+        if self.run_store:
+            self.run_store.close()
+            self.run_store = None
+
         
 
 
@@ -254,34 +396,8 @@ def count_decimal_places(number: float) -> int:
 
 
 def format_unit(value, raw_decoded_unit : str):
+    return find_yokogawa_unit(raw_decoded_unit)
 
-    #mV = 3 decimal places
-    #V = 4 decimal places
-    #uA = 2 decimal places
-    #mA = 3 decimal places
-    #A = 4 decimal places
-
-    table = [
-        {"unit": "mV"},
-        {"unit": "V"},
-        {"unit": "uA"},
-        {"unit": "mA"},
-        {"unit": "A"},
-    ]
-
-    units = ["mVAC", "VAC", "mVDC", "VDC", "OHM", "kOHM", "MOHM", "nF", "uF", "mF", "C", "nADC", "uADC", "mADC", "ADC"]
-
-    pattern = r"({})".format("|".join(units))
-
-    match = re.search(pattern, raw_decoded_unit)
-    if not match:
-        return ""
-    
-    match_unit = match.group()
-    match_unit_trimmed = match_unit.rstrip()
-    return match_unit_trimmed
-
-    
 def check_if_power_available(data_points : list[DataPoint]) -> tuple[bool, Optional[float], Optional[float]]:
     if len(data_points) != 2:
         return (False, None, None)
@@ -311,12 +427,10 @@ def find_current_and_voltage_values(data_points : list[DataPoint]) -> tuple[Opti
 
 
 def is_current_unit(unit : str) -> bool:
-    if unit is None:
-        return False
-    return re.search(r"\w?[A]", unit)
+    return unit in CURRENT_UNITS
 
 def is_voltage_unit(unit : str) -> bool:
-    return re.search(r"\w?[V]", unit)
+    return unit in VOLTAGE_UNITS
 
 def find_current_value(data_point: DataPoint) -> Optional[float]:
     if not is_current_unit(data_point.unit):
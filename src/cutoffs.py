@@ -0,0 +1,183 @@
+#Builtins
+import math
+import bisect
+from collections import deque, namedtuple
+from typing import Optional
+
+#latency is the time from the first sample of the qualifying streak to the sample that triggered the cutoff
+CutoffEvent = namedtuple("CutoffEvent", ["timestamp", "first_qualifying_timestamp", "latency", "samples"])
+
+class RunningWindow:
+    """
+    Sliding time window with running minimum and maximum.
+
+    Keeps monotonic deques of candidates, so append, eviction, minimum() and maximum() are O(1) amortized.
+    A sample stays in the window while newest_timestamp - timestamp <= window_seconds.
+    """
+    def __init__(self, window_seconds : float):
+        self.window_seconds = window_seconds
+        self.timestamps : deque = deque()
+        self.minimums : deque = deque() #(timestamp, value), values increasing
+        self.maximums : deque = deque() #(timestamp, value), values decreasing
+
+    def append(self, value : float, timestamp : float):
+        self.timestamps.append(timestamp)
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((timestamp, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((timestamp, value))
+
+        oldest_allowed = timestamp - self.window_seconds
+        while self.timestamps[0] < oldest_allowed:
+            self.timestamps.popleft()
+        while self.minimums[0][0] < oldest_allowed:
+            self.minimums.popleft()
+        while self.maximums[0][0] < oldest_allowed:
+            self.maximums.popleft()
+
+    def minimum(self) -> float:
+        return self.minimums[0][1]
+
+    def maximum(self) -> float:
+        return self.maximums[0][1]
+
+    def oldest_timestamp(self) -> float:
+        return self.timestamps[0]
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def reset(self):
+        self.timestamps.clear()
+        self.minimums.clear()
+        self.maximums.clear()
+
+class MedianFilter:
+    """Median of the last size values. size is a small constant, the sorted copy is kept with bisect."""
+    def __init__(self, size : int = 5):
+        assert size > 0, "Median filter size must be positive"
+        self.values : deque = deque(maxlen = size)
+        self.sorted_values : list[float] = []
+
+    def update(self, value : float, timestamp : float) -> float:
+        if len(self.values) == self.values.maxlen:
+            del self.sorted_values[bisect.bisect_left(self.sorted_values, self.values[0])]
+        self.values.append(value)
+        bisect.insort(self.sorted_values, value)
+
+        middle = len(self.sorted_values) // 2
+        if len(self.sorted_values) % 2:
+            return self.sorted_values[middle]
+        return (self.sorted_values[middle - 1] + self.sorted_values[middle]) / 2
+
+    def reset(self):
+        self.values.clear()
+        self.sorted_values = []
+
+class EMAFilter:
+    """Exponential moving average with a time constant in seconds, so uneven sample spacing is handled."""
+    def __init__(self, time_constant : float):
+        assert time_constant > 0, "Time constant must be positive"
+        self.time_constant = time_constant
+        self.value : Optional[float] = None
+        self.last_timestamp : Optional[float] = None
+
+    def update(self, value : float, timestamp : float) -> float:
+        if self.value is None:
+            self.value = value
+        else:
+            delta_time = max(0.0, timestamp - self.last_timestamp)
+            alpha = 1 - math.exp(-delta_time / self.time_constant)
+            self.value += alpha * (value - self.value)
+        self.last_timestamp = timestamp
+        return self.value
+
+    def reset(self):
+        self.value = None
+        self.last_timestamp = None
+
+class CutoffRule:
+    """Thresholds that must all hold. Limits left as None are not checked."""
+    def __init__(self, min_voltage : Optional[float] = None, max_voltage : Optional[float] = None, max_abs_current : Optional[float] = None):
+        self.min_voltage = min_voltage
+        self.max_voltage = max_voltage
+        self.max_abs_current = max_abs_current
+
+    def is_met(self, lowest_voltage : float, highest_voltage : float, highest_abs_current : float) -> bool:
+        if self.min_voltage is not None and lowest_voltage < self.min_voltage:
+            return False
+        if self.max_voltage is not None and highest_voltage > self.max_voltage:
+            return False
+        if self.max_abs_current is not None and highest_abs_current > self.max_abs_current:
+            return False
+        return True
+
+    def __repr__(self) -> str:
+        return f"CutoffRule(min_voltage={self.min_voltage}, max_voltage={self.max_voltage}, max_abs_current={self.max_abs_current})"
+
+class CutoffDetector:
+    """
+    Decides when a charge or discharge step has reached its cutoff.
+
+    Samples are optionally filtered, then fed to time windows of voltage and |current|. The rule must hold
+    for every sample in the last window_seconds, the window must contain at least min_samples samples and
+    the qualifying streak must have lasted hold_time seconds. The detector fires once, then stays quiet
+    until it is reset or given a new rule.
+    """
+    def __init__(self, window_seconds : float = 1.0, min_samples : int = 3, hold_time : float = 0.0,
+                 voltage_filter = None, current_filter = None):
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.hold_time = hold_time
+        self.voltage_filter = voltage_filter
+        self.current_filter = current_filter
+        self.voltage_window = RunningWindow(window_seconds)
+        self.current_window = RunningWindow(window_seconds)
+        self.rule : Optional[CutoffRule] = None
+        self.reset()
+
+    def set_rule(self, rule : Optional[CutoffRule]):
+        self.rule = rule
+        self.reset()
+
+    def reset(self):
+        self.voltage_window.reset()
+        self.current_window.reset()
+        if self.voltage_filter:
+            self.voltage_filter.reset()
+        if self.current_filter:
+            self.current_filter.reset()
+        self.first_qualifying_timestamp : Optional[float] = None
+        self.triggered = False
+
+    def update(self, voltage : float, current : float, timestamp : float) -> Optional[CutoffEvent]:
+        if self.voltage_filter:
+            voltage = self.voltage_filter.update(voltage, timestamp)
+        if self.current_filter:
+            current = self.current_filter.update(current, timestamp)
+        abs_current = abs(current)
+        self.voltage_window.append(voltage, timestamp)
+        self.current_window.append(abs_current, timestamp)
+
+        if self.rule is None or self.triggered:
+            return None
+
+        if self.rule.is_met(voltage, voltage, abs_current):
+            if self.first_qualifying_timestamp is None:
+                self.first_qualifying_timestamp = timestamp
+        else:
+            self.first_qualifying_timestamp = None
+            return None
+
+        if len(self.voltage_window) < self.min_samples:
+            return None
+        if timestamp - self.first_qualifying_timestamp < self.hold_time:
+            return None
+        if not self.rule.is_met(self.voltage_window.minimum(), self.voltage_window.maximum(), self.current_window.maximum()):
+            return None
+
+        self.triggered = True
+        latency = timestamp - self.first_qualifying_timestamp
+        return CutoffEvent(timestamp, self.first_qualifying_timestamp, latency, len(self.voltage_window))
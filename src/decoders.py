@@ -0,0 +1,81 @@
+#Builtins
+import re
+import timeit
+from collections import namedtuple
+from typing import Optional
+
+'''
+Instrument reply decoders. Every decoder works on the raw bytes read from the port or socket, uses tables
+and patterns built once at import time, and returns values in base SI units (V, A, ohm, F).
+'''
+
+#value is in base SI units, unit is the unit without its prefix (e.g. 1.978 mVDC -> 0.001978 VDC)
+Reading = namedtuple("Reading", ["value", "unit"])
+
+#Yokogawa unit suffix -> (base unit, scale to base unit)
+YOKOGAWA_UNITS = {
+    "mVAC": ("VAC", 1e-3),
+    "VAC": ("VAC", 1.0),
+    "mVDC": ("VDC", 1e-3),
+    "VDC": ("VDC", 1.0),
+    "OHM": ("OHM", 1.0),
+    "kOHM": ("OHM", 1e3),
+    "MOHM": ("OHM", 1e6),
+    "nF": ("F", 1e-9),
+    "uF": ("F", 1e-6),
+    "mF": ("F", 1e-3),
+    "C": ("C", 1.0),
+    "nADC": ("ADC", 1e-9),
+    "uADC": ("ADC", 1e-6),
+    "mADC": ("ADC", 1e-3),
+    "ADC": ("ADC", 1.0),
+}
+_YOKOGAWA_UNITS_BYTES = {unit.encode(): scaled_unit for unit, scaled_unit in YOKOGAWA_UNITS.items()}
+
+#Longest units first so a prefixed unit is never read as its shorter base unit
+_UNIT_ALTERNATION = "|".join(sorted(YOKOGAWA_UNITS, key = len, reverse = True))
+#Frames look like b"RR,B,-00.002mADC0\r\n", the character after the unit is not part of it
+YOKOGAWA_FRAME_PATTERN = re.compile(rb"([+-]?\d+\.\d+)\s*(" + _UNIT_ALTERNATION.encode() + rb")")
+YOKOGAWA_UNIT_PATTERN = re.compile(_UNIT_ALTERNATION)
+
+VOLTAGE_UNITS = frozenset(unit for unit, (base_unit, _) in YOKOGAWA_UNITS.items() if base_unit in ("VDC", "VAC"))
+CURRENT_UNITS = frozenset(unit for unit, (base_unit, _) in YOKOGAWA_UNITS.items() if base_unit == "ADC")
+
+def decode_yokogawa(frame : bytes) -> Optional[Reading]:
+    #The value follows the last comma, an anchored match there avoids scanning the header
+    match = YOKOGAWA_FRAME_PATTERN.match(frame, frame.rfind(b',') + 1) or YOKOGAWA_FRAME_PATTERN.search(frame)
+    if not match:
+        return None
+    base_unit, scale = _YOKOGAWA_UNITS_BYTES[match.group(2)]
+    return Reading(float(match.group(1)) * scale, base_unit)
+
+def find_yokogawa_unit(raw_unit : str) -> str:
+    """Returns the Yokogawa unit contained in raw_unit, or "" if there is none."""
+    match = YOKOGAWA_UNIT_PATTERN.search(raw_unit)
+    return match.group() if match else ""
+
+def decode_scpi_numbers(reply : bytes) -> tuple[float, ...]:
+    """Numbers of a SCPI reply, several values may be separated by ';' (chained queries) or ','."""
+    return tuple(map(float, reply.replace(b',', b';').split(b';')))
+
+def decode_power_supply_reply(lines : list[bytes]) -> tuple[float, float]:
+    """Replies to 'VOUT1?\\rIOUT1?\\r' come as one value per line: voltage, then current."""
+    if len(lines) != 2:
+        raise ValueError("Could not parse the readings")
+    return float(lines[0]), float(lines[1])
+
+def benchmark_decoders(iterations : int = 100_000):
+    cases = {
+        "yokogawa": lambda: decode_yokogawa(b"RR,B,-00.002mADC0\r\n"),
+        "scpi": lambda: decode_scpi_numbers(b"3.30012;-1.50034;-4.95130"),
+        "power supply": lambda: decode_power_supply_reply([b"3.30\n", b"1.500\n"]),
+    }
+    results = {}
+    for name, decode in cases.items():
+        seconds = min(timeit.repeat(decode, number = iterations, repeat = 5))
+        results[name] = seconds / iterations
+        print(f"{name:>12}: {results[name] * 1e9:.0f} ns per sample")
+    return results
+
+if __name__ == "__main__":
+    benchmark_decoders()
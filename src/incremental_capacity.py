@@ -0,0 +1,94 @@
+#Builtins
+import os
+import math
+from array import array
+from typing import Callable, Optional
+
+#Third party
+import numpy as np
+
+'''
+Incremental capacity (dQ/dV) computed while the run goes, instead of reloading the log afterwards.
+
+IncrementalCapacity listens to a PowerAnalyzer: every integrated interval adds its Ah to the voltage bin of
+the interval's average voltage, in a histogram of fixed size, so a sample costs one division and one
+addition. When the analyzer is reset at the end of a step, the curve of the step is written to the run
+folder and the histogram is cleared:
+
+    <directory>/dqdv_<step name>.csv     voltage;ah;dqdv;dqdv_smoothed
+
+dqdv is |Ah| per volt of the bin, positive for charge and discharge. dqdv_smoothed is the same curve
+convolved with a Gaussian of smoothing bins (sigma), or equal to dqdv when smoothing is 0.
+'''
+
+class IncrementalCapacity:
+    def __init__(self, directory : Optional[str] = None, min_voltage : float = 0.0, max_voltage : float = 64.0, bin_width : float = 0.005,
+                 smoothing : float = 2.0):
+        assert max_voltage > min_voltage, "Voltage range is empty"
+        assert bin_width > 0, "Bin width must be positive"
+        self.directory = directory #Set by the controller to its run folder when None
+        self.min_voltage = min_voltage
+        self.bin_width = bin_width
+        self.bin_count = int(math.ceil((max_voltage - min_voltage) / bin_width))
+        self.smoothing = smoothing
+        self.capacity = array('d', bytes(8 * self.bin_count))
+        self.step_name : Callable[[], str] = lambda: "step" #Name of the step being accumulated, given by the controller
+        self.current_step_name : Optional[str] = None
+        self.intervals = 0
+        self.out_of_range = 0
+
+    def on_interval(self, voltage : float, capacity : float):
+        if self.current_step_name is None:
+            self.current_step_name = self.step_name()
+        index = int((voltage - self.min_voltage) / self.bin_width)
+        if 0 <= index < self.bin_count:
+            self.capacity[index] += capacity
+            self.intervals += 1
+        else:
+            self.out_of_range += 1
+
+    def on_reset(self):
+        if self.intervals and self.directory is not None:
+            self.write(os.path.join(self.directory, f"dqdv_{self.current_step_name}.csv"))
+        self.clear()
+
+    def clear(self):
+        self.capacity = array('d', bytes(8 * self.bin_count))
+        self.current_step_name = None
+        self.intervals = 0
+        self.out_of_range = 0
+
+    def curve(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Returns (bin centre voltages, Ah, dQ/dV, smoothed dQ/dV) over the bins between the first and last one used."""
+        capacity = np.abs(np.frombuffer(self.capacity, dtype = np.float64))
+        used = np.flatnonzero(capacity)
+        if len(used) == 0:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+        first, last = used[0], used[-1] + 1
+        capacity = capacity[first:last]
+        voltage = self.min_voltage + (np.arange(first, last) + 0.5) * self.bin_width
+        dqdv = capacity / self.bin_width
+        return voltage, capacity, dqdv, self._smooth(dqdv)
+
+    def _smooth(self, values : np.ndarray) -> np.ndarray:
+        if self.smoothing <= 0:
+            return values
+        radius = int(math.ceil(3 * self.smoothing))
+        offsets = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 * (offsets / self.smoothing) ** 2)
+        kernel /= kernel.sum()
+        #Divided by the kernel weight inside the curve, so the ends are not pulled towards zero
+        window = slice(radius, radius + len(values))
+        weights = np.convolve(np.ones(len(values)), kernel)[window]
+        return np.convolve(values, kernel)[window] / weights
+
+    def write(self, path : str):
+        voltage, capacity, dqdv, smoothed = self.curve()
+        try:
+            with open(path, 'w', newline = '') as file:
+                file.write("voltage;ah;dqdv;dqdv_smoothed\r\n")
+                for row in zip(voltage.tolist(), capacity.tolist(), dqdv.tolist(), smoothed.tolist()):
+                    file.write(f"{row[0]:.4f};{row[1]:.9f};{row[2]:.6f};{row[3]:.6f}\r\n")
+        except OSError as e:
+            print(f"[DQDV]Error writing {path}: {e}")
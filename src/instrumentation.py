@@ -0,0 +1,159 @@
+#Builtins
+import os
+import json
+import math
+import time
+import threading
+from array import array
+from typing import Optional
+
+'''
+Always-on timing of the acquisition loop stages.
+
+Every stage has a fixed-size histogram with log spaced buckets (four per octave from 1 us to about a minute),
+so memory does not grow with the run length and recording a duration costs a clock read and a few additions.
+The loop chains the measurements, each lap ending one stage and starting the next:
+
+    start = instrumentation.clock()
+    data = read()
+    start = instrumentation.lap("read", start)
+    process(data)
+    start = instrumentation.lap("process", start)
+
+A background thread writes every histogram to a JSON file in the run folder periodically. NullInstrumentation
+has the same interface and does nothing, for when even that cost is unwanted.
+'''
+
+SUB_BUCKETS = 4
+OCTAVES = 26
+BUCKET_COUNT = 1 + OCTAVES * SUB_BUCKETS
+
+def bucket_index(duration : float) -> int:
+    #Bucket 0 holds everything under 1 us, then each octave of microseconds is split in SUB_BUCKETS
+    microseconds = duration * 1e6
+    if microseconds < 1.0:
+        return 0
+    mantissa, exponent = math.frexp(microseconds)
+    index = 1 + (exponent - 1) * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+    return index if index < BUCKET_COUNT else BUCKET_COUNT - 1
+
+def bucket_upper_bound(index : int) -> float:
+    """Upper bound of a bucket, in seconds."""
+    if index == 0:
+        return 1e-6
+    octave, sub_bucket = divmod(index - 1, SUB_BUCKETS)
+    return 2 ** octave * (1 + (sub_bucket + 1) / SUB_BUCKETS) * 1e-6
+
+class StageHistogram:
+    def __init__(self):
+        self.counts = array('Q', [0] * BUCKET_COUNT)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, duration : float):
+        self.counts[bucket_index(duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+
+    def percentile(self, fraction : float) -> float:
+        """Upper bound of the bucket holding the given fraction of the samples, in seconds."""
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bucket_upper_bound(index), self.maximum)
+        return self.maximum
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6 if self.count else 0.0,
+            "p50_us": self.percentile(0.50) * 1e6,
+            "p99_us": self.percentile(0.99) * 1e6,
+            "p999_us": self.percentile(0.999) * 1e6,
+            "max_us": self.maximum * 1e6,
+            #Only the buckets in use, keyed by their upper bound in microseconds
+            "buckets": {f"{bucket_upper_bound(index) * 1e6:.2f}": count for index, count in enumerate(self.counts) if count},
+        }
+
+class Instrumentation:
+    def __init__(self, stages : list[str]):
+        assert stages, "No stages provided"
+        self.stages = {stage: StageHistogram() for stage in stages}
+        self.clock = time.perf_counter
+        self.path : Optional[str] = None
+        self.dump_interval = 60.0
+        self.stop_event = threading.Event()
+        self.dump_thread : Optional[threading.Thread] = None
+
+    def lap(self, stage : str, start : float) -> float:
+        """Records the time since start for stage and returns the current time, the start of the next stage."""
+        now = self.clock()
+        self.stages[stage].record(now - start)
+        return now
+
+    def record(self, stage : str, duration : float):
+        self.stages[stage].record(duration)
+
+    def to_dict(self) -> dict:
+        return {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+
+    def dump(self):
+        if not self.path:
+            return
+        #Written next to the file then renamed, so a reader never sees a partial dump
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, 'w') as file:
+                json.dump({"time": time.time(), "stages": self.to_dict()}, file, indent = 4)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"[INSTRUMENTATION]Error writing {self.path}: {e}")
+
+    def start_dumping(self, path : str, interval : float = 60.0):
+        self.path = path
+        self.dump_interval = interval
+        self.dump_thread = threading.Thread(target = self._dump_loop, name = "instrumentation", daemon = True)
+        self.dump_thread.start()
+
+    def _dump_loop(self):
+        while not self.stop_event.wait(self.dump_interval):
+            self.dump()
+
+    def close(self):
+        self.stop_event.set()
+        if self.dump_thread and self.dump_thread is not threading.current_thread():
+            self.dump_thread.join(timeout = 5.0)
+        self.dump()
+
+class NullInstrumentation:
+    """Instrumentation that records nothing."""
+    def __init__(self, stages : Optional[list[str]] = None):
+        self.stages = {}
+
+    def clock(self) -> float:
+        return 0.0
+
+    def lap(self, stage : str, start : float) -> float:
+        return start
+
+    def record(self, stage : str, duration : float):
+        pass
+
+    def to_dict(self) -> dict:
+        return {}
+
+    def dump(self):
+        pass
+
+    def start_dumping(self, path : str, interval : float = 60.0):
+        pass
+
+    def close(self):
+        pass
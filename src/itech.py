@@ -1,6 +1,6 @@
 #socket client communication
 
-from typing import Optional, Protocol, Union, List, Type
+from typing import Callable, Optional, Protocol, Union, List, Type
 from enum import Enum
 from dataclasses import dataclass, asdict, fields
 import socket
@@ -9,8 +9,22 @@ import logging
 import os
 from utils import generate_test_folder_name
 from analyzers import PowerAnalyzer
+from run_store import RunStoreWriter, encode_state
+from cutoffs import CutoffDetector, CutoffRule
+from plot_buffer import PlotBuffer
+from log_sink import LogSink
+from decoders import decode_scpi_numbers
+from instrumentation import Instrumentation, NullInstrumentation
+from metrics import MetricsRegistry, RigStatus, start_metrics_server
+from notifications import default_dispatcher
+from checkpoint import Checkpointer, load_checkpoint, CHECKPOINT_FILE
+from incremental_capacity import IncrementalCapacity
+from resistance import ResistanceEstimator, RESISTANCE_FIELDS, resistance_row
+from log_segments import RotationPolicy, DEFAULT_ROTATION, rotate_file
+from log_index import append_index_entry, last_index_entry
 
 import threading
+import argparse
 import matplotlib.pyplot as plot
 from matplotlib.animation import FuncAnimation
 from queue import Queue, Empty
@@ -18,62 +32,61 @@ import csv
 
 #Thread safe queue to store data points
 data_queue = Queue()
-voltage_values =  []
-current_values =  []
-timestamps     =  []
-
-figure, axes = plot.subplots(2, 1, figsize = (10, 6))
-
-#Voltage plot
-axes[0].set_title("Voltage")
-axes[0].set_ylabel("Voltage (V)")
-axes[0].set_xlabel("Time (s)")
-axes[0].set_xlim(0, 10)
-axes[0].set_ylim(2, 4)
-axes[0].legend(loc = "upper right")
-line_voltage, = axes[0].plot([], [], label = "Voltage", color = "blue")
-
-#Current plot
-axes[1].set_title("Current")
-axes[1].set_xlabel("Time (s)")
-axes[1].set_ylabel("Current (A)")
-axes[1].set_xlim(0, 10)
-axes[1].set_ylim(-5, 5)
-axes[1].legend(loc = "upper right")
-line_current, = axes[1].plot([], [], label = "Current", color = "red")
-
-#Update function for the live plot
-def update_plot(frame):
-    global voltage_values, current_values, timestamps
-
-    try:
-        while True:
-            voltage, current, timestamp = data_queue.get_nowait()
-            voltage_values.append(voltage)
-            current_values.append(current)
-            timestamps.append(timestamp)
-    except Empty:
-        pass
-
-    if len(timestamps) > 0:
-        line_voltage.set_data(timestamps, voltage_values)
-        axes[0].set_xlim(timestamps[0], timestamps[-1])
-        axes[0].set_ylim(min(voltage_values) - 0.1, max(voltage_values) + 0.1)
-
-        line_current.set_data(timestamps, current_values)
-        axes[1].set_xlim(timestamps[0], timestamps[-1])
-        axes[1].set_ylim(min(current_values) - 0.1, max(current_values) + 0.1)
-
-        axes[0].relim()
-        axes[0].autoscale_view()
-        axes[1].relim()
-        axes[1].autoscale_view()
+#Min/max envelope of the whole run, so redraws stay cheap on long runs
+plot_buffer = PlotBuffer(channels = 2, max_buckets = 1024)
 
-    return line_voltage, line_current
-
-animation = FuncAnimation(figure, update_plot, interval = 100)
+def start_plot(window_title: str = "Live Plot"):
+    #The window is only built here, so importing this module has no plotting side effect
+    figure, axes = plot.subplots(2, 1, figsize = (10, 6))
+    figure.suptitle(window_title)
+    figure.canvas.manager.set_window_title("ITECH")
 
-def start_plot():
+    #Voltage plot
+    axes[0].set_title("Voltage")
+    axes[0].set_ylabel("Voltage (V)")
+    axes[0].set_xlabel("Time (s)")
+    axes[0].set_xlim(0, 10)
+    axes[0].set_ylim(2, 4)
+    line_voltage, = axes[0].plot([], [], label = "Voltage", color = "blue")
+    axes[0].legend(loc = "upper right")
+
+    #Current plot
+    axes[1].set_title("Current")
+    axes[1].set_xlabel("Time (s)")
+    axes[1].set_ylabel("Current (A)")
+    axes[1].set_xlim(0, 10)
+    axes[1].set_ylim(-5, 5)
+    line_current, = axes[1].plot([], [], label = "Current", color = "red")
+    axes[1].legend(loc = "upper right")
+
+    #Update function for the live plot
+    def update_plot(frame):
+        try:
+            while True:
+                voltage, current, timestamp = data_queue.get_nowait()
+                plot_buffer.append(timestamp, (voltage, current))
+        except Empty:
+            pass
+
+        if len(plot_buffer) > 0:
+            lowest_voltage, highest_voltage = plot_buffer.get_limits(0)
+            line_voltage.set_data(*plot_buffer.get_series(0))
+            axes[0].set_xlim(plot_buffer.first_time, plot_buffer.last_time)
+            axes[0].set_ylim(lowest_voltage - 0.1, highest_voltage + 0.1)
+
+            lowest_current, highest_current = plot_buffer.get_limits(1)
+            line_current.set_data(*plot_buffer.get_series(1))
+            axes[1].set_xlim(plot_buffer.first_time, plot_buffer.last_time)
+            axes[1].set_ylim(lowest_current - 0.1, highest_current + 0.1)
+
+            axes[0].relim()
+            axes[0].autoscale_view()
+            axes[1].relim()
+            axes[1].autoscale_view()
+
+        return line_voltage, line_current
+
+    animation = FuncAnimation(figure, update_plot, interval = 100, cache_frame_data = False) #Kept referenced until the window closes
     plot.tight_layout()
     plot.show()
 
@@ -115,6 +128,13 @@ class DataPointClass:
     timestamp: float
     is_valid : bool
 
+DATA_POINT_FIELDS = tuple(field.name for field in fields(DataPointClass))
+
+def data_point_row(data_point: DataPointClass) -> tuple:
+    #Same column order as DATA_POINT_FIELDS, without the deep copy done by asdict/astuple
+    return (data_point.voltage, data_point.current, data_point.power, data_point.ahour,
+            data_point.whour, data_point.timestamp, data_point.is_valid)
+
 def round_values(data_point_dict: dict, decimal_places: int) -> dict:
     rounded_dict = {}
     for key, value in data_point_dict.items():
@@ -125,12 +145,17 @@ def round_values(data_point_dict: dict, decimal_places: int) -> dict:
 
 def serialize_to_csv(data_points : Union[object, List[object]],
                      data_point_type : Type,
-                     file_path : str):
+                     file_path : str,
+                     rotation : Optional[RotationPolicy] = DEFAULT_ROTATION,
+                     index_seconds : Optional[float] = 60.0):
     if isinstance(data_points, data_point_type):
         data_points = [data_points]
     elif not isinstance(data_points, list):
         raise ValueError(f"Expected {data_point_type}, got {type(data_points)}")
     
+    #The file is reopened on every call, so only its size is known to rotate it
+    if rotation and os.path.isfile(file_path) and rotation.should_rotate(os.path.getsize(file_path)):
+        rotate_file(file_path, rotation.compression)
     file_exists = os.path.isfile(file_path)
 
     with open(file_path, mode = 'a' if file_exists else 'w', newline = '') as file:
@@ -138,6 +163,12 @@ def serialize_to_csv(data_points : Union[object, List[object]],
 
         if not file_exists:
             writer.writeheader()
+        if index_seconds is not None and data_points and data_points[0].timestamp is not None:
+            #Called with a few rows at a time, so the time index gets an entry at most every index_seconds
+            last_entry = last_index_entry(file_path)
+            if last_entry is None or data_points[0].timestamp - last_entry[0] >= index_seconds:
+                file.flush()
+                append_index_entry(file_path, data_points[0].timestamp, file.tell())
         for data_point in data_points:
             data_point_dict = asdict(data_point)
             #rounded_dict = round_values(data_point_dict, 2)
@@ -158,23 +189,117 @@ class StateManager(Protocol):
     def set_state(self, state : PowerStates, current : float, cutoff_voltage : float, cutoff_current : float):
         pass
 
+def scpi_line(commands: list[str]) -> str:
+    #Chains commands in one program message, a leading ':' restarts each header at the root
+    return ";".join(command if index == 0 or command.startswith('*') else f":{command}" for index, command in enumerate(commands)) + "\n"
+
+class ITechCommands:
+    """SCPI of the ITech 6018 shared by the blocking driver and the asyncio one (itech_async)."""
+    COMPOUND_QUERY = "MEASURE:VOLTAGE?;:MEASURE:CURRENT?;:MEASURE:POWER?\n"
+    INITIAL_COMMANDS = ['SYSTEM:REMOTE\n', '*CLS\n', 'FUNCTION:MODE FIXED\n', 'SENSE:ACQUIRE:POINTS 10\n', 'SENSE:WHOUR:RESET\n', 'SENSE:AHOUR:RESET\n']
+    MAX_ERROR_QUEUE = 32
+    #Sent after a reply timed out: the replies still in flight are read and dropped until the "1" of this *OPC?
+    RESYNC_COMMAND = "*CLS;*OPC?\n"
+    RESYNC_REPLY = "1"
+    MAX_STALE_REPLIES = 16
+    MODE_QUERY = "FUNCTION:MODE?\n"
+    #How a CHARGE or DISCHARGE transition waits for FIXED mode before the battery settings:
+    #wai: *WAI in the transition line, which is sent in one go
+    #poll: FUNCTION:MODE FIXED alone, then FUNCTION:MODE? until the instrument reports FIXED
+    MODE_CHANGES = ["wai", "poll"]
+    MODE_POLL_INTERVAL = 0.050
+
+    def _parse_compound_response(self, response: bytes) -> tuple[float, float, float]:
+        values = decode_scpi_numbers(response)
+        if len(values) != 3:
+            raise ValueError(f"Expected voltage, current and power, got {response!r}")
+        return values
+
+    def battery_commands(self, state: PowerStates, current: float, cutoff_voltage: float, cutoff_current: float) -> list[str]:
+        #Battery test of a CHARGE or DISCHARGE step, to send once the instrument is in FIXED mode
+        if state == PowerStates.CHARGE:
+            return ["BATTERY:MODE CHARGE",
+                    *self._charge_rate_commands(charge_current = current, charge_cutoff_voltage = cutoff_voltage, charge_cutoff_current = cutoff_current),
+                    "FUNCTION:MODE BATTERY"]
+        return ["BATTERY:MODE DISCHARGE",
+                *self._discharge_rate_commands(discharge_current = current, discharge_cutoff_voltage = cutoff_voltage, discharge_cutoff_current = cutoff_current),
+                "FUNCTION:MODE BATTERY"]
+
+    def transition_commands(self, state: PowerStates, current: float, cutoff_voltage: float, cutoff_current: float) -> str:
+        #The whole transition as one line, ending with *OPC? and SYSTEM:ERROR? (see ITech6018Device.set_state).
+        #*WAI is expected to hold the battery settings until FIXED mode has taken effect, this is not verified on the instrument
+        if state in (PowerStates.CHARGE, PowerStates.DISCHARGE):
+            commands = ["FUNCTION:MODE FIXED", "*WAI", *self.battery_commands(state, current, cutoff_voltage, cutoff_current)]
+        else:
+            commands = ["FUNCTION:MODE FIXED", "OUTPUT 0"]
+        return scpi_line(commands + ["*OPC?", "SYSTEM:ERROR?"])
+
+    @staticmethod
+    def transition_errors(reply: str) -> tuple[list[str], str]:
+        #Reply to "*OPC?;SYSTEM:ERROR?": the errors so far and the error queue entry, to read again until it is 0
+        operation_complete, _, error = reply.partition(';')
+        errors = [] if operation_complete == "1" else [f"Unexpected *OPC? reply {reply!r}"]
+        return errors, error
+
+    @staticmethod
+    def is_error(error: str) -> bool:
+        return bool(error) and not error.lstrip('+').startswith('0,')
+
+    def _charge_rate_commands(self, charge_current : float, charge_cutoff_voltage : float, charge_cutoff_current : float) -> list[str]:
+        return [f"BATTERY:CHARGE:CURRENT {charge_current}",
+                f"BATTERY:CHARGE:VOLTAGE {charge_cutoff_voltage + 0.020}", #For charge, charge voltage must be the same as the cutoff voltage
+                "BATTERY:SHUT:CURRENT 0",
+                f"BATTERY:SHUT:VOLTAGE {charge_cutoff_voltage + 1.000}"] #For charge, shutdown voltage must be above the charge voltage
+
+    def _discharge_rate_commands(self, discharge_current : float, discharge_cutoff_voltage : float, discharge_cutoff_current : float) -> list[str]:
+        return [f"BATTERY:DISCHARGE:CURRENT {discharge_current}",
+                f"BATTERY:DISCHARGE:VOLTAGE {discharge_cutoff_voltage - 0.150}", #For discharge, discharge voltage must be below the shutdown voltage
+                "BATTERY:SHUT:CURRENT 0",
+                f"BATTERY:SHUT:VOLTAGE {discharge_cutoff_voltage - 0.150}"] #For discharge, shutdown voltage is the same as the cutoff voltage
+
 #Bidirectional power supply that can read measurements and charge and discharge batteries itself via socket communication
-class ITech6018Device(DataSource, StateManager):
-    def __init__(self, ip: str, port: int):
+class ITech6018Device(ITechCommands, DataSource, StateManager):
+
+    #separate: one round trip per quantity
+    #compound: voltage, current and power in a single chained query
+    #pipelined: compound, with the next query sent before the current reply is processed
+    MEASUREMENT_MODES = ["separate", "compound", "pipelined"]
+
+    def __init__(self, ip: str, port: int, measurement_mode: str = "compound", clock: Callable[[], float] = time.time,
+                 transition_timeout: float = 10.0, max_consecutive_errors: int = 10, error_backoff: float = 0.100,
+                 mode_change: str = "wai"):
+        assert measurement_mode in self.MEASUREMENT_MODES, f"Invalid measurement mode: {measurement_mode}"
+        assert mode_change in self.MODE_CHANGES, f"Invalid mode change: {mode_change}"
         self.ip = ip
         self.port = port
+        self.measurement_mode = measurement_mode
+        self.mode_change = mode_change
+        self.clock = clock #A simulator's virtual clock makes accelerated runs integrate in simulated time
+        #A failed read waits error_backoff, doubled on every failure in a row, so a silent unit is not polled at full speed.
+        #After max_consecutive_errors failed reads the sequence fails
+        self.max_consecutive_errors = max_consecutive_errors
+        self.error_backoff = error_backoff
+        self.consecutive_errors = 0
+        self.receive_buffer = b""
+        self.query_in_flight = False
+        self.query_sent_at = 0.0 #Clock time the pipelined query in flight was sent, the time of the sample it answers
+        self.out_of_sync = False #A reply did not arrive in time and may still come, see resynchronize
+        self.resync_in_flight = False
         self.state = PowerStates.PASSIVE
+        #Transition sent by set_state whose *OPC? reply was not read yet
+        self.transition_pending: Optional[PowerStates] = None
+        self.transition_start = 0.0
+        self.transition_timeout = transition_timeout
+        self.last_transition: Optional[tuple] = None #(state, latency in seconds, errors)
+        self.transition_listener: Optional[Callable[[PowerStates, float, list], None]] = None
+        self.reply_timeout = 3.0
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(3)
-        self.start_time = time.time()
+        self.socket.settimeout(self.reply_timeout)
+        self.start_time = self.clock()
         try:
             self.socket.connect((self.ip, self.port))
-            self.send_command('SYSTEM:REMOTE\n')
-            self.send_command('*CLS\n')
-            self.send_command('FUNCTION:MODE FIXED\n')
-            self.send_command('SENSE:ACQUIRE:POINTS 10\n')
-            self.send_command('SENSE:WHOUR:RESET\n')
-            self.send_command('SENSE:AHOUR:RESET\n')
+            for command in self.INITIAL_COMMANDS:
+                self.send_command(command)
 
         except socket.error as e:
             print(f"Error connecting to device: {e}")
@@ -194,52 +319,205 @@ class ITech6018Device(DataSource, StateManager):
         except socket.error as e:
             print(f"Error sending command: {e}")
 
-    def receive_response(self) -> str:
+    def receive_line(self) -> bytes:
+        """
+        Returns the next reply line, an empty line when it times out. A closed connection raises ConnectionError,
+        a dead unit would otherwise look like an endless series of timeouts that take no time at all.
+        """
+        #Replies are newline terminated and may arrive split over several packets
         try:
-            data = self.socket.recv(1024)
-            return data.decode('utf-8').strip()
-        except socket.error as e:
+            while b"\n" not in self.receive_buffer:
+                data = self.socket.recv(1024)
+                if not data:
+                    raise ConnectionError("Connection closed by device")
+                self.receive_buffer += data
+            line, self.receive_buffer = self.receive_buffer.split(b"\n", 1)
+            return line
+        except socket.timeout as e:
             print(f"Error receiving response: {e}")
-            return ""
+            self.receive_buffer = b""
+            self.out_of_sync = True
+            return b""
+        except socket.error as e:
+            self.receive_buffer = b""
+            if isinstance(e, ConnectionError):
+                raise
+            raise ConnectionError(f"Error receiving response from {self.ip}:{self.port}: {e}") from e
+
+    def receive_response(self) -> str:
+        return self.receive_line().decode('utf-8').strip()
+
+    def _read_separate(self) -> tuple[float, float, float]:
+        self.send_command("MEASURE:CURRENT?\n")
+        current, = decode_scpi_numbers(self.receive_line())
+        
+        self.send_command("MEASURE:VOLTAGE?\n")
+        voltage, = decode_scpi_numbers(self.receive_line())
+        return voltage, current, voltage * current
+
+    def _read_compound(self) -> tuple[float, float, float]:
+        self.send_command(self.COMPOUND_QUERY)
+        return self._parse_compound_response(self.receive_line())
+
+    def _read_pipelined(self) -> tuple[float, float, float, float]:
+        #The reply answers a query sent before, often at the end of the previous read, so it is timestamped with its send time
+        if not self.query_in_flight:
+            self.send_command(self.COMPOUND_QUERY)
+            self.query_sent_at = self.clock()
+        response = self.receive_line()
+        sample_time = self.query_sent_at
+        #Keep the instrument busy while this reply is parsed, logged and integrated
+        self.send_command(self.COMPOUND_QUERY)
+        self.query_sent_at = self.clock()
+        self.query_in_flight = True
+        return (*self._parse_compound_response(response), sample_time)
+
+    def resynchronize(self) -> bool:
+        """Drops the replies still in flight after a timeout, so the next reply belongs to the next query."""
+        self.query_in_flight = False
+        self.out_of_sync = False
+        if not self.resync_in_flight:
+            #The "1" of a resync that timed out still comes first, a second one would be left unread
+            self.send_command(self.RESYNC_COMMAND)
+            self.resync_in_flight = True
+        #A late transition reply may take as long as the transition itself
+        self.socket.settimeout(self.transition_timeout)
+        try:
+            for _ in range(self.MAX_STALE_REPLIES):
+                reply = self.receive_response()
+                if self.out_of_sync:
+                    break #Timed out again, retried on the next read
+                if reply == self.RESYNC_REPLY:
+                    self.resync_in_flight = False
+                    return True
+        finally:
+            self.socket.settimeout(self.reply_timeout)
+        self.out_of_sync = True
+        print(f"[ITECH]Could not resynchronize with {self.ip}:{self.port}")
+        return False
+
+    def drain_pipeline(self):
+        #Collect the reply of the query still in flight so the next response belongs to a new query
+        if self.query_in_flight:
+            self.query_in_flight = False
+            self.receive_line()
 
     def read_measurements(self) -> DataPointClass:
+        """
+        Reads a sample, invalid when the reply times out or cannot be parsed. A closed connection, or
+        max_consecutive_errors failed reads in a row, raise ConnectionError.
+        """
         try:
-            self.send_command("MEASURE:CURRENT?\n")
-            current = float(self.receive_response())
-            
-            self.send_command("MEASURE:VOLTAGE?\n")
-            voltage = float(self.receive_response())
-
-            ahour = 0.0 # Let the program calculate this
-            whour = 0.0 # Let the program calculate this
-            
-            power = voltage * current
-            timestamp = time.time() - self.start_time
-            return DataPointClass(voltage, current, power, ahour, whour, time.time() - self.start_time, True)
-        except (socket.error, ValueError) as e:
+            if self.transition_pending is not None:
+                self.complete_transition()
+            if self.out_of_sync and not self.resynchronize():
+                raise ValueError("Replies are out of sync with the queries")
+            if self.measurement_mode == "pipelined":
+                voltage, current, power, sample_time = self._read_pipelined()
+            elif self.measurement_mode == "compound":
+                voltage, current, power = self._read_compound()
+                sample_time = self.clock()
+            else:
+                voltage, current, power = self._read_separate()
+                sample_time = self.clock()
+
+        except ValueError as e:
+            #A pipelined query sent before the error is still in flight, its reply is read next.
+            #A reply that timed out sets out_of_sync instead
+            self.consecutive_errors += 1
             print(f"Error reading measurements: {e}")
-            return DataPointClass(None, None, None, None, None, self.start_time - time.time(), False)
+            if self.consecutive_errors >= self.max_consecutive_errors:
+                raise ConnectionError(f"{self.consecutive_errors} failed reads in a row from {self.ip}:{self.port}") from e
+            time.sleep(self.error_backoff * 2 ** (self.consecutive_errors - 1))
+            return DataPointClass(None, None, None, None, None, self.clock() - self.start_time, False)
+        self.consecutive_errors = 0
+
+        ahour = 0.0 # Let the program calculate this
+        whour = 0.0 # Let the program calculate this
+
+        return DataPointClass(voltage, current, power, ahour, whour, sample_time - self.start_time, True)
         
     def set_state(self, state: PowerStates, current : float, cutoff_voltage : float, cutoff_current : float):
+        """
+        Sends the transition and returns without waiting for it to be confirmed.
+
+        The line ends with *OPC? and SYSTEM:ERROR?. Their reply comes before the reply of the next measurement
+        query, so the next read_measurements collects it, records the transition latency and reports any error.
+        The instrument answers queries in order, so that read blocks until the transition is done, up to
+        transition_timeout, and no sample is taken during a transition.
+        With mode_change "wai", *WAI is relied on to hold the battery settings until FIXED mode has taken effect.
+        With "poll", FIXED mode is confirmed with FUNCTION:MODE? before the battery settings are sent, which
+        blocks here. A "wai" transition that reports errors switches the device to "poll".
+        The PASSIVE transition ends the sequence, so it is waited for here.
+        """
+        self.drain_pipeline()
+        if self.transition_pending is not None:
+            self.complete_transition()
+        if self.out_of_sync:
+            self.resynchronize()
+        self.transition_start = time.perf_counter()
+        if self.mode_change == "poll" and state in (PowerStates.CHARGE, PowerStates.DISCHARGE):
+            self.send_command("FUNCTION:MODE FIXED\n")
+            if not self.wait_for_mode("FIXED") and self.out_of_sync:
+                self.resynchronize()
+            self.send_command(scpi_line(self.battery_commands(state, current, cutoff_voltage, cutoff_current) + ["*OPC?", "SYSTEM:ERROR?"]))
+        else:
+            self.send_command(self.transition_commands(state, current, cutoff_voltage, cutoff_current))
+        self.transition_pending = state
+        self.state = state
+        if state == PowerStates.PASSIVE:
+            self.complete_transition()
+
+    def wait_for_mode(self, function_mode: str) -> bool:
+        """Polls FUNCTION:MODE? until the instrument reports function_mode, False if it did not within transition_timeout."""
+        deadline = time.perf_counter() + self.transition_timeout
+        self.socket.settimeout(self.transition_timeout)
         try:
-            if state == PowerStates.CHARGE:
-                self.send_command("FUNCTION:MODE FIXED\n")
-                time.sleep(2)
-                self.send_command("BATTERY:MODE CHARGE\n")
-                self._send_charge_rates(charge_current = current, charge_cutoff_voltage = cutoff_voltage, charge_cutoff_current = cutoff_current)
-                self.send_command("FUNCTION:MODE BATTERY\n")
-            elif state == PowerStates.DISCHARGE:
-                self.send_command("FUNCTION:MODE FIXED\n")
-                time.sleep(2)
-                self.send_command("BATTERY:MODE DISCHARGE\n")
-                self._send_discharge_rates(discharge_current = current, discharge_cutoff_voltage = cutoff_voltage, discharge_cutoff_current = cutoff_current)
-                self.send_command("FUNCTION:MODE BATTERY\n")
-            else:
-                self.send_command("FUNCTION:MODE FIXED\n")
-                self.send_command("OUTPUT 0\n")
-            self.state = state
-        except socket.error as e:
-            print(f"Error setting mode: {e}")
+            while True:
+                self.send_command(self.MODE_QUERY)
+                reply = self.receive_response()
+                if self.out_of_sync:
+                    break
+                if reply.upper().startswith(function_mode[:3]): #The instrument may answer with the short form
+                    return True
+                if time.perf_counter() + self.MODE_POLL_INTERVAL > deadline:
+                    break
+                time.sleep(self.MODE_POLL_INTERVAL)
+        finally:
+            self.socket.settimeout(self.reply_timeout)
+        print(f"[ITECH]{self.ip}:{self.port} did not report {function_mode} mode within {self.transition_timeout}s")
+        return False
+
+    def complete_transition(self) -> Optional[float]:
+        """
+        Reads the reply confirming the last transition and returns its latency in seconds, None if none is pending.
+        When the reply times out, the replies still in flight are dropped by resynchronize before the next query.
+        """
+        state = self.transition_pending
+        if state is None:
+            return None
+        self.transition_pending = None
+        self.socket.settimeout(self.transition_timeout)
+        try:
+            reply = self.receive_response()
+            latency = time.perf_counter() - self.transition_start
+            errors, error = self.transition_errors(reply)
+            #The error queue is read until it is empty, the first entry came with the *OPC? reply
+            while self.is_error(error) and len(errors) < self.MAX_ERROR_QUEUE:
+                errors.append(error)
+                self.send_command("SYSTEM:ERROR?\n")
+                error = self.receive_response()
+        finally:
+            self.socket.settimeout(self.reply_timeout)
+        if errors:
+            print(f"[ITECH]Transition to {state.value} reported: {errors}")
+            if self.mode_change == "wai" and state != PowerStates.PASSIVE:
+                print("[ITECH]Confirming FIXED mode with FUNCTION:MODE? from now on")
+                self.mode_change = "poll"
+        self.last_transition = (state, latency, errors)
+        if self.transition_listener:
+            self.transition_listener(state, latency, errors)
+        return latency
 
     def set_output(self, output: bool):
         try:
@@ -250,35 +528,47 @@ class ITech6018Device(DataSource, StateManager):
         except socket.error as e:
             print(f"Error setting output: {e}")
 
-    def _send_charge_rates(self, charge_current : float, charge_cutoff_voltage : float, charge_cutoff_current : float):
-        try:
-            self.send_command(f"BATTERY:CHARGE:CURRENT {charge_current}\n")
-            self.send_command(f"BATTERY:CHARGE:VOLTAGE {charge_cutoff_voltage + 0.020}\n") #For charge, charge voltage must be the same as the cutoff voltage
-            self.send_command(f"BATTERY:SHUT:CURRENT 0\n")
-            self.send_command(f"BATTERY:SHUT:VOLTAGE {charge_cutoff_voltage + 1.000}\n") #For charge, shutdown voltage must be above the charge voltage
-        except socket.error as e:
-            print(f"Error setting charge rates: {e}")
-
-    def _send_discharge_rates(self, discharge_current : float, discharge_cutoff_voltage : float, discharge_cutoff_current : float):
-        try:
-            self.send_command(f"BATTERY:DISCHARGE:CURRENT {discharge_current}\n")
-            self.send_command(f"BATTERY:DISCHARGE:VOLTAGE {discharge_cutoff_voltage - 0.150}\n") #For discharge, discharge voltage must be below the shutdown voltage
-            self.send_command(f"BATTERY:SHUT:CURRENT 0\n")
-            self.send_command(f"BATTERY:SHUT:VOLTAGE {discharge_cutoff_voltage - 0.150}\n") #For discharge, shutdown voltage is the same as the cutoff voltage
-        except socket.error as e:
-            print(f"Error setting discharge rates: {e}")
-
 class ChargeController:
 
-    def __init__(self, data_source: DataSource, state_manager: StateManager, logger: logging.Logger, folder_name: str):
+    LOG_FORMATS = ["text", "binary"]
+    #"transition" is the time from set_state to the instrument confirming it with *OPC?
+    SEQUENCE_STAGES = ["read", "add_entry", "plot_queue", "log_write", "cutoff", "loop", "transition"]
+
+    def __init__(self, data_source: DataSource, state_manager: StateManager, logger: logging.Logger, folder_name: str, log_format: str = "text", max_sample_gap: Optional[float] = 30.0,
+                 cutoff_detector: Optional[CutoffDetector] = None, log_sink: Optional[LogSink] = None,
+                 instrumentation: Optional[Union[Instrumentation, NullInstrumentation]] = None, rig_status: Optional[RigStatus] = None,
+                 checkpoint_interval: float = 10.0, incremental_capacity: Optional[IncrementalCapacity] = None,
+                 resistance_estimator: Optional[ResistanceEstimator] = None):
+        assert log_format in self.LOG_FORMATS, f"Invalid log format: {log_format}"
+        self.log_format = log_format
         self.data_source = data_source
         self.state_manager = state_manager
         self.logger = logger
         self.folder_name = folder_name
         self.sequence = []
         self.current_step = 0
-        self.power_analyzer = PowerAnalyzer()
+        self.power_analyzer = PowerAnalyzer(max_gap = max_sample_gap)
+        #Debounce cutoffs: every sample of the last second must qualify, with at least three samples
+        self.cutoff_detector = cutoff_detector if cutoff_detector else CutoffDetector(window_seconds = 1.0, min_samples = 3)
         self.on_finish_callback = None
+        self.log_sink = log_sink if log_sink else LogSink()
+        #Stage timings of the sampling loop, dumped to the run folder. Pass NullInstrumentation() to turn them off
+        self.instrumentation = instrumentation if instrumentation else Instrumentation(self.SEQUENCE_STAGES)
+        self.rig_status = rig_status
+        self.checkpoint_interval = checkpoint_interval
+        self.resumed_analyzer: Optional[dict] = None #Totals of the interrupted step, applied when it starts again
+        self.plot_queue: Optional[Queue] = data_queue #Samples for the live plot, None for runs without it
+        if hasattr(state_manager, "transition_listener"):
+            state_manager.transition_listener = self._on_transition_complete
+        #dQ/dV of every step, written to the run folder when the analyzer is reset at the end of the step
+        self.incremental_capacity = incremental_capacity
+        if incremental_capacity:
+            incremental_capacity.step_name = lambda: f"{self.current_step}_{self.sequence[self.current_step][0].value}"
+            self.power_analyzer.add_listener(incremental_capacity)
+        #DC-IR of every current step, one row per step in <run folder>/resistance.csv
+        self.resistance_estimator = resistance_estimator
+        if resistance_estimator:
+            resistance_estimator.label = lambda: f"{self.current_step}_{self.sequence[self.current_step][0].value}"
 
     def register_finish_callback(self, callback):
         self.on_finish_callback = callback
@@ -286,62 +576,187 @@ class ChargeController:
     def add_state(self, state: PowerStates, current: float, cutoff_voltage: float, cutoff_current: float):
         self.sequence.append((state, current, cutoff_voltage, cutoff_current))
 
-    def execute_sequence(self):
-        
+    def _on_transition_complete(self, state: PowerStates, latency: float, errors: list):
+        self.instrumentation.record("transition", latency)
+        self.logger.info(f"{state.value} confirmed {latency * 1000:.1f}ms after it was sent")
+        if errors and self.rig_status:
+            self.rig_status.count_error("transition")
+
+    def snapshot(self) -> dict:
+        return {
+            "folder_name": self.folder_name,
+            "sequence": [[state.value, current, cutoff_voltage, cutoff_current] for state, current, cutoff_voltage, cutoff_current in self.sequence],
+            "current_step": self.current_step,
+            "time_origin": getattr(self.data_source, "start_time", None),
+            "power_analyzer": self.power_analyzer.snapshot(),
+        }
+
+    def restore(self, snapshot: dict):
+        sequence = [[state.value, current, cutoff_voltage, cutoff_current] for state, current, cutoff_voltage, cutoff_current in self.sequence]
+        if snapshot["sequence"] != sequence:
+            raise ValueError(f"The sequence of {self.folder_name} does not match the one of its checkpoint")
+        self.current_step = snapshot["current_step"]
+        self.resumed_analyzer = snapshot["power_analyzer"]
+        if snapshot["time_origin"] is not None and hasattr(self.data_source, "start_time"):
+            #Timestamps continue from the start of the interrupted run, the downtime is a gap that is not integrated
+            self.data_source.start_time = snapshot["time_origin"]
+
+    def _cutoff_rule(self, state: PowerStates, cutoff_voltage: float, cutoff_current: Optional[float]) -> Optional[CutoffRule]:
+        if state == PowerStates.CHARGE:
+            return CutoffRule(min_voltage = cutoff_voltage, max_abs_current = abs(cutoff_current))
+        if state == PowerStates.DISCHARGE:
+            return CutoffRule(max_voltage = cutoff_voltage)
+        return None
+
+    def _open_run(self, resume: bool) -> bool:
+        """Creates the run folder, or reopens it from its checkpoint. Returns False if there is nothing left to run."""
         log_directory = f'./logs/{self.folder_name}'
-        if os.path.exists(log_directory):
+        checkpoint_path = f'{log_directory}/{CHECKPOINT_FILE}'
+        if resume:
+            #Continue the interrupted step from the checkpoint, appending to the existing logs
+            self.restore(load_checkpoint(checkpoint_path))
+            if self.current_step >= len(self.sequence):
+                self.logger.info(f"Sequence of {self.folder_name} was already complete")
+                return False
+            self.logger.info(f"Resuming step {self.current_step} at {self.resumed_analyzer['energy_sum'][0]:.4f}Wh")
+        elif os.path.exists(log_directory):
             raise FileExistsError(f"Directory {self.folder_name} already exists")
-        os.makedirs(log_directory)
-
-        all_sequences_log_file = f'{log_directory}/all_sequences.log'
-       
-        while self.current_step < len(self.sequence):
-
-            state, current, cutoff_voltage, cutoff_current = self.sequence[self.current_step]
-
-            current_sequence_log_file = f'{log_directory}/{self.current_step}_{state.value}.log'
-
-            self.state_manager.set_state(state, current, cutoff_voltage, cutoff_current)
-            self.logger.info(f"Executing {state.value} with cutoff voltage {cutoff_voltage}V and current {current}A")
-            self.power_analyzer.reset() #Reset for each step
-            
-            while True:
-                data_point = self.data_source.read_measurements()
-                self.power_analyzer.add_entry(data_point.current, data_point.voltage, data_point.timestamp)
-                energy, capacity = self.power_analyzer.calculate_energy_capacity()
-                data_point.whour = energy
-                data_point.ahour = capacity
-                elapsed_time = data_point.timestamp - self.power_analyzer.start_time
-                data_queue.put((data_point.voltage, data_point.current, elapsed_time))
-
-                #log data_point as CSV
-                serialize_to_csv(data_point, DataPointClass, current_sequence_log_file)
-                serialize_to_csv(data_point, DataPointClass, all_sequences_log_file)
-                if state == PowerStates.CHARGE and data_point.voltage >= cutoff_voltage and abs(data_point.current) <= abs(cutoff_current):
-                    break
-                if state == PowerStates.DISCHARGE and data_point.voltage <= cutoff_voltage:
-                    break
-
-            self.current_step += 1
-        self.state_manager.set_state(PowerStates.PASSIVE, None, None, None)
+        else:
+            os.makedirs(log_directory)
+        self.log_directory = log_directory
+        self.checkpointer = Checkpointer(checkpoint_path, self.snapshot, interval = self.checkpoint_interval)
+        if self.incremental_capacity and self.incremental_capacity.directory is None:
+            self.incremental_capacity.directory = log_directory
+
+        self.all_sequences_log_file = f'{log_directory}/all_sequences.log'
+        self.log_sink.add_csv_destination(self.all_sequences_log_file, DATA_POINT_FIELDS)
+        self.resistance_log_file = (f'{log_directory}/resistance.csv',)
+        self.log_sink.add_csv_destination(self.resistance_log_file[0], RESISTANCE_FIELDS)
+        self.run_store = RunStoreWriter(f'{log_directory}/store') if self.log_format == "binary" else None
+        self.instrumentation.start_dumping(f'{log_directory}/timings.json', interval = 60.0)
+        return True
+
+    def _begin_step(self) -> tuple:
+        """Resets the step after its state was sent to the instrument, returns the files of its samples."""
+        state, current, cutoff_voltage, cutoff_current = self.sequence[self.current_step]
+        current_sequence_log_file = f'{self.log_directory}/{self.current_step}_{state.value}.log'
+        self.log_sink.add_csv_destination(current_sequence_log_file, DATA_POINT_FIELDS)
+        self.logger.info(f"Executing {state.value} with cutoff voltage {cutoff_voltage}V and current {current}A")
+        self.power_analyzer.reset() #Reset for each step
+        if self.resumed_analyzer:
+            self.power_analyzer.restore(self.resumed_analyzer)
+            self.resumed_analyzer = None
+        self.cutoff_detector.set_rule(self._cutoff_rule(state, cutoff_voltage, cutoff_current))
+        return (current_sequence_log_file, self.all_sequences_log_file)
+
+    def _process_data_point(self, data_point: DataPointClass, state: PowerStates, log_files: tuple, stage_start: float) -> bool:
+        """Integrates, plots, logs and checks the cutoff of a sample. Returns True when the step is over."""
+        instrumentation = self.instrumentation
+        if self.rig_status:
+            self.rig_status.tick()
+        if not data_point.is_valid:
+            if self.rig_status:
+                self.rig_status.count_error("invalid_reading")
+            return False
+        self.power_analyzer.add_entry(data_point.voltage, data_point.current, data_point.timestamp)
+        energy, capacity = self.power_analyzer.calculate_energy_capacity()
+        data_point.whour = energy
+        data_point.ahour = capacity
+        if self.rig_status:
+            self.rig_status.update(data_point.voltage, data_point.current, energy, capacity, "sequence", state.value, data_point.timestamp)
+        stage_start = instrumentation.lap("add_entry", stage_start)
+        if self.plot_queue is not None:
+            elapsed_time = data_point.timestamp - self.power_analyzer.start_time
+            self.plot_queue.put((data_point.voltage, data_point.current, elapsed_time))
+        stage_start = instrumentation.lap("plot_queue", stage_start)
+
+        if self.run_store:
+            self.run_store.append(data_point.timestamp, data_point.voltage, data_point.current, data_point.power,
+                                  data_point.whour, data_point.ahour, encode_state(state.value))
+        else:
+            #log data_point as CSV, serialized once by the sink for both files
+            self.log_sink.write(log_files, data_point_row(data_point))
+        stage_start = instrumentation.lap("log_write", stage_start)
+        if self.resistance_estimator:
+            estimate = self.resistance_estimator.update(data_point.voltage, data_point.current, data_point.timestamp)
+            if estimate:
+                self.logger.info(f"DC-IR {estimate.resistance * 1000:.2f}mOhm entering {estimate.label} "
+                                 f"({estimate.delta_voltage * 1000:.1f}mV / {estimate.delta_current:.3f}A)")
+                self.log_sink.write(self.resistance_log_file, resistance_row(estimate))
+        cutoff_event = self.cutoff_detector.update(data_point.voltage, data_point.current, data_point.timestamp)
+        instrumentation.lap("cutoff", stage_start)
+        if cutoff_event:
+            self.logger.info(f"{state.value} cutoff reached {cutoff_event.latency:.3f}s after the first qualifying sample")
+            return True
+        self.checkpointer.maybe_save()
+        return False
+
+    def _end_step(self):
+        self.current_step += 1
+        self.power_analyzer.reset()
+        self.checkpointer.save() #A restart from here begins the next step
+
+    def _close_run(self):
+        if self.run_store:
+            self.run_store.close()
+            self.run_store = None
+        self.log_sink.flush()
+        self.instrumentation.close()
+
+    def _on_sequence_complete(self):
         self.logger.info("Sequence complete")
         if self.on_finish_callback:
             self.on_finish_callback()
 
+    def execute_sequence(self, resume: bool = False):
+        if not self._open_run(resume):
+            return
+        instrumentation = self.instrumentation
+        try:
+            while self.current_step < len(self.sequence):
+                state, current, cutoff_voltage, cutoff_current = self.sequence[self.current_step]
+                self.state_manager.set_state(state, current, cutoff_voltage, cutoff_current)
+                log_files = self._begin_step()
+                while True:
+                    stage_start = loop_start = instrumentation.clock()
+                    data_point = self.data_source.read_measurements()
+                    stage_start = instrumentation.lap("read", stage_start)
+                    step_over = self._process_data_point(data_point, state, log_files, stage_start)
+                    instrumentation.lap("loop", loop_start)
+                    if step_over:
+                        break
+                self._end_step()
+        finally:
+            self._close_run() #Also on errors, so the run store header holds every row written
+        self.state_manager.set_state(PowerStates.PASSIVE, None, None, None)
+        self._on_sequence_complete()
+
 
 #Use SENSE:ACQUIRE:POINTS <NUMBER> to set the number of points to acquire
 #Use SENSE:ACQUIRE:TINTERVAL <TIME> to set the time interval between points
 #Minimum is 10 points
-def benchmark_response_time(ip: str, port: int):
-    device = ITech6018Device(ip, port)
-    time_list = []
-    for i in range(10):
-        time_begin = time.time()
-        data_point = device.read_measurements()
-        time_end = time.time()
-        time_list.append(time_end - time_begin)
-    
-    print(f"Average response time: {sum(time_list) / len(time_list):.4f} seconds")
+def benchmark_response_time(ip: str, port: int, samples: int = 100):
+    #"separate" is the original two round trip read, the other modes are the single query reads
+    results = {}
+    for measurement_mode in ITech6018Device.MEASUREMENT_MODES:
+        device = ITech6018Device(ip, port, measurement_mode = measurement_mode)
+        time_list = []
+        for i in range(samples):
+            time_begin = time.perf_counter()
+            data_point = device.read_measurements()
+            time_end = time.perf_counter()
+            time_list.append(time_end - time_begin)
+        device.drain_pipeline()
+        del device
+
+        average = sum(time_list) / len(time_list)
+        results[measurement_mode] = average
+        print(f"{measurement_mode:>10}: average response time {average:.4f} seconds ({1 / average:.1f} samples/s)")
+
+    baseline = results["separate"]
+    for measurement_mode, average in results.items():
+        print(f"{measurement_mode:>10}: {baseline / average:.2f}x the separate query rate")
+    return results
 
 def set_system_time(ip : str, port : int) -> None:
     device = ITech6018Device(ip, port)
@@ -355,17 +770,17 @@ def set_system_time(ip : str, port : int) -> None:
 ip_address = '169.254.150.40'
 port = 30000
 folder_name = '13S6P' ##Todas as 1P e 2P já foram testadas##
+log_format = 'text' #'text' for CSV step files or 'binary' for the columnar run store
+instrumentation_enabled = True #Stage timings in <run folder>/timings.json, False to skip timing entirely
+dcir_min_step = 0.5 #Current step (A) measured as a DC-IR in <run folder>/resistance.csv, None to not measure it
+dqdv_bin_width = 0.005 #Voltage bin of the dQ/dV curves written to the run folder after every step, None to skip them
+metrics_port = None #Port of the HTTP status server (/metrics and /status), None to not start it
 
 def on_finish_callback():
-    import requests
-    import chime
-    requests.post("https://ntfy.sh/alertas-bateria", data = "[ITECH]Ciclo de carga completado")
-    chime.theme("pokemon")
-    chime.success()
-    time.sleep(6)
+    default_dispatcher().notify("[ITECH]Ciclo de carga completado", level = "success")
 
-def data_loop(charge_controller: ChargeController):
-    charge_controller.execute_sequence()
+def data_loop(charge_controller: ChargeController, resume: bool = False):
+    charge_controller.execute_sequence(resume)
 
 def add_lifepo4_sequence(charge_controller: ChargeController):
     charge_controller.add_state(PowerStates.CHARGE, current = 4.000, cutoff_voltage = 3.65, cutoff_current = 0.040)
@@ -399,6 +814,12 @@ def add_naion_sequence(charge_controller : ChargeController):
     
 
 def main():
+    parser = argparse.ArgumentParser(description = "Run the charge / discharge sequence on the ITech power supply")
+    parser.add_argument("--resume", action = "store_true", help = f"Continue the interrupted run in logs/{folder_name} from its checkpoint")
+    parser.add_argument("--mode_change", choices = ITech6018Device.MODE_CHANGES, default = "wai",
+                        help = "Wait for FIXED mode with *WAI, or confirm it with FUNCTION:MODE? before the battery settings")
+    args = parser.parse_args()
+
     logger = logging.getLogger('ChargeController')
     logger.setLevel(logging.DEBUG)
     console_handler = logging.StreamHandler()   
@@ -407,20 +828,31 @@ def main():
     console_handler.setFormatter(console_formatter)
     logger.addHandler(console_handler)
 
-    device = ITech6018Device(ip_address, port)
-    controller = ChargeController(data_source= device, state_manager= device, logger= logger, folder_name= folder_name)
+    device = ITech6018Device(ip_address, port, mode_change = args.mode_change)
+    instrumentation = Instrumentation(ChargeController.SEQUENCE_STAGES) if instrumentation_enabled else NullInstrumentation()
+    metrics_server = None
+    rig_status = None
+    if metrics_port is not None:
+        metrics_registry = MetricsRegistry()
+        rig_status = metrics_registry.register(folder_name)
+        metrics_server = start_metrics_server(metrics_registry, port = metrics_port)
+        if metrics_server:
+            logger.info(f"Status at http://{metrics_server.address[0]}:{metrics_server.address[1]}/metrics and /status")
+    controller = ChargeController(data_source= device, state_manager= device, logger= logger, folder_name= folder_name, log_format= log_format,
+                                  instrumentation= instrumentation, rig_status= rig_status,
+                                  incremental_capacity= IncrementalCapacity(bin_width = dqdv_bin_width) if dqdv_bin_width else None,
+                                  resistance_estimator= ResistanceEstimator(min_step_current = dcir_min_step) if dcir_min_step else None)
     add_lifepo4_sequence(controller)
     controller.register_finish_callback(on_finish_callback)
 
-    data_thread = threading.Thread(target = data_loop, args = (controller,))
+    data_thread = threading.Thread(target = data_loop, args = (controller, args.resume))
     data_thread.daemon = True
     data_thread.start()
 
-    window_title = f"{folder_name}" if folder_name else "Live Plot"
-    figure.suptitle(window_title)
-    figure.canvas.manager.set_window_title("ITECH")
-    start_plot()
+    start_plot(f"{folder_name}" if folder_name else "Live Plot")
     data_thread.join()
+    if metrics_server:
+        metrics_server.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
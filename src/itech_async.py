@@ -0,0 +1,293 @@
+#Builtins
+import time
+import json
+import asyncio
+import logging
+import argparse
+from typing import Callable, Optional
+
+#Locals
+from itech import (ITechCommands, ChargeController, DataPointClass, PowerStates, scpi_line, add_lifepo4_sequence,
+                   add_liion_sequence, add_lifepo4_pack_sequence, add_naion_sequence)
+from log_sink import LogSink
+from metrics import MetricsRegistry, start_metrics_server
+from notifications import default_dispatcher
+
+'''
+Drives many ITech 6018 units from one process and one thread, with asyncio.
+
+AsyncITech6018Device speaks the same SCPI as ITech6018Device (compound measurement query, transitions sent as
+a single line confirmed by *OPC?) over a non-blocking asyncio stream. While one unit waits for its reply the
+others are polled, so a round of a dozen units takes about as long as the slowest reply instead of the sum of
+all replies. A transition is awaited in set_state: the unit changing state waits for *OPC?, the others keep
+sampling.
+
+AsyncChargeController is itech.ChargeController with an async execute_sequence: the same per-step logs,
+checkpoints, cutoffs, dQ/dV and DC-IR, without the live plot. run_units() runs the sequences of every unit
+concurrently; a unit that fails is put back to passive and does not stop the others.
+
+Config file format (JSON), for python itech_async.py --config units.json:
+{
+    "log_format": "text",
+    "metrics_port": 9100,
+    "resume": false,
+    "checkpoint_interval": 10.0,
+    "units": [
+        {"name": "itech1", "ip": "169.254.150.40", "port": 30000, "folder": "13S6P", "sequence": "lifepo4"}
+    ]
+}
+A unit may set "mode_change": "poll", see ITech6018Device.set_state.
+'''
+
+SEQUENCES = {
+    "lifepo4": add_lifepo4_sequence,
+    "liion": add_liion_sequence,
+    "lifepo4_pack": add_lifepo4_pack_sequence,
+    "naion": add_naion_sequence,
+}
+
+class AsyncITech6018Device(ITechCommands):
+    def __init__(self, ip: str, port: int, clock: Callable[[], float] = time.time, reply_timeout: float = 3.0,
+                 transition_timeout: float = 10.0, max_consecutive_errors: int = 10, error_backoff: float = 0.100,
+                 mode_change: str = "wai"):
+        assert mode_change in self.MODE_CHANGES, f"Invalid mode change: {mode_change}"
+        self.ip = ip
+        self.port = port
+        self.clock = clock
+        self.reply_timeout = reply_timeout
+        self.transition_timeout = transition_timeout
+        self.mode_change = mode_change #See ITech6018Device.set_state
+        #A failed read waits error_backoff, doubled on every failure in a row, so a dead unit does not starve the others.
+        #After max_consecutive_errors failed reads the unit fails
+        self.max_consecutive_errors = max_consecutive_errors
+        self.error_backoff = error_backoff
+        self.consecutive_errors = 0
+        self.out_of_sync = False #A reply timed out and may still arrive
+        self.resync_in_flight = False
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.state = PowerStates.PASSIVE
+        self.last_transition: Optional[tuple] = None #(state, latency in seconds, errors)
+        self.transition_listener: Optional[Callable[[PowerStates, float, list], None]] = None
+        self.start_time = self.clock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), self.reply_timeout)
+        await self.send_command("".join(self.INITIAL_COMMANDS))
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.send_command('SYSTEM:LOCAL\n')
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (OSError, ConnectionError) as e:
+            print(f"[ITECH]Error closing {self.ip}:{self.port}: {e}")
+        self.writer = None
+
+    async def send_command(self, command: str):
+        if self.writer is None:
+            raise ConnectionError(f"{self.ip}:{self.port} is not connected")
+        self.writer.write(command.encode('utf-8'))
+        await self.writer.drain()
+
+    async def receive_line(self, timeout: Optional[float] = None) -> bytes:
+        line = await asyncio.wait_for(self.reader.readline(), timeout if timeout is not None else self.reply_timeout)
+        if not line:
+            raise ConnectionError("Connection closed by device")
+        return line.rstrip(b"\r\n")
+
+    async def receive_response(self, timeout: Optional[float] = None) -> str:
+        return (await self.receive_line(timeout)).decode('utf-8').strip()
+
+    async def resynchronize(self):
+        """Drops the replies still in flight after a timeout, so the next reply belongs to the next query."""
+        if not self.resync_in_flight:
+            #The "1" of a resync that timed out still comes first, a second one would be left unread
+            await self.send_command(self.RESYNC_COMMAND)
+            self.resync_in_flight = True
+        for _ in range(self.MAX_STALE_REPLIES):
+            #A late transition reply may take as long as the transition itself
+            if await self.receive_response(self.transition_timeout) == self.RESYNC_REPLY:
+                self.resync_in_flight = False
+                self.out_of_sync = False
+                return
+        raise ValueError(f"No reply to {self.RESYNC_COMMAND.strip()} after {self.MAX_STALE_REPLIES} stale replies")
+
+    async def wait_for_mode(self, function_mode: str):
+        """Polls FUNCTION:MODE? until the instrument reports function_mode, raises asyncio.TimeoutError after transition_timeout."""
+        deadline = time.perf_counter() + self.transition_timeout
+        while True:
+            await self.send_command(self.MODE_QUERY)
+            reply = await self.receive_response(self.transition_timeout)
+            if reply.upper().startswith(function_mode[:3]): #The instrument may answer with the short form
+                return
+            if time.perf_counter() + self.MODE_POLL_INTERVAL > deadline:
+                raise asyncio.TimeoutError(f"{self.ip}:{self.port} did not report {function_mode} mode")
+            await asyncio.sleep(self.MODE_POLL_INTERVAL)
+
+    async def read_measurements(self) -> DataPointClass:
+        """
+        Reads a sample, invalid when the reply times out or cannot be parsed. A closed connection, or
+        max_consecutive_errors failed reads in a row, raise ConnectionError.
+        """
+        try:
+            if self.out_of_sync:
+                await self.resynchronize()
+            await self.send_command(self.COMPOUND_QUERY)
+            voltage, current, power = self._parse_compound_response(await self.receive_line())
+        except (asyncio.TimeoutError, ValueError) as e:
+            self.consecutive_errors += 1
+            self.out_of_sync = self.out_of_sync or isinstance(e, asyncio.TimeoutError)
+            print(f"[ITECH]Error reading measurements from {self.ip}:{self.port}: {e!r}")
+            if self.consecutive_errors >= self.max_consecutive_errors:
+                raise ConnectionError(f"{self.consecutive_errors} failed reads in a row from {self.ip}:{self.port}") from e
+            await asyncio.sleep(self.error_backoff * 2 ** (self.consecutive_errors - 1))
+            return DataPointClass(None, None, None, None, None, self.clock() - self.start_time, False)
+        self.consecutive_errors = 0
+        return DataPointClass(voltage, current, power, 0.0, 0.0, self.clock() - self.start_time, True)
+
+    async def set_state(self, state: PowerStates, current: float, cutoff_voltage: float, cutoff_current: float) -> float:
+        """
+        Sends the transition and waits for the instrument to confirm it, returns its latency in seconds.
+        FIXED mode is confirmed with FUNCTION:MODE? first when mode_change is "poll", as in ITech6018Device.set_state.
+        """
+        transition_start = time.perf_counter()
+        if self.mode_change == "poll" and state in (PowerStates.CHARGE, PowerStates.DISCHARGE):
+            await self.send_command("FUNCTION:MODE FIXED\n")
+            await self.wait_for_mode("FIXED")
+            await self.send_command(scpi_line(self.battery_commands(state, current, cutoff_voltage, cutoff_current) + ["*OPC?", "SYSTEM:ERROR?"]))
+        else:
+            await self.send_command(self.transition_commands(state, current, cutoff_voltage, cutoff_current))
+        self.state = state
+        reply = await self.receive_response(self.transition_timeout)
+        latency = time.perf_counter() - transition_start
+        errors, error = self.transition_errors(reply)
+        #The error queue is read until it is empty, the first entry came with the *OPC? reply
+        while self.is_error(error) and len(errors) < self.MAX_ERROR_QUEUE:
+            errors.append(error)
+            await self.send_command("SYSTEM:ERROR?\n")
+            error = await self.receive_response()
+        if errors:
+            print(f"[ITECH]Transition of {self.ip}:{self.port} to {state.value} reported: {errors}")
+            if self.mode_change == "wai" and state != PowerStates.PASSIVE:
+                print(f"[ITECH]Confirming FIXED mode of {self.ip}:{self.port} with FUNCTION:MODE? from now on")
+                self.mode_change = "poll"
+        self.last_transition = (state, latency, errors)
+        if self.transition_listener:
+            self.transition_listener(state, latency, errors)
+        return latency
+
+class AsyncChargeController(ChargeController):
+    """ChargeController whose sequence runs as a coroutine, for AsyncITech6018Device units."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.plot_queue = None
+
+    async def execute_sequence(self, resume: bool = False):
+        if not self._open_run(resume):
+            return
+        instrumentation = self.instrumentation
+        try:
+            while self.current_step < len(self.sequence):
+                state, current, cutoff_voltage, cutoff_current = self.sequence[self.current_step]
+                await self.state_manager.set_state(state, current, cutoff_voltage, cutoff_current)
+                log_files = self._begin_step()
+                while True:
+                    stage_start = loop_start = instrumentation.clock()
+                    data_point = await self.data_source.read_measurements()
+                    stage_start = instrumentation.lap("read", stage_start)
+                    step_over = self._process_data_point(data_point, state, log_files, stage_start)
+                    instrumentation.lap("loop", loop_start)
+                    if step_over:
+                        break
+                self._end_step()
+        finally:
+            self._close_run()
+        await self.state_manager.set_state(PowerStates.PASSIVE, None, None, None)
+        self._on_sequence_complete()
+
+async def run_unit(controller: AsyncChargeController, resume: bool = False, connect: bool = False):
+    if connect:
+        await controller.data_source.connect()
+    await controller.execute_sequence(resume)
+
+async def run_units(controllers: list[AsyncChargeController], resume: bool = False, connect: bool = False) -> list:
+    """
+    Runs every sequence concurrently, returns None or the exception of each unit. With connect, each unit
+    connects in its own task, so a unit that cannot be reached fails alone.
+    """
+    results = await asyncio.gather(*(run_unit(controller, resume, connect) for controller in controllers), return_exceptions = True)
+    for controller, result in zip(controllers, results):
+        if isinstance(result, BaseException):
+            controller.logger.error(f"{controller.folder_name} stopped: {result!r}")
+            default_dispatcher().notify(f"[ITECH]{controller.folder_name} parou: {result}", level = "error", key = f"{controller.folder_name}:stopped")
+            try:
+                await controller.state_manager.set_state(PowerStates.PASSIVE, None, None, None)
+            except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                controller.logger.error(f"{controller.folder_name} could not be set to passive: {e!r}")
+    return [result if isinstance(result, BaseException) else None for result in results]
+
+def load_config(path: str) -> dict:
+    with open(path, 'r') as file:
+        config = json.load(file)
+    assert config.get("units"), "No units configured"
+    folders = [unit["folder"] for unit in config["units"]]
+    assert len(set(folders)) == len(folders), "Each unit needs its own folder"
+    for unit in config["units"]:
+        assert unit.get("sequence", "lifepo4") in SEQUENCES, f"Unknown sequence {unit.get('sequence')}, expected one of {list(SEQUENCES)}"
+    return config
+
+async def run_config(config: dict, logger: logging.Logger, sink: LogSink, metrics_registry: Optional[MetricsRegistry] = None) -> list:
+    devices, controllers = [], []
+    for unit in config["units"]:
+        device = AsyncITech6018Device(unit["ip"], int(unit.get("port", 30000)), mode_change = unit.get("mode_change", "wai"))
+        rig_status = metrics_registry.register(unit["name"]) if metrics_registry else None
+        controller = AsyncChargeController(data_source = device, state_manager = device, logger = logger.getChild(unit["name"]),
+                                           folder_name = unit["folder"], log_format = config.get("log_format", "text"), log_sink = sink,
+                                           rig_status = rig_status, checkpoint_interval = float(config.get("checkpoint_interval", 10.0)))
+        SEQUENCES[unit.get("sequence", "lifepo4")](controller)
+        devices.append(device)
+        controllers.append(controller)
+
+    try:
+        return await run_units(controllers, bool(config.get("resume", False)), connect = True)
+    finally:
+        await asyncio.gather(*(device.close() for device in devices))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the charge / discharge sequences of several ITech power supplies from one process")
+    parser.add_argument("--config", required = True, help = "Path to the JSON unit configuration")
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    logger = logging.getLogger('ChargeController')
+    logger.setLevel(logging.DEBUG)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    console_handler.setFormatter(logging.Formatter('%(levelname)s - %(name)s - %(message)s'))
+    logger.addHandler(console_handler)
+
+    sink = LogSink()
+    metrics_registry, metrics_server = None, None
+    if config.get("metrics_port") is not None:
+        metrics_registry = MetricsRegistry()
+        metrics_server = start_metrics_server(metrics_registry, port = int(config["metrics_port"]))
+        if metrics_server:
+            logger.info(f"Status at http://{metrics_server.address[0]}:{metrics_server.address[1]}/metrics and /status")
+    try:
+        results = asyncio.run(run_config(config, logger, sink, metrics_registry))
+    finally:
+        sink.close()
+        if metrics_server:
+            metrics_server.close()
+    #Every failed unit was already alerted by run_units
+    failed = [unit["name"] for unit, result in zip(config["units"], results) if result is not None]
+    if failed:
+        logger.error(f"Units stopped before completing their sequence: {failed}")
+    else:
+        default_dispatcher().notify("[ITECH]Ciclos de carga completados", level = "success")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#Builtins
+import os
+import gzip
+import lzma
+import struct
+import bisect
+from typing import Callable, Iterator, Optional, Union
+
+#Locals
+from log_segments import segment_paths, SIDECAR_SUFFIXES
+
+'''
+Sidecar time index of the run logs, to read a time window without scanning the log from its start.
+
+Next to a log, <log>.idx holds (timestamp, byte offset) pairs, packed as little endian float64 + int64, each
+pointing to the start of a line. The writers add a pair every index_rows rows or index_seconds seconds of
+data, whichever comes first, so the index stays a few KB per GB of log. A rotated segment keeps its index
+under the name of the uncompressed segment (all_sequences.log.000001.idx).
+
+read_window() bisects the index of every segment for the start of the window, seeks there and streams lines
+until the end of the window. Segments that end before the window are not opened. Timestamps are in the units
+of the log itself: epoch seconds for DataLogger logs, seconds since the start of the run for ITech logs.
+'''
+
+INDEX_SUFFIX = SIDECAR_SUFFIXES[0]
+INDEX_ENTRY = struct.Struct("<dq")
+
+def index_path(path : str) -> str:
+    """Index of a log or of one of its segments, compressed or not."""
+    for extension in (".gz", ".xz"):
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    return path + INDEX_SUFFIX
+
+def csv_line_timestamp(line : str, column : int = 5) -> Optional[float]:
+    #serialize_to_csv and LogSink CSV: voltage;current;power;ahour;whour;timestamp;is_valid
+    try:
+        return float(line.split(';')[column])
+    except (IndexError, ValueError):
+        return None #Header or a line without a timestamp
+
+def data_logger_line_timestamp(line : str) -> Optional[float]:
+    #DataLogger: 3.30V 1.000A 0.1234Wh<TAB>1710411302.5<TAB>10:15:02
+    fields = line.split('\t')
+    if len(fields) < 3:
+        return None
+    try:
+        return float(fields[1])
+    except ValueError:
+        return None
+
+def line_timestamp(line : str) -> Optional[float]:
+    """Timestamp of a line of any of the indexed log formats, None for headers and messages."""
+    if '\t' in line:
+        return data_logger_line_timestamp(line)
+    if ';' in line:
+        return csv_line_timestamp(line)
+    return None
+
+def csv_row_timestamp(column : int) -> Callable[[tuple], Optional[float]]:
+    """Timestamp of a row given to LogSink as a tuple, at the given column."""
+    def timestamp_of(row : Union[str, tuple]) -> Optional[float]:
+        if isinstance(row, str):
+            return csv_line_timestamp(row, column)
+        value = row[column]
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+    return timestamp_of
+
+class IndexWriter:
+    """Decides when a log gets a new index entry and appends it to the sidecar file."""
+    def __init__(self, path : str, timestamp_of : Callable, every_rows : int = 1024, every_seconds : float = 60.0):
+        self.path = index_path(path)
+        self.timestamp_of = timestamp_of
+        self.every_rows = every_rows
+        self.every_seconds = every_seconds
+        self.file = None
+        self.restart()
+
+    def restart(self):
+        """The log was rotated, the next rows start a new file and a new index."""
+        self.close()
+        self.rows_since_entry = 0
+        self.last_timestamp : Optional[float] = None
+
+    def add_rows(self, rows : list, offset : int):
+        """Rows about to be written at offset. The entry, if any, points to the first of them with a timestamp."""
+        if self.last_timestamp is not None and self.rows_since_entry < self.every_rows:
+            #Only the first timestamp of the batch is needed to check the time interval
+            timestamp = self._first_timestamp(rows[:1])
+            if timestamp is None or timestamp - self.last_timestamp < self.every_seconds:
+                self.rows_since_entry += len(rows)
+                return
+        timestamp = self._first_timestamp(rows)
+        if timestamp is None:
+            self.rows_since_entry += len(rows)
+            return
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(INDEX_ENTRY.pack(timestamp, offset))
+        self.last_timestamp = timestamp
+        self.rows_since_entry = len(rows)
+
+    def _first_timestamp(self, rows : list) -> Optional[float]:
+        #Rows before it without a timestamp (messages) are skipped by read_window anyway
+        for row in rows:
+            timestamp = self.timestamp_of(row)
+            if timestamp is not None:
+                return timestamp
+        return None
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def load_index(path : str) -> tuple[list[float], list[int]]:
+    """Returns the (timestamps, offsets) of the index of a log or segment, empty if it has none."""
+    try:
+        with open(index_path(path), 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return [], []
+    data = data[:len(data) - len(data) % INDEX_ENTRY.size] #A torn last entry from a crash is ignored
+    entries = list(INDEX_ENTRY.iter_unpack(data))
+    return [timestamp for timestamp, _ in entries], [offset for _, offset in entries]
+
+def append_index_entry(path : str, timestamp : float, offset : int):
+    with open(index_path(path), 'ab') as file:
+        file.write(INDEX_ENTRY.pack(timestamp, offset))
+
+def last_index_entry(path : str) -> Optional[tuple[float, int]]:
+    try:
+        with open(index_path(path), 'rb') as file:
+            size = file.seek(0, os.SEEK_END)
+            size -= size % INDEX_ENTRY.size
+            if size == 0:
+                return None
+            file.seek(size - INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(file.read(INDEX_ENTRY.size))
+    except FileNotFoundError:
+        return None
+
+def find_offset(path : str, timestamp : float) -> int:
+    """Offset of the last indexed line at or before timestamp, 0 when the window starts before the index."""
+    timestamps, offsets = load_index(path)
+    position = bisect.bisect_right(timestamps, timestamp) - 1
+    return offsets[position] if position >= 0 else 0
+
+def _open_binary(path : str):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if path.endswith(".xz"):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+def read_window(path : str, start : float, end : float, timestamp_of : Callable[[str], Optional[float]] = line_timestamp,
+                encoding : str = 'utf-8') -> Iterator[str]:
+    """Streams the lines of a log, across its segments, whose timestamps are within [start, end]."""
+    assert end >= start, "The window ends before it starts"
+    segments = segment_paths(path)
+    first_timestamps = []
+    for segment in segments:
+        timestamps, _ = load_index(segment)
+        first_timestamps.append(timestamps[0] if timestamps else None)
+
+    for position, segment in enumerate(segments):
+        if first_timestamps[position] is not None and first_timestamps[position] > end:
+            return
+        following = first_timestamps[position + 1] if position + 1 < len(segments) else None
+        if following is not None and following < start:
+            continue #The whole segment is before the window
+        try:
+            file = _open_binary(segment)
+        except FileNotFoundError:
+            continue #Compressed or rotated after it was listed
+        with file:
+            #Compressed segments are decompressed up to the offset, without splitting it into lines
+            file.seek(find_offset(segment, start))
+            in_window = False
+            for raw_line in file:
+                line = raw_line.decode(encoding, errors = 'replace').replace('\r\n', '\n') #As read_lines gives them
+                timestamp = timestamp_of(line)
+                if timestamp is None:
+                    if in_window:
+                        yield line
+                    continue
+                if timestamp > end:
+                    return
+                in_window = timestamp >= start
+                if in_window:
+                    yield line
@@ -0,0 +1,191 @@
+#Builtins
+import os
+import re
+import gzip
+import lzma
+import time
+import queue
+import atexit
+import shutil
+import threading
+from typing import Iterator, Optional
+
+'''
+Rotation and compression of run logs, and reading them back as a single file.
+
+A log file is written at its usual path. When it is rotated, it is renamed to the next numbered segment and a
+new file is started at the path, with the CSV header again for CSV logs:
+
+    all_sequences.log.000001.gz    first rotated segment, compressed
+    all_sequences.log.000002       rotated, still waiting for its compression
+    all_sequences.log              segment being written
+
+Segments are compressed by a background thread, written to a temporary file and renamed, so a segment is
+always complete under one of its two names. read_lines() streams every segment of a log in order, compressed
+or not, and drops the header repeated at the top of every segment after the first.
+'''
+
+SEGMENT_DIGITS = 6
+COMPRESSIONS = {"gzip": ".gz", "lzma": ".xz", None: ""}
+SIDECAR_SUFFIXES = (".idx",) #Files kept next to a log that are renamed with it, such as its time index (see log_index)
+_SEGMENT_SUFFIX = re.compile(r"\.(\d{%d})(\.gz|\.xz)?$" % SEGMENT_DIGITS)
+
+class RotationPolicy:
+    """Rotate a log once it holds max_bytes or was started max_seconds ago, None for no limit."""
+    def __init__(self, max_bytes : Optional[int] = None, max_seconds : Optional[float] = None, compression : Optional[str] = "gzip"):
+        assert compression in COMPRESSIONS, f"Invalid compression: {compression}"
+        assert max_bytes is None or max_bytes > 0, "max_bytes must be positive"
+        assert max_seconds is None or max_seconds > 0, "max_seconds must be positive"
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression = compression
+
+    def should_rotate(self, size : int, opened_at : Optional[float] = None) -> bool:
+        if size == 0:
+            return False
+        if self.max_bytes is not None and size >= self.max_bytes:
+            return True
+        return self.max_seconds is not None and opened_at is not None and time.time() - opened_at >= self.max_seconds
+
+DEFAULT_ROTATION = RotationPolicy(max_bytes = 256 * 1024 * 1024, compression = "gzip")
+
+def compress_segment(path : str, compression : str) -> str:
+    """Compresses a rotated segment next to itself and removes it, returns the compressed path."""
+    compressed_path = path + COMPRESSIONS[compression]
+    temporary_path = compressed_path + ".tmp"
+    with open(path, 'rb') as source, _compressed_writer(temporary_path, compression) as destination:
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+    os.replace(temporary_path, compressed_path)
+    os.remove(path)
+    return compressed_path
+
+def _compressed_writer(path : str, compression : str):
+    if compression == "gzip":
+        return gzip.open(path, 'wb', compresslevel = 6)
+    return lzma.open(path, 'wb')
+
+class SegmentCompressor(threading.Thread):
+    """Compresses rotated segments off the writing threads, one at a time."""
+    def __init__(self):
+        threading.Thread.__init__(self, name = "segment-compressor")
+        self.daemon = True
+        self.segments : queue.Queue = queue.Queue()
+        self.compressed = 0
+        self.failed = 0
+        self.start()
+        atexit.register(self.close)
+
+    def submit(self, path : str, compression : str):
+        self.segments.put((path, compression))
+
+    def run(self):
+        while True:
+            segment = self.segments.get()
+            try:
+                if segment is None:
+                    return
+                try:
+                    compress_segment(*segment)
+                    self.compressed += 1
+                except OSError as e:
+                    #The segment stays uncompressed, readers handle it the same
+                    self.failed += 1
+                    print(f"[LOG SEGMENTS]Error compressing {segment[0]}: {e}")
+            finally:
+                self.segments.task_done()
+
+    def flush(self):
+        """Waits until every submitted segment was compressed."""
+        if self.is_alive():
+            self.segments.join()
+
+    def close(self):
+        if self.is_alive():
+            self.segments.put(None)
+            if threading.current_thread() is not self:
+                self.join()
+
+_default_compressor : Optional[SegmentCompressor] = None
+_default_lock = threading.Lock()
+
+def default_compressor() -> SegmentCompressor:
+    """Compressor shared by every log of the process."""
+    global _default_compressor
+    with _default_lock:
+        if _default_compressor is None or not _default_compressor.is_alive():
+            _default_compressor = SegmentCompressor()
+        return _default_compressor
+
+def log_base_path(path : str) -> str:
+    """The path of the log a segment belongs to, the path itself for a live log."""
+    return _SEGMENT_SUFFIX.sub("", path)
+
+def _rotated_segments(path : str) -> list[tuple[int, str]]:
+    directory, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + _SEGMENT_SUFFIX.pattern)
+    segments = {}
+    try:
+        names = os.listdir(directory or '.')
+    except FileNotFoundError:
+        return []
+    for file_name in names:
+        match = pattern.match(file_name)
+        if match:
+            index = int(match.group(1))
+            #While a segment is compressed both names exist, the uncompressed one is read
+            if index not in segments or not match.group(2):
+                segments[index] = os.path.join(directory, file_name)
+    return sorted(segments.items())
+
+def segment_paths(path : str) -> list[str]:
+    """Every segment of a log in write order: the rotated ones, then the live file if there is one."""
+    paths = [segment for _, segment in _rotated_segments(path)]
+    if os.path.isfile(path):
+        paths.append(path)
+    return paths
+
+def rotate_file(path : str, compression : Optional[str] = "gzip", compressor : Optional[SegmentCompressor] = None) -> Optional[str]:
+    """Renames a closed log to its next segment and queues the segment for compression. Returns the segment path."""
+    if not os.path.isfile(path):
+        return None
+    segments = _rotated_segments(path)
+    index = segments[-1][0] + 1 if segments else 1
+    segment_path = f"{path}.{index:0{SEGMENT_DIGITS}d}"
+    os.replace(path, segment_path)
+    for suffix in SIDECAR_SUFFIXES:
+        if os.path.isfile(path + suffix):
+            os.replace(path + suffix, segment_path + suffix)
+    if compression:
+        (compressor or default_compressor()).submit(segment_path, compression)
+    return segment_path
+
+def read_lines(path : str, skip_repeated_header : bool = True, errors : str = 'strict') -> Iterator[str]:
+    """Streams the lines of every segment of a log as if it was never rotated."""
+    header = None
+    for position, segment_path in enumerate(segment_paths(path)):
+        file = _open_segment(segment_path, errors)
+        if file is None:
+            continue #Rotated away after it was listed
+        with file:
+            first_line = file.readline()
+            if position == 0:
+                header = first_line
+            if first_line and (position == 0 or not (skip_repeated_header and first_line == header and _is_header(header))):
+                yield first_line
+            yield from file
+
+def _open_segment(path : str, errors : str):
+    for candidate in [path] + ([path + extension for extension in (".gz", ".xz")] if not path.endswith((".gz", ".xz")) else []):
+        try:
+            if candidate.endswith(".gz"):
+                return gzip.open(candidate, 'rt', errors = errors)
+            if candidate.endswith(".xz"):
+                return lzma.open(candidate, 'rt', errors = errors)
+            return open(candidate, 'r', errors = errors)
+        except FileNotFoundError:
+            continue #Compressed since it was listed
+    return None
+
+def _is_header(line : str) -> bool:
+    #Headers are the only lines with letters and no digits, data lines always hold a number
+    return bool(line) and not any(character.isdigit() for character in line)
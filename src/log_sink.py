@@ -0,0 +1,190 @@
+#Builtins
+import io
+import csv
+import time
+import atexit
+import threading
+from collections import deque
+from typing import Callable, Optional, Union
+
+#Locals
+from log_segments import RotationPolicy, SegmentCompressor, DEFAULT_ROTATION, rotate_file, default_compressor
+from log_index import IndexWriter, csv_row_timestamp
+
+class LogSink(threading.Thread):
+    """
+    Group-commit writer shared by every log file of a run.
+
+    The acquisition loop only appends (destinations, row) to an in-memory queue. A background thread drains
+    the queue when flush_rows rows are pending or flush_interval seconds have passed, serializes each row
+    once and writes it to all of its destinations through file handles that stay open. At most
+    flush_interval seconds of rows can be lost if the process dies.
+
+    A row is either a str, written as is, or a tuple, written as a CSV line with the sink's delimiter.
+
+    Files are rotated after a flush that leaves them over the rotation policy, then compressed in the
+    background (see log_segments), rotation = None keeps every file whole.
+
+    Files given an index, and CSV files with a timestamp column, get a sidecar time index with an entry every
+    index_rows rows or index_seconds seconds (see log_index).
+    """
+    def __init__(self, flush_rows : int = 256, flush_interval : float = 1.0, delimiter : str = ';',
+                 rotation : Optional[RotationPolicy] = DEFAULT_ROTATION, compressor : Optional[SegmentCompressor] = None,
+                 index_rows : int = 1024, index_seconds : float = 60.0):
+        threading.Thread.__init__(self, name = "log-sink")
+        self.daemon = True
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.delimiter = delimiter
+        self.pending : deque = deque()
+        self.files : dict = {}
+        self.opened_at : dict[str, float] = {}
+        self.rotation = rotation
+        self.compressor = compressor #The shared one when None
+        self.rotations = 0
+        self.indexes : dict[str, IndexWriter] = {}
+        self.index_rows = index_rows
+        self.index_seconds = index_seconds
+        self.headers : dict[str, tuple] = {}
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        self.write_errors = 0
+        self.flush_listeners : list[Callable[[list, float], None]] = []
+        self.start()
+        atexit.register(self.close)
+
+    def add_csv_destination(self, path : str, fieldnames : Union[list, tuple]):
+        #The header is written when the file is first opened, unless the file already has content
+        self.headers[path] = tuple(fieldnames)
+        if "timestamp" in self.headers[path]:
+            self.add_index(path, csv_row_timestamp(self.headers[path].index("timestamp")))
+
+    def add_index(self, path : str, timestamp_of : Callable[[Union[str, tuple]], Optional[float]]):
+        #timestamp_of gives the timestamp of a row, or None for rows without one
+        with self.write_lock:
+            if path not in self.indexes:
+                self.indexes[path] = IndexWriter(path, timestamp_of, self.index_rows, self.index_seconds)
+
+    def add_flush_listener(self, callback : Callable[[list, float], None]):
+        #Called with the flushed (destinations, row) pairs and the time.time() after the files were flushed, not fsynced
+        self.flush_listeners.append(callback)
+
+    def write(self, destinations : tuple, row : Union[str, tuple]):
+        self.pending.append((destinations, row))
+        if not self.running:
+            self.flush() #Late writes after close go straight to disk
+        elif len(self.pending) >= self.flush_rows:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def _open(self, path : str):
+        file = open(path, 'a', newline = '')
+        if path in self.headers and file.tell() == 0:
+            file.write(self._serialize(self.headers[path]))
+        self.files[path] = file
+        self.opened_at[path] = time.time()
+        return file
+
+    def _serialize(self, row : Union[str, tuple]) -> str:
+        if isinstance(row, str):
+            return row
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter = self.delimiter).writerow(row)
+        return buffer.getvalue()
+
+    def _serialize_batch(self, rows : list) -> str:
+        if all(isinstance(row, str) for row in rows):
+            return "".join(rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter = self.delimiter)
+        for row in rows:
+            if isinstance(row, str):
+                buffer.write(row)
+            else:
+                writer.writerow(row)
+        return buffer.getvalue()
+
+    def flush(self):
+        with self.write_lock:
+            batch = []
+            while self.pending:
+                batch.append(self.pending.popleft())
+            if not batch:
+                return
+
+            #Serialize consecutive rows that go to the same destinations together, once for all destinations
+            touched = set()
+            start = 0
+            while start < len(batch):
+                destinations = batch[start][0]
+                end = start
+                while end < len(batch) and batch[end][0] == destinations:
+                    end += 1
+                rows = [row for _, row in batch[start:end]]
+                if any(path in self.indexes for path in destinations):
+                    #Serialized in chunks of index_rows, so a large batch still gets an index entry every index_rows rows
+                    chunks = [(rows[first:first + self.index_rows], self._serialize_batch(rows[first:first + self.index_rows]))
+                              for first in range(0, len(rows), self.index_rows)]
+                    data = "".join(chunk for _, chunk in chunks)
+                else:
+                    chunks = None
+                    data = self._serialize_batch(rows)
+                for path in destinations:
+                    try:
+                        file = self.files.get(path) or self._open(path)
+                        index = self.indexes.get(path)
+                        if index:
+                            offset = file.tell()
+                            for chunk_rows, chunk in chunks:
+                                index.add_rows(chunk_rows, offset)
+                                offset += len(chunk.encode(file.encoding))
+                        file.write(data)
+                        touched.add(path)
+                    except OSError as e:
+                        self.write_errors += 1
+                        print(f"[LOG SINK]Error writing to {path}: {e}")
+                start = end
+
+            for path in touched:
+                self.files[path].flush()
+                if path in self.indexes:
+                    self.indexes[path].flush()
+                if self.rotation and self.rotation.should_rotate(self.files[path].tell(), self.opened_at[path]):
+                    self._rotate(path)
+            if self.flush_listeners:
+                flush_time = time.time()
+                for callback in self.flush_listeners:
+                    callback(batch, flush_time)
+
+    def _rotate(self, path : str):
+        #The next write to the path starts a new file, with the CSV header again
+        self.files.pop(path).close()
+        if path in self.indexes:
+            self.indexes[path].restart()
+        try:
+            rotate_file(path, self.rotation.compression, self.compressor or default_compressor())
+            self.rotations += 1
+        except OSError as e:
+            self.write_errors += 1
+            print(f"[LOG SINK]Error rotating {path}: {e}")
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout = 5.0)
+        self.flush()
+        with self.write_lock:
+            for file in self.files.values():
+                file.close()
+            self.files = {}
+            for index in self.indexes.values():
+                index.close()
@@ -0,0 +1,208 @@
+#Builtins
+import json
+import time
+import asyncio
+import threading
+from typing import Optional
+
+'''
+Live status of every rig over HTTP, for quiet runs that do not print each sample.
+
+The acquisition loops update a RigStatus in place (a few attribute writes per sample). A MetricsServer runs an
+asyncio HTTP server on its own thread and renders the statuses only when they are requested:
+    GET /metrics        Prometheus text format
+    GET /status         JSON
+'''
+
+class RigStatus:
+    """Latest readings and counters of one rig, written by its acquisition loop."""
+    __slots__ = ("name", "voltage", "current", "power", "energy", "capacity", "mode", "cycle_state", "last_sample_time",
+                 "samples", "iterations", "loop_rate", "rate_start", "rate_iterations", "errors", "log_sink")
+
+    def __init__(self, name : str, log_sink = None):
+        self.name = name
+        self.voltage : Optional[float] = None
+        self.current : Optional[float] = None
+        self.power : Optional[float] = None
+        self.energy : Optional[float] = None
+        self.capacity : Optional[float] = None
+        self.mode = ""
+        self.cycle_state = ""
+        self.last_sample_time : Optional[float] = None
+        self.samples = 0
+        self.iterations = 0
+        self.loop_rate = 0.0
+        self.rate_start = time.monotonic()
+        self.rate_iterations = 0
+        self.errors : dict[str, int] = {}
+        self.log_sink = log_sink #Its write_errors are reported with the rig errors
+
+    def tick(self):
+        #One loop iteration, the rate is refreshed about once a second
+        self.iterations += 1
+        now = time.monotonic()
+        if now - self.rate_start >= 1.0:
+            self.loop_rate = (self.iterations - self.rate_iterations) / (now - self.rate_start)
+            self.rate_start = now
+            self.rate_iterations = self.iterations
+
+    def update(self, voltage : float, current : float, energy : float, capacity : float, mode : str, cycle_state : str, timestamp : float):
+        self.voltage = voltage
+        self.current = current
+        self.power = voltage * current
+        self.energy = energy
+        self.capacity = capacity
+        self.mode = mode
+        self.cycle_state = cycle_state
+        self.last_sample_time = timestamp
+        self.samples += 1
+
+    def count_error(self, kind : str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def error_counts(self) -> dict[str, int]:
+        errors = dict(self.errors)
+        if self.log_sink is not None and self.log_sink.write_errors:
+            errors["log_write"] = self.log_sink.write_errors
+        return errors
+
+    def to_dict(self) -> dict:
+        return {
+            "voltage": self.voltage,
+            "current": self.current,
+            "power": self.power,
+            "energy_wh": self.energy,
+            "capacity_ah": self.capacity,
+            "mode": self.mode,
+            "cycle_state": self.cycle_state,
+            "last_sample_time": self.last_sample_time,
+            "samples": self.samples,
+            "iterations": self.iterations,
+            "loop_rate": self.loop_rate,
+            "errors": self.error_counts(),
+        }
+
+#(attribute, metric name, type, help)
+PROMETHEUS_METRICS = [
+    ("voltage", "powercalc_voltage_volts", "gauge", "Last measured voltage"),
+    ("current", "powercalc_current_amperes", "gauge", "Last measured current, positive when charging"),
+    ("power", "powercalc_power_watts", "gauge", "Last measured power"),
+    ("energy", "powercalc_energy_watthours", "gauge", "Energy of the current state"),
+    ("capacity", "powercalc_capacity_amperehours", "gauge", "Capacity of the current state"),
+    ("last_sample_time", "powercalc_last_sample_timestamp_seconds", "gauge", "Time of the last sample"),
+    ("samples", "powercalc_samples_total", "counter", "Samples with both voltage and current"),
+    ("iterations", "powercalc_loop_iterations_total", "counter", "Acquisition loop iterations"),
+    ("loop_rate", "powercalc_loop_rate_hertz", "gauge", "Acquisition loop iterations per second"),
+]
+
+def _label(value : str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    def __init__(self):
+        self.rigs : dict[str, RigStatus] = {}
+
+    def register(self, name : str, log_sink = None) -> RigStatus:
+        assert name not in self.rigs, f"Rig {name} is already registered"
+        self.rigs[name] = RigStatus(name, log_sink)
+        return self.rigs[name]
+
+    def to_dict(self) -> dict:
+        return {"time": time.time(), "rigs": {name: status.to_dict() for name, status in self.rigs.items()}}
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for attribute, metric, metric_type, description in PROMETHEUS_METRICS:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for name, status in self.rigs.items():
+                value = getattr(status, attribute)
+                if value is not None:
+                    lines.append(f'{metric}{{rig="{_label(name)}"}} {value}')
+
+        lines.append("# HELP powercalc_state_info Mode and cycle state of the rig")
+        lines.append("# TYPE powercalc_state_info gauge")
+        for name, status in self.rigs.items():
+            lines.append(f'powercalc_state_info{{rig="{_label(name)}",mode="{_label(status.mode)}",cycle_state="{_label(status.cycle_state)}"}} 1')
+
+        lines.append("# HELP powercalc_errors_total Errors by kind")
+        lines.append("# TYPE powercalc_errors_total counter")
+        for name, status in self.rigs.items():
+            for kind, count in status.error_counts().items():
+                lines.append(f'powercalc_errors_total{{rig="{_label(name)}",kind="{_label(kind)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+class MetricsServer(threading.Thread):
+    """Serves a MetricsRegistry from an asyncio event loop running on this thread."""
+    def __init__(self, registry : MetricsRegistry, host : str = "127.0.0.1", port : int = 9100):
+        threading.Thread.__init__(self, name = "metrics-server")
+        self.daemon = True
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.address : Optional[tuple] = None
+        self.error : Optional[Exception] = None
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.start()
+        self.ready.wait(timeout = 5.0)
+        if self.error:
+            raise self.error
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.address = server.sockets[0].getsockname()[:2]
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    def render(self, path : str) -> tuple[str, str, str]:
+        """Returns (status, content type, body) for a GET of path."""
+        if path == "/metrics":
+            return "200 OK", "text/plain; version=0.0.4", self.registry.prometheus_text()
+        if path in ("/status", "/metrics.json"):
+            return "200 OK", "application/json", json.dumps(self.registry.to_dict())
+        return "404 Not Found", "text/plain", "Not found, use /metrics or /status\n"
+
+    async def _handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout = 5.0)
+            while True: #Headers are not used
+                header = await asyncio.wait_for(reader.readline(), timeout = 5.0)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode(errors = 'replace').split()
+            if len(parts) < 2 or parts[0] != "GET":
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "Only GET is supported\n"
+            else:
+                status, content_type, body = self.render(parts[1].split('?')[0])
+            data = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(timeout = 5.0)
+
+def start_metrics_server(registry : MetricsRegistry, port : int, host : str = "127.0.0.1") -> Optional[MetricsServer]:
+    """Starts a MetricsServer, or warns and returns None when the port cannot be bound, so the rig runs without it."""
+    try:
+        return MetricsServer(registry, host, port)
+    except OSError as e:
+        print(f"[METRICS]Status server not started on {host}:{port}: {e}")
+        return None
@@ -1,9 +1,11 @@
 #Builtins
+import os
 import time 
 import serial
 from collections import namedtuple
 import argparse
 import threading
+from typing import Callable, Optional
 
 #Third party
 from colorama import Fore, Style, init
@@ -16,15 +18,25 @@ from queue import Queue, Empty
 from controllers import *
 from analyzers import *
 from threads import *
+from acquisition import MultimeterAcquisition, StreamingAcquisition
+from plot_buffer import PlotBuffer
+from instrumentation import Instrumentation, NullInstrumentation
+from metrics import MetricsRegistry, RigStatus, start_metrics_server
+from notifications import default_dispatcher
+from checkpoint import Checkpointer, load_checkpoint, CHECKPOINT_FILE
+from incremental_capacity import IncrementalCapacity
+from resistance import ResistanceEstimator
+from clock import VirtualClock
 import sounds
 
 #Thread safe queue
 data_queue = Queue()
 
-#Setup the live plot
-voltage_values =  []
-current_values =  []
-timestamps     =  []
+#Stages of main_loop timed by the instrumentation
+MAIN_LOOP_STAGES = ["acquire", "parse", "plot_queue", "add_entry", "watch_values", "print_and_log", "loop"]
+
+#Setup the live plot, the buffer keeps a min/max envelope so redraws stay cheap on long runs
+plot_buffer = PlotBuffer(channels = 2, max_buckets = 1024)
 
 figure, axes = plot.subplots(2, 1, figsize = (10, 6))
 
@@ -48,25 +60,21 @@ line_current, = axes[1].plot([], [], label = "Current", color = "red")
 
 #Update function for the live plot
 def update_plot(frame):
-    global voltage_values, current_values, timestamps
-
     try:
         while True:
             voltage, current, timestamp = data_queue.get_nowait()
-            voltage_values.append(voltage)
-            current_values.append(current)
-            timestamps.append(timestamp)
+            plot_buffer.append(timestamp, (voltage, current))
     except Empty:
         pass
 
-    if len(timestamps) > 0:
+    if len(plot_buffer) > 0:
         #Update data for voltage
-        line_voltage.set_data(timestamps, voltage_values)
-        axes[0].set_xlim(timestamps[0], timestamps[-1])
+        line_voltage.set_data(*plot_buffer.get_series(0))
+        axes[0].set_xlim(plot_buffer.first_time, plot_buffer.last_time)
 
         #Update data for current
-        line_current.set_data(timestamps, current_values)
-        axes[1].set_xlim(timestamps[0], timestamps[-1])
+        line_current.set_data(*plot_buffer.get_series(1))
+        axes[1].set_xlim(plot_buffer.first_time, plot_buffer.last_time)
 
         axes[0].relim()
         axes[0].autoscale_view()
@@ -88,22 +96,36 @@ def handle_exception(exception : Exception, runner_name : str):
     file.write(message)
     file.close()
 
-    #send to ntfy.sh/alertas-bateria-erros
-    chime.theme('pokemon')
-    chime.error()
-    requests.post("https://ntfy.sh/alertas-bateria", data = f"Error:{message}")
-    time.sleep(4)
-
-
-def main_loop(args, multimeters, relay_controller : RelayController, power_analyzer : PowerAnalyzer, logger : DataLogger, charge_controller : ChargeController):
-    start_time = time.time()
+    #Repeated errors of the same type are merged into one alert while the previous one is waiting to be sent
+    default_dispatcher().notify(f"Error:{message}", level = "error", key = f"{runner_name}:{type(exception).__name__}")
+
+
+def main_loop(args, multimeters, relay_controller : RelayController, power_analyzer : PowerAnalyzer, logger : DataLogger, charge_controller : ChargeController,
+              stop_event : Optional[threading.Event] = None, instrumentation : Optional[Instrumentation] = None, rig_status : Optional[RigStatus] = None,
+              checkpointer : Optional[Checkpointer] = None, clock : Callable[[], float] = time.time):
+    #Samples are timestamped with clock, the loop is paced in real time
+    start_time = clock()
+    quiet = args.quiet #Per-sample lines are not built nor printed, the rig status is served over HTTP instead
+    instrumentation = instrumentation if instrumentation else NullInstrumentation()
+    measurement_interval = float(args.measurement_interval)
+    if args.stream:
+        #Meters in talk-only mode push readings on their own, the loop follows their conversion rate
+        acquisition = StreamingAcquisition(multimeters, clock = clock)
+    else:
+        acquisition = MultimeterAcquisition(multimeters, clock = clock)
     charge_controller.set_mode("cycle")
     try:
-        while True:
+        while stop_event is None or not stop_event.is_set():
+            tick_start = time.time()
+            stage_start = loop_start = instrumentation.clock()
             data_points: list[DataPoint] = [DataPoint(None, None, None)] * len(multimeters)
             terminal_output_message = ""
+            sample = acquisition.acquire()
+            stage_start = instrumentation.lap("acquire", stage_start)
+            if rig_status:
+                rig_status.tick()
             for i, multimeter in enumerate(multimeters):
-                raw_data_point = multimeter.read_measurements()
+                raw_data_point = sample.data_points[i]
                 if raw_data_point.value is None:
                     continue
                 
@@ -112,37 +134,61 @@ def main_loop(args, multimeters, relay_controller : RelayController, power_analy
                 else:
                     data_point = raw_data_point   
                 data_points[i] = data_point
-                terminal_output_message += f"{multimeter.serial.port}: {data_point.value:.4f} {data_point.unit}\t"
+                if not quiet:
+                    terminal_output_message += f"{multimeter.serial.port}: {data_point.value:.4f} {data_point.unit}\t"
 
             is_power_available, voltage, current = check_if_power_available(data_points)
-            timestamp = get_timestamp(data_points)
+            timestamp = sample.timestamp
+            stage_start = instrumentation.lap("parse", stage_start)
             if is_power_available:
                 relative_timestamp_seconds = timestamp - start_time
                 data_queue.put((voltage, current, relative_timestamp_seconds))
+                stage_start = instrumentation.lap("plot_queue", stage_start)
                 power_analyzer.add_entry(voltage, current, timestamp)
+                stage_start = instrumentation.lap("add_entry", stage_start)
                 charge_controller.watch_values(voltage, current, timestamp)
+                if checkpointer:
+                    checkpointer.maybe_save()
+                stage_start = instrumentation.lap("watch_values", stage_start)
                 
-                accumulated_energy = power_analyzer.calculate_energy()
-                power = voltage * current
-                terminal_output_message += f"Power: {power:.4f}W\t\tEnergy: {accumulated_energy:.4f}Wh"
+                accumulated_energy, accumulated_capacity = power_analyzer.calculate_energy_capacity()
+                if rig_status:
+                    rig_status.update(voltage, current, accumulated_energy, accumulated_capacity, charge_controller.mode, charge_controller.cycle_state, timestamp)
+                if not quiet:
+                    power = voltage * current
+                    terminal_output_message += f"Power: {power:.4f}W\t\tEnergy: {accumulated_energy:.4f}Wh\tSkew: {sample.skew * 1000:.1f}ms"
+            elif rig_status:
+                rig_status.count_error("missing_reading")
 
             if terminal_output_message:
                 folder_str = f"\t{args.folder}" if args.folder else ""
                 output_message_with_folder = terminal_output_message + folder_str
                 output_message_with_mode = f"{output_message_with_folder}\t{charge_controller.get_mode()}"
-                output_message_with_mode = f"{output_message_with_mode}\t{time.time() - start_time:.2f}s"
+                output_message_with_mode = f"{output_message_with_mode}\t{clock() - start_time:.2f}s"
                 stamped_output_message = append_timestamp(timestamp, output_message_with_mode)
                 print_and_log(logger, stamped_output_message)
+                instrumentation.lap("print_and_log", stage_start)
+            instrumentation.lap("loop", loop_start)
 
-            time.sleep(measurement_interval := 0.100)
+            #Sleep only for what is left of the tick so the acquisition time is not added on top of it
+            if not args.stream: #Streaming acquisition already waits for the meters
+                time.sleep(max(0.0, measurement_interval - (time.time() - tick_start)))
 
     except (KeyboardInterrupt, SystemExit): 
         print(Fore.RED + "Exiting..." + Style.RESET_ALL)
     except Exception as exception:
         print(Fore.RED + f"Error: {exception}" + Style.RESET_ALL)
+        if rig_status:
+            rig_status.count_error(type(exception).__name__)
         handle_exception(exception, args.runner_name)
     finally:
+        acquisition.close()
+        if checkpointer:
+            checkpointer.save() #Before leaving the cycle, so --resume continues it
         charge_controller.set_mode("monitor")
+        charge_controller.close()
+        logger.flush()
+        instrumentation.close()
 
 def main():
 
@@ -156,6 +202,19 @@ def main():
     parser.add_argument("--charge_cutoff_current", default = '0.600', help = "Specify the charge cutoff current")
     parser.add_argument("--discharge_cutoff_voltage", default = '2.50', help = "Specify the discharge cutoff voltage")
     parser.add_argument("--runner_name", default = 'multimeter.py', help = "Specify the name of the runner script")
+    parser.add_argument("--measurement_interval", default = '0.100', help = "Specify the time between paired samples in seconds")
+    parser.add_argument("--persistent_relay", action = "store_true", help = "Keep the relay port open and confirm every relay change. Only when no other process uses the relay board")
+    parser.add_argument("--quiet", action = "store_true", help = "Do not print every sample, serve the rig status over HTTP instead")
+    parser.add_argument("--metrics_port", type = int, default = None, help = "Port of the status server, 9100 + relay number by default. Started with --quiet or when given")
+    parser.add_argument("--no_instrumentation", action = "store_true", help = "Do not time the loop stages")
+    parser.add_argument("--stream", action = "store_true", help = "Read multimeters set to talk-only mode instead of polling them with RR,1")
+    parser.add_argument("--log_format", default = 'text', choices = ChargeController.LOG_FORMATS, help = "Log samples as text files or to the binary run store")
+    parser.add_argument("--dqdv_bin_width", type = float, default = 0.005, help = "Voltage bin of the dQ/dV curve written for every state, 0 to skip them")
+    parser.add_argument("--dcir_min_step", type = float, default = 0.5, help = "Current step (A) measured as a DC-IR in resistance.csv, 0 to not measure it")
+    parser.add_argument("--resume", action = "store_true", help = "Continue the interrupted run in --folder from its checkpoint")
+    parser.add_argument("--max_sample_gap", type = float, default = 30.0, help = "Real seconds between samples above which the interval is not integrated")
+    parser.add_argument("--time_scale", type = float, default = 1.0, help = "Virtual seconds per real second of the simulated instruments (python simulators.py --scale), 1 for real instruments")
+    parser.add_argument("--checkpoint_interval", type = float, default = 10.0, help = "Seconds between checkpoints of the run")
     args = parser.parse_args()
 
     multimeter_port_names : list[str] = args.multimeter_ports
@@ -174,6 +233,14 @@ def main():
     print(f"Charge Cutoff Current = {args.charge_cutoff_current}")
     print(f"Discharge Cutoff Voltage = {args.discharge_cutoff_voltage}")
     print(f"Runner Name = {args.runner_name}")
+    print(f"Measurement Interval = {args.measurement_interval}")
+    print(f"Log Format = {args.log_format}")
+    print(f"Persistent Relay = {args.persistent_relay}")
+    print(f"Stream = {args.stream}")
+    print(f"Instrumentation = {not args.no_instrumentation}")
+    print(f"Quiet = {args.quiet}")
+    print(f"Resume = {args.resume}")
+    print(f"Time Scale = {args.time_scale}")
     print("-"*len(program_args_intro))
     print('\n' * 2)
 
@@ -196,20 +263,57 @@ def main():
     
     multimeters = [YokogawaController(multimeter_port) for multimeter_port in multimeter_ports]
 
-    relay_controller = RelayController(relay_port, relay_number = int(args.relay_number))
-    power_analyzer = PowerAnalyzer()
-    logger = DataLogger(["terminal"], args.folder)
-    charge_controller = ChargeController(relay_controller, power_analyzer, logger)
+    relay_channel = RelayChannel(relay_port) if args.persistent_relay else None
+    relay_controller = RelayController(relay_port, relay_number = int(args.relay_number), channel = relay_channel)
+    #Accelerated simulated instruments are integrated in simulated time, like the battery they simulate.
+    #The time limits below are real seconds, scaled to the clock
+    clock = VirtualClock(args.time_scale).time if args.time_scale != 1.0 else time.time
+    #A longer interval, such as the downtime before a resume, is not integrated
+    power_analyzer = PowerAnalyzer(max_gap = args.max_sample_gap * args.time_scale)
+    if args.resume and not args.folder:
+        parser.error("--resume needs the --folder of the interrupted run")
+    logger = DataLogger(["terminal"], args.folder, resume = args.resume)
+    if args.no_instrumentation:
+        instrumentation = NullInstrumentation()
+    else:
+        #Stage timings are rewritten to the run folder every minute
+        instrumentation = Instrumentation(MAIN_LOOP_STAGES)
+        instrumentation.start_dumping(os.path.join(logger.root_path, "timings.json"), interval = 60.0)
+    incremental_capacity = IncrementalCapacity(bin_width = args.dqdv_bin_width) if args.dqdv_bin_width > 0 else None
+    resistance_estimator = ResistanceEstimator(min_step_current = args.dcir_min_step, window_seconds = 2.0 * args.time_scale) if args.dcir_min_step > 0 else None
+    cutoff_detector = CutoffDetector(window_seconds = 1.0 * args.time_scale, min_samples = 3)
+    charge_controller = ChargeController(relay_controller, power_analyzer, logger, log_format = args.log_format, incremental_capacity = incremental_capacity,
+                                         resistance_estimator = resistance_estimator, cutoff_detector = cutoff_detector)
 
     charge_controller.set_charge_threshold(float(args.charge_cutoff_voltage), float(args.charge_cutoff_current))
     charge_controller.set_discharge_threshold(float(args.discharge_cutoff_voltage))
     charge_controller.set_mode("monitor")
+
+    checkpoint_path = os.path.join(logger.root_path, CHECKPOINT_FILE)
+    if args.resume:
+        charge_controller.restore(load_checkpoint(checkpoint_path))
+        if charge_controller.cycle_completed:
+            print(f"[CHECKPOINT]The cycle of {args.folder} was already completed")
+            return
+        energy, capacity = power_analyzer.calculate_energy_capacity()
+        print(f"[CHECKPOINT]Resuming {charge_controller.cycle_state} at {energy:.4f}Wh {capacity:.4f}Ah")
+    checkpointer = Checkpointer(checkpoint_path, charge_controller.snapshot, interval = args.checkpoint_interval)
+
+    rig_status = None
+    metrics_server = None
+    if args.quiet or args.metrics_port is not None:
+        metrics_registry = MetricsRegistry()
+        rig_status = metrics_registry.register(args.folder or args.runner_name, logger.sink)
+        metrics_port = args.metrics_port if args.metrics_port is not None else 9100 + int(args.relay_number)
+        metrics_server = start_metrics_server(metrics_registry, port = metrics_port)
+        if metrics_server:
+            print(f"Rig status at http://{metrics_server.address[0]}:{metrics_server.address[1]}/metrics and /status")
     
     keyboard_listener_thread = KeyboardListenerThread(keyboard_input_callback, charge_controller)
     keyboard_listener_thread.daemon = True
     keyboard_listener_thread.start()
 
-    main_thread = threading.Thread(target=main_loop, args=(args, multimeters, relay_controller, power_analyzer, logger, charge_controller))
+    main_thread = threading.Thread(target=main_loop, args=(args, multimeters, relay_controller, power_analyzer, logger, charge_controller, None, instrumentation, rig_status, checkpointer, clock))
     main_thread.daemon = True
     main_thread.start()
 
@@ -218,6 +322,8 @@ def main():
     figure.canvas.manager.set_window_title(window_title)
     start_plot()
     main_thread.join()
+    if metrics_server:
+        metrics_server.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,225 @@
+#Builtins
+import time
+import heapq
+import atexit
+import itertools
+import threading
+from typing import Optional
+
+'''
+Alerts delivered off the acquisition threads.
+
+notify() only merges the alert into an in-memory queue and returns. A background dispatcher thread delivers
+each alert to every sink that accepts its level:
+    - a delivery that fails is retried with exponential backoff, up to max_attempts times
+    - a sink receives at most one alert every min_interval seconds, later alerts wait in the queue
+    - an alert with the same key as one still waiting for a sink is merged into it and counted, so an error
+      raised on every sample is sent once with its repeat count instead of flooding the sinks
+    - the queue holds at most max_pending deliveries, alerts that do not fit are dropped and counted
+
+Levels: "info" and "success" for progress, "error" for failures, "feedback" for local acknowledgements
+(keyboard commands) that only the sound sink plays.
+'''
+
+NTFY_URL = "https://ntfy.sh/alertas-bateria"
+LEVELS = ["info", "success", "error", "feedback"]
+
+class NtfySink:
+    """Posts alerts to an ntfy topic, or any URL accepting the message as the request body."""
+    levels = ("info", "success", "error")
+
+    def __init__(self, url : str = NTFY_URL, timeout : float = 10.0, min_interval : float = 5.0):
+        self.url = url
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.name = f"ntfy {url}"
+
+    def send(self, message : str, level : str):
+        import requests
+        headers = {"Tags": "warning"} if level == "error" else {}
+        response = requests.post(self.url, data = message.encode(), headers = headers, timeout = self.timeout)
+        response.raise_for_status()
+
+class SoundSink:
+    """Plays a chime for the alert level, waiting for the sound to end so alerts do not overlap."""
+    levels = ("success", "error", "feedback")
+    #level: (theme, sound)
+    SOUNDS = {"success": ("pokemon", "success"), "error": ("pokemon", "error"), "feedback": ("big-sur", "success")}
+
+    def __init__(self, min_interval : float = 0.0):
+        self.min_interval = min_interval
+        self.name = "sound"
+
+    def send(self, message : str, level : str):
+        import chime
+        theme, sound = self.SOUNDS[level]
+        previous_theme = chime.theme()
+        chime.theme(theme)
+        try:
+            getattr(chime, sound)(sync = True, raise_error = True)
+        finally:
+            chime.theme(previous_theme)
+
+class FileSink:
+    """Appends alerts to a text file."""
+    levels = ("info", "success", "error", "feedback")
+
+    def __init__(self, path : str, min_interval : float = 0.0):
+        self.path = path
+        self.min_interval = min_interval
+        self.name = f"file {path}"
+
+    def send(self, message : str, level : str):
+        timestamp = time.strftime("%m-%d %H:%M:%S")
+        with open(self.path, 'a') as file:
+            file.write(f"[{timestamp}]\t[{level.upper()}]\t{message.rstrip()}\n")
+
+class Delivery:
+    """One alert waiting to be sent to one sink."""
+    __slots__ = ("sink", "key", "message", "level", "count", "attempts")
+
+    def __init__(self, sink, key : str, message : str, level : str):
+        self.sink = sink
+        self.key = key
+        self.message = message
+        self.level = level
+        self.count = 1
+        self.attempts = 0
+
+    def text(self) -> str:
+        return self.message if self.count == 1 else f"{self.message} (x{self.count})"
+
+class NotificationDispatcher(threading.Thread):
+    def __init__(self, sinks : list, max_pending : int = 256, max_attempts : int = 5, backoff : float = 2.0, max_backoff : float = 300.0):
+        threading.Thread.__init__(self, name = "notifications")
+        self.daemon = True
+        self.sinks = list(sinks)
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = time.monotonic
+        self.condition = threading.Condition()
+        self.schedule : list = [] #Heap of (due time, sequence, delivery)
+        self.sequence = itertools.count()
+        self.waiting : dict[tuple, Delivery] = {} #(sink index, key): delivery not sent yet, for coalescing
+        self.next_send = [0.0] * len(self.sinks)
+        self.running = True
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.start()
+        atexit.register(self.close)
+
+    def notify(self, message : str, level : str = "info", key : Optional[str] = None):
+        """Queues message for every sink accepting level and returns immediately. Alerts are merged by key, the message by default."""
+        assert level in LEVELS, f"Invalid notification level: {level}"
+        key = key if key is not None else message
+        with self.condition:
+            for index, sink in enumerate(self.sinks):
+                if level not in sink.levels:
+                    continue
+                delivery = self.waiting.get((index, key))
+                if delivery:
+                    delivery.count += 1
+                    delivery.message = message #The latest text, counted with the earlier ones
+                    self.coalesced += 1
+                elif len(self.waiting) >= self.max_pending:
+                    self.dropped += 1
+                else:
+                    self.waiting[(index, key)] = Delivery(sink, key, message, level)
+                    self._schedule(self.clock(), self.waiting[(index, key)])
+            self.condition.notify()
+
+    def _schedule(self, due : float, delivery : Delivery):
+        heapq.heappush(self.schedule, (due, next(self.sequence), delivery))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.schedule or self.schedule[0][0] > self.clock()):
+                    self.condition.wait(self.schedule[0][0] - self.clock() if self.schedule else None)
+                if not self.running:
+                    return
+                _, _, delivery = heapq.heappop(self.schedule)
+                index = self.sinks.index(delivery.sink)
+                now = self.clock()
+                if now < self.next_send[index]:
+                    #Rate limited, the delivery keeps absorbing duplicates until the sink is free
+                    self._schedule(self.next_send[index], delivery)
+                    continue
+                self.next_send[index] = now + delivery.sink.min_interval
+                del self.waiting[(index, delivery.key)]
+            self._deliver(index, delivery)
+
+    def _deliver(self, index : int, delivery : Delivery):
+        delivery.attempts += 1
+        try:
+            delivery.sink.send(delivery.text(), delivery.level)
+            self.sent += 1
+            return
+        except Exception as e:
+            error = e
+
+        with self.condition:
+            if delivery.attempts >= self.max_attempts:
+                self.failed += 1
+                print(f"[NOTIFICATIONS]Giving up on {delivery.sink.name} after {delivery.attempts} attempts: {error}")
+                return
+            newer = self.waiting.get((index, delivery.key))
+            if newer:
+                #A duplicate arrived while sending, it carries this one's count
+                newer.count += delivery.count
+                return
+            self.waiting[(index, delivery.key)] = delivery
+            delay = min(self.backoff * 2 ** (delivery.attempts - 1), self.max_backoff)
+            self._schedule(self.clock() + delay, delivery)
+            self.condition.notify()
+
+    def pending(self) -> int:
+        with self.condition:
+            return len(self.waiting)
+
+    def flush(self, timeout : float = 10.0) -> bool:
+        """Delivers what is due now, ignoring rate limits and backoff, until timeout. True if nothing is left."""
+        deadline = self.clock() + timeout
+        while self.clock() < deadline:
+            with self.condition:
+                if not self.schedule:
+                    return True
+                _, _, delivery = heapq.heappop(self.schedule)
+                index = self.sinks.index(delivery.sink)
+                del self.waiting[(index, delivery.key)]
+            self._deliver(index, delivery)
+        return self.pending() == 0
+
+    def close(self, timeout : float = 10.0):
+        #Called at exit too, so an alert raised right before the program ends is still sent
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self is not threading.current_thread():
+            self.join(timeout = 1.0)
+        self.max_attempts = 1 #No retries once closing
+        self.flush(timeout)
+
+_default_dispatcher : Optional[NotificationDispatcher] = None
+_default_lock = threading.Lock()
+
+def default_dispatcher() -> NotificationDispatcher:
+    """Dispatcher shared by the acquisition programs, posting to ntfy and playing sounds."""
+    global _default_dispatcher
+    with _default_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = NotificationDispatcher([NtfySink(), SoundSink()])
+        return _default_dispatcher
+
+def set_default_dispatcher(dispatcher : Optional[NotificationDispatcher]) -> Optional[NotificationDispatcher]:
+    """Replaces the shared dispatcher, returning the previous one."""
+    global _default_dispatcher
+    with _default_lock:
+        previous, _default_dispatcher = _default_dispatcher, dispatcher
+        return previous
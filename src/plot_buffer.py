@@ -0,0 +1,142 @@
+#Builtins
+from array import array
+
+class PlotBuffer:
+    """
+    Fixed-size min/max envelope of an arbitrarily long run, for live plots.
+
+    Samples are folded into buckets that keep the first and last timestamp and, per channel, the minimum,
+    the maximum and which of the two came first. When max_buckets buckets are full, neighbouring pairs are
+    merged and every bucket from then on covers twice as many samples. Memory and redraw cost therefore stay
+    at about 2 * max_buckets points per channel however long the run is, while spikes are never dropped.
+    """
+    def __init__(self, channels : int = 2, max_buckets : int = 1024):
+        assert channels > 0, "At least one channel is required"
+        assert max_buckets >= 2 and max_buckets % 2 == 0, "max_buckets must be an even number of at least 2"
+        self.channels = channels
+        self.max_buckets = max_buckets
+        self.samples_per_bucket = 1
+
+        #Closed buckets
+        self.start_times = array('d')
+        self.end_times = array('d')
+        self.minimums = [array('d') for _ in range(channels)]
+        self.maximums = [array('d') for _ in range(channels)]
+        self.minimum_first = [array('b') for _ in range(channels)]
+
+        #Bucket being filled
+        self.open_count = 0
+        self.open_start_time = 0.0
+        self.open_end_time = 0.0
+        self.open_minimums = [0.0] * channels
+        self.open_maximums = [0.0] * channels
+        self.open_minimum_first = [True] * channels
+
+        #Whole run limits, for axis scaling
+        self.lowest = [float("inf")] * channels
+        self.highest = [float("-inf")] * channels
+        self.first_time = None
+        self.last_time = None
+
+    def append(self, timestamp : float, values : tuple):
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+
+        if self.open_count == 0:
+            self.open_start_time = timestamp
+            for channel, value in enumerate(values):
+                self.open_minimums[channel] = value
+                self.open_maximums[channel] = value
+                self.open_minimum_first[channel] = True
+        else:
+            for channel, value in enumerate(values):
+                if value < self.open_minimums[channel]:
+                    self.open_minimums[channel] = value
+                    self.open_minimum_first[channel] = False #The maximum was seen before this new minimum
+                elif value > self.open_maximums[channel]:
+                    self.open_maximums[channel] = value
+                    self.open_minimum_first[channel] = True
+        self.open_end_time = timestamp
+        self.open_count += 1
+
+        for channel, value in enumerate(values):
+            if value < self.lowest[channel]:
+                self.lowest[channel] = value
+            if value > self.highest[channel]:
+                self.highest[channel] = value
+
+        if self.open_count == self.samples_per_bucket:
+            self._close_bucket()
+
+    def _close_bucket(self):
+        self.start_times.append(self.open_start_time)
+        self.end_times.append(self.open_end_time)
+        for channel in range(self.channels):
+            self.minimums[channel].append(self.open_minimums[channel])
+            self.maximums[channel].append(self.open_maximums[channel])
+            self.minimum_first[channel].append(self.open_minimum_first[channel])
+        self.open_count = 0
+
+        if len(self.start_times) == self.max_buckets:
+            self._merge_buckets()
+
+    def _merge_buckets(self):
+        half = self.max_buckets // 2
+        for index in range(half):
+            first, second = 2 * index, 2 * index + 1
+            self.start_times[index] = self.start_times[first]
+            self.end_times[index] = self.end_times[second]
+            for channel in range(self.channels):
+                minimums, maximums, minimum_first = self.minimums[channel], self.maximums[channel], self.minimum_first[channel]
+                minimum_in_first = minimums[first] <= minimums[second]
+                maximum_in_first = maximums[first] >= maximums[second]
+                if minimum_in_first and maximum_in_first:
+                    order = minimum_first[first]
+                elif not minimum_in_first and not maximum_in_first:
+                    order = minimum_first[second]
+                else:
+                    order = minimum_in_first
+                minimums[index] = minimums[first] if minimum_in_first else minimums[second]
+                maximums[index] = maximums[first] if maximum_in_first else maximums[second]
+                minimum_first[index] = order
+
+        del self.start_times[half:]
+        del self.end_times[half:]
+        for channel in range(self.channels):
+            del self.minimums[channel][half:]
+            del self.maximums[channel][half:]
+            del self.minimum_first[channel][half:]
+        self.samples_per_bucket *= 2
+
+    def get_series(self, channel : int) -> tuple[list[float], list[float]]:
+        """Envelope of one channel as (timestamps, values), two points per bucket in time order."""
+        times = []
+        values = []
+        minimums, maximums, minimum_first = self.minimums[channel], self.maximums[channel], self.minimum_first[channel]
+        for index in range(len(self.start_times)):
+            times.append(self.start_times[index])
+            times.append(self.end_times[index])
+            if minimum_first[index]:
+                values.append(minimums[index])
+                values.append(maximums[index])
+            else:
+                values.append(maximums[index])
+                values.append(minimums[index])
+
+        if self.open_count:
+            times.append(self.open_start_time)
+            times.append(self.open_end_time)
+            if self.open_minimum_first[channel]:
+                values.append(self.open_minimums[channel])
+                values.append(self.open_maximums[channel])
+            else:
+                values.append(self.open_maximums[channel])
+                values.append(self.open_minimums[channel])
+        return times, values
+
+    def get_limits(self, channel : int) -> tuple[float, float]:
+        return self.lowest[channel], self.highest[channel]
+
+    def __len__(self) -> int:
+        return len(self.start_times) + (1 if self.open_count else 0)
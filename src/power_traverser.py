@@ -1,59 +1,113 @@
 #Builtins
 import os
-import datetime
-import re
+import calendar
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+#Locals
+from analyzers import PowerAnalyzer
+from log_segments import read_lines, log_base_path
+
+'''
+Energy report over every log the project writes. Files are streamed line by line and integrated on the fly,
+so memory does not depend on the file size, and files are spread over a process pool. A rotated log is
+reported once, its segments read in order whether they are compressed or not.
+
+Supported line formats, detected per line:
+    .txt logs:         14/03/2024 10:15:02 3.30V 1.00A
+    DataLogger logs:   3.30V 1.000A 0.1234Wh<TAB>1710411302.5<TAB>10:15:02
+    serialize_to_csv:  voltage;current;power;ahour;whour;timestamp;is_valid
+Lines in any other format (headers, terminal.log output) are skipped.
+'''
+
+LOG_EXTENSIONS = ('.txt', '.log')
+
+#Timestamps of .txt logs only matter relative to each other, so dates are read as naive UTC
+_date_cache : dict[str, int] = {}
+
+def _parse_date(date_str : str) -> int:
+    epoch = _date_cache.get(date_str)
+    if epoch is None:
+        day, month, year = date_str.split('/')
+        epoch = calendar.timegm((int(year), int(month), int(day), 0, 0, 0))
+        _date_cache[date_str] = epoch
+    return epoch
+
+def parse_text_line(line : str) -> Optional[tuple[float, float, float]]:
+    parts = line.split()
+    if len(parts) != 4 or not parts[2].endswith('V') or not parts[3].endswith('A'):
+        return None
+    date_str, time_str, voltage_str, current_str = parts
+    hours, minutes, seconds = time_str.split(':')
+    timestamp = _parse_date(date_str) + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return (timestamp, float(voltage_str[:-1]), float(current_str[:-1]))
+
+def parse_data_logger_line(line : str) -> Optional[tuple[float, float, float]]:
+    fields = line.split('\t')
+    if len(fields) < 2:
+        return None
+    values = fields[0].split()
+    if len(values) < 2 or not values[0].endswith('V') or not values[1].endswith('A'):
+        return None
+    return (float(fields[1]), float(values[0][:-1]), float(values[1][:-1]))
+
+def parse_csv_line(line : str) -> Optional[tuple[float, float, float]]:
+    fields = line.rstrip('\r\n').split(';')
+    if len(fields) != 7 or fields[6] != 'True' or not fields[0]:
+        return None #Header, invalid sample or other CSV
+    return (float(fields[5]), float(fields[0]), float(fields[1]))
+
+def parse_line(line : str) -> Optional[tuple[float, float, float]]:
+    """Returns (timestamp, voltage, current) or None if the line holds no sample."""
+    try:
+        if ';' in line:
+            return parse_csv_line(line)
+        if '\t' in line:
+            return parse_data_logger_line(line)
+        return parse_text_line(line)
+    except ValueError:
+        return None
+
+def integrate_file(filename) -> tuple[str, float, float, int]:
+    """Streams a log file and returns (filename, energy in Wh, capacity in Ah, samples)."""
+    power_analyzer = PowerAnalyzer()
+    samples = 0
+    for line in read_lines(filename, errors = 'replace'):
+        sample = parse_line(line)
+        if sample is None:
+            continue
+        timestamp, voltage, current = sample
+        power_analyzer.add_entry(voltage, current, timestamp)
+        samples += 1
+    energy, capacity = power_analyzer.calculate_energy_capacity()
+    return filename, energy, capacity, samples
 
 def calculate_energy_from_file(filename):
     """Calculate total energy consumption from a file."""
-    with open(filename, 'r') as file:
-        data = file.read()
-
-    entries = []
-    for line in data.strip().split("\n"):
-        # Extract date, time, voltage, and current
-        date_str, time_str, voltage_str, current_str = re.split(r'\s+', line)
-        
-        # Combine date and time into a single timestamp
-        timestamp_str = f"{date_str} {time_str}"
-        timestamp = datetime.datetime.strptime(timestamp_str, '%d/%m/%Y %H:%M:%S')
-        
-        # Extract voltage and current
-        voltage = float(voltage_str.rstrip("V"))
-        current = float(current_str.rstrip("A"))
-        
-        entries.append((timestamp, voltage, current))
-
-    total_energy = 0.0
-    for i in range(1, len(entries)):
-        t1, v1, i1 = entries[i - 1]
-        t2, v2, i2 = entries[i]
-
-        # Calculate the time difference in hours
-        delta_time_hours = (t2 - t1).total_seconds() / 3600
-
-        # Calculate average voltage and current
-        average_voltage = (v1 + v2) / 2
-        average_current = (i1 + i2) / 2
-
-        # Calculate energy in Wh
-        energy = average_voltage * average_current * delta_time_hours
-        total_energy += energy
-
-    return total_energy
-
-def process_directory(root_dir, output_file):
+    return integrate_file(filename)[1]
+
+def find_log_files(root_dir, output_file) -> list[str]:
+    log_files = set()
+    for subdir, _, files in os.walk(root_dir):
+        for file in files:
+            file = log_base_path(file)
+            if file == os.path.basename(output_file):
+                continue
+
+            if file.endswith(LOG_EXTENSIONS):
+                log_files.add(os.path.join(subdir, file))
+    return sorted(log_files)
+
+def process_directory(root_dir, output_file, workers = None):
     """Process all files in the given directory and its subdirectories."""
-    with open(output_file, 'w') as outfile:
-        for subdir, _, files in os.walk(root_dir):
-            for file in files:
-                if file == os.path.basename(output_file):
-                    continue
-
-                if file.endswith('.txt'):
-                    file_path = os.path.join(subdir, file)
-                    total_energy = calculate_energy_from_file(file_path)
-                    outfile.write(f"{file_path}: {total_energy:.3f} Wh\n")
-                    print(f"Processed {file_path}: {total_energy:.3f} Wh")
+    log_files = find_log_files(root_dir, output_file)
+    with open(output_file, 'w') as outfile, ProcessPoolExecutor(max_workers = workers) as executor:
+        #Results come back in file order while the pool keeps working on the following files
+        for file_path, total_energy, total_capacity, samples in executor.map(integrate_file, log_files):
+            if samples == 0:
+                continue
+            outfile.write(f"{file_path}: {total_energy:.3f} Wh\n")
+            print(f"Processed {file_path}: {total_energy:.3f} Wh {total_capacity:.3f} Ah ({samples} samples)")
 
 if __name__ == "__main__":
     # Specify the root directory to search and the output file
@@ -0,0 +1,150 @@
+#Builtins
+from collections import deque, namedtuple
+from typing import Callable, Optional
+
+'''
+Streaming DC internal resistance (DC-IR) from the current steps of a run.
+
+Every relay flip and every ITech state change steps the current, and the voltage jumps by about R * dI.
+ResistanceEstimator watches the sample stream for those steps, no hint from the controller is needed:
+
+    before  the last window_seconds of samples before the step, at most max_window_samples of them
+    step    a sample whose current is min_step_current or more away from the mean current before it
+    after   the window_seconds of samples following the step, skipping the first settle_seconds
+
+A straight line V(t) is fitted by least squares on each side and both are extrapolated to the step time, so a
+voltage that keeps drifting during the windows is not counted as a jump. R = dV / dI, dI between the mean
+currents of both sides. The fit after the step is accumulated sample by sample, the one before it is computed
+once from the bounded window, so memory does not grow with the length of the run.
+'''
+
+RESISTANCE_FIELDS = ("timestamp", "label", "resistance", "delta_voltage", "delta_current", "samples_before", "samples_after")
+ResistanceEstimate = namedtuple("ResistanceEstimate", RESISTANCE_FIELDS)
+
+class LinearFit:
+    """Incremental least squares of y = intercept + slope * x. x is taken relative to origin to keep the sums small."""
+    def __init__(self, origin : float = 0.0):
+        self.origin = origin
+        self.count = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+    def add(self, x : float, y : float):
+        x -= self.origin
+        self.count += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+
+    def value_at(self, x : float) -> float:
+        assert self.count > 0, "No points to fit"
+        x -= self.origin
+        mean_x = self.sum_x / self.count
+        mean_y = self.sum_y / self.count
+        variance = self.sum_xx - self.count * mean_x * mean_x
+        if self.count < 2 or variance <= 1e-12:
+            return mean_y #A single instant, no slope to extrapolate with
+        slope = (self.sum_xy - self.count * mean_x * mean_y) / variance
+        return mean_y + slope * (x - mean_x)
+
+class ResistanceEstimator:
+    def __init__(self, min_step_current : float = 0.5, window_seconds : float = 2.0, settle_seconds : float = 0.0,
+                 max_window_samples : int = 256, label : Optional[Callable[[], str]] = None):
+        assert min_step_current > 0, "Minimum current step must be positive"
+        assert window_seconds > 0, "Window must be positive"
+        assert settle_seconds >= 0, "Settle time can not be negative"
+        self.min_step_current = min_step_current
+        self.window_seconds = window_seconds
+        self.settle_seconds = settle_seconds
+        self.label = label if label else (lambda: "") #Given by the controller, names the state the step goes into
+        self.before : deque = deque(maxlen = max_window_samples)
+        self.before_current_sum = 0.0
+        self.step = None #(time, voltage before, current before, samples before, label) while measuring after a step
+        self.after_fit : Optional[LinearFit] = None
+        self.after_current_sum = 0.0
+        self.last_after_time = 0.0
+        self.last_estimate : Optional[ResistanceEstimate] = None
+        self.estimate_count = 0
+
+    def reset(self):
+        self.before.clear()
+        self.before_current_sum = 0.0
+        self.step = None
+        self.after_fit = None
+        self.after_current_sum = 0.0
+
+    def update(self, voltage : float, current : float, timestamp : float) -> Optional[ResistanceEstimate]:
+        """Adds a sample, returns the estimate of a step once its window after is complete."""
+        if self.step is not None:
+            return self._measure_after(voltage, current, timestamp)
+
+        if self.before and timestamp - self.before[-1][0] > self.window_seconds:
+            self.reset() #A gap in the data, the samples before it say nothing about this one
+        if len(self.before) >= 2:
+            mean_current = self.before_current_sum / len(self.before)
+            if abs(current - mean_current) >= self.min_step_current:
+                self._start_step(mean_current, timestamp)
+                return self._measure_after(voltage, current, timestamp)
+        self._add_before(voltage, current, timestamp)
+        return None
+
+    def _add_before(self, voltage : float, current : float, timestamp : float):
+        if len(self.before) == self.before.maxlen:
+            self.before_current_sum -= self.before[0][2]
+        self.before.append((timestamp, voltage, current))
+        self.before_current_sum += current
+        while timestamp - self.before[0][0] > self.window_seconds:
+            self.before_current_sum -= self.before.popleft()[2]
+
+    def _start_step(self, mean_current : float, timestamp : float):
+        step_time = (self.before[-1][0] + timestamp) / 2 #The current changed somewhere between the two samples
+        before_fit = LinearFit(step_time)
+        for sample_time, sample_voltage, _ in self.before:
+            before_fit.add(sample_time, sample_voltage)
+        self.step = (step_time, before_fit.value_at(step_time), mean_current, len(self.before), self.label())
+        self.after_fit = LinearFit(step_time)
+        self.after_current_sum = 0.0
+        self.before.clear()
+        self.before_current_sum = 0.0
+
+    def _restart_step(self, timestamp : float):
+        step_time = (self.last_after_time + timestamp) / 2
+        count = self.after_fit.count
+        self.step = (step_time, self.after_fit.value_at(step_time), self.after_current_sum / count, count, self.label())
+        self.after_fit = LinearFit(step_time)
+        self.after_current_sum = 0.0
+
+    def _measure_after(self, voltage : float, current : float, timestamp : float) -> Optional[ResistanceEstimate]:
+        step_time, voltage_before, current_before, samples_before, label = self.step
+        elapsed = timestamp - step_time
+        if elapsed < self.settle_seconds:
+            return None
+        if elapsed <= self.settle_seconds + self.window_seconds:
+            if self.after_fit.count >= 2 and abs(current - self.after_current_sum / self.after_fit.count) >= self.min_step_current:
+                #Stepped again before the window was complete: the samples since the last step are the window before this one
+                self._restart_step(timestamp)
+                return self._measure_after(voltage, current, timestamp)
+            self.after_fit.add(timestamp, voltage)
+            self.after_current_sum += current
+            self.last_after_time = timestamp
+            return None
+
+        estimate = None
+        if self.after_fit.count >= 2:
+            delta_voltage = self.after_fit.value_at(step_time) - voltage_before
+            delta_current = self.after_current_sum / self.after_fit.count - current_before
+            estimate = ResistanceEstimate(step_time, label, delta_voltage / delta_current, delta_voltage, delta_current,
+                                          samples_before, self.after_fit.count)
+            self.last_estimate = estimate
+            self.estimate_count += 1
+        #The sample past the window starts the window before the next step
+        self.reset()
+        self._add_before(voltage, current, timestamp)
+        return estimate
+
+def resistance_row(estimate : ResistanceEstimate) -> tuple:
+    return (f"{estimate.timestamp:.3f}", estimate.label, f"{estimate.resistance:.6f}", f"{estimate.delta_voltage:.5f}",
+            f"{estimate.delta_current:.5f}", estimate.samples_before, estimate.samples_after)
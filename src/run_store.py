@@ -0,0 +1,194 @@
+#Builtins
+import os
+import time
+
+#Third party
+import numpy as np
+
+'''
+Append-only binary run store.
+
+A run is a directory of segment files. Every segment is preallocated for a fixed number of rows and holds
+one contiguous float64 block per column, so a column can be memory mapped and handed out as a NumPy array
+without copying or parsing anything:
+
+    [header: 64 bytes][timestamp * capacity][voltage * capacity] ... [state * capacity]
+
+The header stores the row count, which is only advanced after the column data is in place. A segment that
+was cut short by a crash therefore exposes the rows that were committed before it.
+'''
+
+COLUMNS = ("timestamp", "voltage", "current", "power", "energy", "capacity", "state")
+
+#States are stored as float64 like every other column
+STATE_CODES = {
+    "monitor": 0.0,
+    "precharge": 1.0,
+    "discharge": 2.0,
+    "recharge": 3.0,
+    "charge": 4.0,
+    "passive": 5.0,
+}
+STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+
+HEADER_SIZE = 64
+HEADER_MAGIC = int.from_bytes(b"PCRSTOR1", "little")
+HEADER_VERSION = 1
+#Header layout in uint64 words
+HEADER_MAGIC_INDEX = 0
+HEADER_VERSION_INDEX = 1
+HEADER_COLUMNS_INDEX = 2
+HEADER_CAPACITY_INDEX = 3
+HEADER_ROWS_INDEX = 4
+
+def encode_state(state : str) -> float:
+    return STATE_CODES[state]
+
+def decode_state(code : float) -> str:
+    return STATE_NAMES[float(code)]
+
+def segment_file_name(index : int) -> str:
+    return f"segment_{index:05d}.bin"
+
+def list_segment_paths(directory : str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.startswith("segment_") and name.endswith(".bin"))
+    return [os.path.join(directory, name) for name in names]
+
+def _map_header(path : str, mode : str) -> np.memmap:
+    return np.memmap(path, dtype = "<u8", mode = mode, offset = 0, shape = (HEADER_SIZE // 8,))
+
+def _map_columns(path : str, mode : str, capacity : int) -> np.memmap:
+    return np.memmap(path, dtype = "<f8", mode = mode, offset = HEADER_SIZE, shape = (len(COLUMNS), capacity))
+
+def _check_header(header : np.ndarray, path : str):
+    if header[HEADER_MAGIC_INDEX] != HEADER_MAGIC:
+        raise ValueError(f"{path} is not a run store segment")
+    if header[HEADER_VERSION_INDEX] != HEADER_VERSION:
+        raise ValueError(f"{path} has unsupported version {header[HEADER_VERSION_INDEX]}")
+    if header[HEADER_COLUMNS_INDEX] != len(COLUMNS):
+        raise ValueError(f"{path} has {header[HEADER_COLUMNS_INDEX]} columns, expected {len(COLUMNS)}")
+
+class RunStoreWriter:
+    """
+    Buffers rows in memory and copies them into the memory mapped segment in blocks.
+
+    The OS writes the mapped pages back on its own; flush() forces them to disk (msync) at most every
+    fsync_interval seconds. Opening an existing store continues after its last committed row.
+    """
+    def __init__(self, directory : str, segment_rows : int = 1_000_000, buffer_rows : int = 1024, fsync_interval : float = 5.0):
+        assert segment_rows > 0, "Segment must hold at least one row"
+        assert buffer_rows > 0, "Buffer must hold at least one row"
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.buffer_rows = buffer_rows
+        self.fsync_interval = fsync_interval
+        self.buffer : list[tuple] = []
+        self.last_fsync_time = time.monotonic()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        segment_paths = list_segment_paths(directory)
+        if segment_paths:
+            self._open_segment(len(segment_paths) - 1)
+        else:
+            self._create_segment(0)
+
+    def _create_segment(self, index : int):
+        path = os.path.join(self.directory, segment_file_name(index))
+        with open(path, "wb") as file:
+            file.truncate(HEADER_SIZE + len(COLUMNS) * self.segment_rows * 8) #Preallocate, sparse where supported
+        header = _map_header(path, "r+")
+        header[HEADER_MAGIC_INDEX] = HEADER_MAGIC
+        header[HEADER_VERSION_INDEX] = HEADER_VERSION
+        header[HEADER_COLUMNS_INDEX] = len(COLUMNS)
+        header[HEADER_CAPACITY_INDEX] = self.segment_rows
+        header[HEADER_ROWS_INDEX] = 0
+        header.flush()
+        self._open_segment(index)
+
+    def _open_segment(self, index : int):
+        path = os.path.join(self.directory, segment_file_name(index))
+        self.header = _map_header(path, "r+")
+        _check_header(self.header, path)
+        self.segment_index = index
+        self.capacity = int(self.header[HEADER_CAPACITY_INDEX])
+        self.row_count = int(self.header[HEADER_ROWS_INDEX])
+        self.columns = _map_columns(path, "r+", self.capacity)
+
+    def append(self, timestamp : float, voltage : float, current : float, power : float, energy : float, capacity : float, state : float):
+        self.buffer.append((timestamp, voltage, current, power, energy, capacity, state))
+        if len(self.buffer) >= self.buffer_rows:
+            self._write_buffer()
+        if time.monotonic() - self.last_fsync_time >= self.fsync_interval:
+            self.flush()
+
+    def _write_buffer(self):
+        if not self.buffer:
+            return
+        rows = np.array(self.buffer, dtype = np.float64).T
+        self.buffer = []
+        written = 0
+        while written < rows.shape[1]:
+            if self.row_count == self.capacity:
+                self._sync()
+                self._create_segment(self.segment_index + 1)
+            count = min(rows.shape[1] - written, self.capacity - self.row_count)
+            self.columns[:, self.row_count:self.row_count + count] = rows[:, written:written + count]
+            self.row_count += count
+            self.header[HEADER_ROWS_INDEX] = self.row_count #Commit only after the data is in place
+            written += count
+
+    def _sync(self):
+        self.columns.flush()
+        self.header.flush()
+        self.last_fsync_time = time.monotonic()
+
+    def flush(self):
+        self._write_buffer()
+        self._sync()
+
+    def close(self):
+        self.flush()
+        del self.columns
+        del self.header
+
+class RunStoreReader:
+    """
+    Maps every segment of a run read-only. Column arrays are views into the files, nothing is copied
+    unless a column spanning several segments is requested as a single array.
+    """
+    def __init__(self, directory : str):
+        self.directory = directory
+        self.segment_paths = list_segment_paths(directory)
+        if not self.segment_paths:
+            raise FileNotFoundError(f"No run store segments in {directory}")
+
+    def segments(self) -> list[dict[str, np.ndarray]]:
+        segments = []
+        for path in self.segment_paths:
+            header = _map_header(path, "r")
+            _check_header(header, path)
+            capacity = int(header[HEADER_CAPACITY_INDEX])
+            row_count = int(header[HEADER_ROWS_INDEX])
+            columns = _map_columns(path, "r", capacity)
+            segments.append({name: columns[index, :row_count] for index, name in enumerate(COLUMNS)})
+        return segments
+
+    def read_column(self, name : str) -> np.ndarray:
+        assert name in COLUMNS, f"Invalid column: {name}"
+        arrays = [segment[name] for segment in self.segments()]
+        if len(arrays) == 1:
+            return arrays[0]
+        return np.concatenate(arrays)
+
+    def read(self) -> dict[str, np.ndarray]:
+        segments = self.segments()
+        if len(segments) == 1:
+            return segments[0]
+        return {name: np.concatenate([segment[name] for segment in segments]) for name in COLUMNS}
+
+    def __len__(self) -> int:
+        return sum(len(segment["timestamp"]) for segment in self.segments())
@@ -0,0 +1,376 @@
+#Builtins
+import os
+import math
+import time
+import argparse
+import threading
+import socketserver
+from bisect import bisect_left
+from collections import deque
+from typing import Callable, Optional
+
+#Locals
+from clock import VirtualClock
+
+'''
+Simulated instruments for runs without the lab.
+
+Every simulator is backed by a BatteryModel that follows a VirtualClock, so a run can go many times faster
+than real time (a 10 hour cycle takes one minute with scale = 600):
+    ITechSimulator      TCP SCPI server answering like ITech6018Device expects
+    YokogawaSimulator   pty serial port answering RR,1 (or streaming in talk-only mode)
+    RelaySimulator      pty serial port speaking the relay firmware protocol, RELAY;n;STATE
+
+Serial simulators need a POSIX pty, point pyserial at their port_name.
+Run this file to start a complete relay rig and an ITech, e.g. python simulators.py --scale 600
+'''
+
+#Open circuit voltage of a LiFePO4 cell against state of charge
+LFP_OCV_TABLE = [(0.00, 2.50), (0.02, 2.90), (0.05, 3.10), (0.10, 3.20), (0.20, 3.25), (0.40, 3.29),
+                 (0.60, 3.31), (0.80, 3.33), (0.90, 3.35), (0.95, 3.40), (0.98, 3.50), (1.00, 3.60)]
+
+class BatteryModel:
+    """
+    First order equivalent circuit: open circuit voltage from a SOC table, series resistance r0 and one
+    r1 || c1 branch for the polarization. Current is positive when charging.
+
+    The source connected to the battery is set with rest() or constant_current(). The
+    model is integrated lazily up to the clock time whenever it is read, in steps of at most max_step
+    virtual seconds, so reading it often or rarely gives the same trajectory.
+    """
+    def __init__(self, capacity_ah : float = 3.0, soc : float = 0.5, r0 : float = 0.020, r1 : float = 0.015, c1 : float = 2000.0,
+                 ocv_table : list[tuple[float, float]] = LFP_OCV_TABLE, clock : Optional[VirtualClock] = None, max_step : float = 1.0):
+        assert capacity_ah > 0, "Capacity must be positive"
+        self.capacity_ah = capacity_ah
+        self.soc = soc
+        self.r0 = r0
+        self.r1 = r1
+        self.c1 = c1
+        self.ocv_socs = [point[0] for point in ocv_table]
+        self.ocv_voltages = [point[1] for point in ocv_table]
+        self.clock = clock if clock else VirtualClock()
+        self.max_step = max_step
+        self.lock = threading.Lock()
+
+        self.polarization_voltage = 0.0
+        self.current = 0.0
+        self.source = ("rest", 0.0, None) #(mode, current limit, voltage limit)
+        self.last_time = self.clock.time()
+
+    def open_circuit_voltage(self, soc : float) -> float:
+        #Beyond the table the end segments are extended, so an overcharged cell keeps rising to the charge voltage
+        index = min(max(1, bisect_left(self.ocv_socs, soc)), len(self.ocv_socs) - 1)
+        soc_low, soc_high = self.ocv_socs[index - 1], self.ocv_socs[index]
+        voltage_low, voltage_high = self.ocv_voltages[index - 1], self.ocv_voltages[index]
+        return voltage_low + (voltage_high - voltage_low) * (soc - soc_low) / (soc_high - soc_low)
+
+    def _source_current(self) -> float:
+        mode, current_limit, voltage_limit = self.source
+        if mode == "rest":
+            return 0.0
+        if voltage_limit is None:
+            return current_limit
+        #Current that holds the terminal voltage at the limit, never beyond the current limit
+        internal_voltage = self.open_circuit_voltage(self.soc) + self.polarization_voltage
+        current = (voltage_limit - internal_voltage) / self.r0
+        if current_limit >= 0:
+            return min(max(current, 0.0), current_limit)
+        return max(min(current, 0.0), current_limit)
+
+    def _advance(self, now : float):
+        remaining = now - self.last_time
+        tau = self.r1 * self.c1
+        while remaining > 0:
+            step = min(remaining, self.max_step)
+            self.current = self._source_current()
+            self.soc += self.current * step / 3600 / self.capacity_ah
+            decay = math.exp(-step / tau)
+            self.polarization_voltage = self.polarization_voltage * decay + self.current * self.r1 * (1 - decay)
+            remaining -= step
+        self.current = self._source_current()
+        self.last_time = max(self.last_time, now)
+
+    def _set_source(self, source : tuple):
+        with self.lock:
+            self._advance(self.clock.time())
+            self.source = source
+            self.current = self._source_current()
+
+    def rest(self):
+        self._set_source(("rest", 0.0, None))
+
+    def constant_current(self, current : float, voltage_limit : Optional[float] = None):
+        """Charges (current > 0) or discharges (current < 0), holding voltage_limit once it is reached."""
+        self._set_source(("cc", current, voltage_limit))
+
+    def read(self) -> tuple[float, float, float]:
+        """Returns (voltage, current, clock time) at the current clock time."""
+        with self.lock:
+            now = self.clock.time()
+            self._advance(now)
+            voltage = self.open_circuit_voltage(self.soc) + self.polarization_voltage + self.current * self.r0
+            return voltage, self.current, now
+
+class ScpiHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.simulator.execute(line.decode(errors = 'replace').strip())
+            if reply is not None:
+                if self.server.simulator.reply_delay:
+                    time.sleep(self.server.simulator.reply_delay)
+                self.wfile.write((reply + '\n').encode())
+
+class ITechSimulator:
+    """
+    TCP SCPI server with the subset of the ITech 6018 command set used by ITech6018Device.
+
+    Commands may be chained with ';' and a leading ':' is ignored, as on the instrument. The replies of all
+    queries of one line are joined with ';', and *OPC? answers 1 once the commands before it are applied.
+    FUNCTION:MODE BATTERY runs the battery test: the battery is
+    charged with constant current then constant voltage, or discharged with constant current down to the
+    discharge voltage. Unknown commands are queued as errors for SYSTEM:ERROR?.
+    """
+    def __init__(self, battery : BatteryModel, host : str = "127.0.0.1", port : int = 0, mode_change_delay : float = 0.0,
+                 reply_delay : float = 0.0):
+        self.battery = battery
+        self.mode_change_delay = mode_change_delay #Real seconds taken by a FUNCTION:MODE change
+        self.reply_delay = reply_delay #Real seconds before every reply, like the measurement time of the instrument
+        self.function_mode = "FIXED"
+        self.battery_mode = "CHARGE"
+        self.output = False
+        self.settings = {"CHARGE:CURRENT": 0.0, "CHARGE:VOLTAGE": 0.0, "DISCHARGE:CURRENT": 0.0, "DISCHARGE:VOLTAGE": 0.0,
+                         "SHUT:CURRENT": 0.0, "SHUT:VOLTAGE": 0.0}
+        self.errors = []
+        self.commands : deque = deque(maxlen = 1000) #Last commands received, for tests and debugging
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), ScpiHandler, bind_and_activate = False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.server.server_bind()
+        self.server.server_activate()
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target = self.server.serve_forever, name = "itech-simulator", daemon = True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _apply_source(self):
+        if self.function_mode != "BATTERY":
+            self.battery.rest() #FIXED mode is used as STOP, with no setpoint
+        elif self.battery_mode == "CHARGE":
+            self.battery.constant_current(abs(self.settings["CHARGE:CURRENT"]), self.settings["CHARGE:VOLTAGE"])
+        else:
+            self.battery.constant_current(-abs(self.settings["DISCHARGE:CURRENT"]), self.settings["DISCHARGE:VOLTAGE"])
+
+    def _execute_one(self, command : str) -> Optional[str]:
+        header, _, argument = command.partition(' ')
+        header = header.upper()
+        argument = argument.strip()
+
+        if header.startswith("MEASURE:"):
+            voltage, current, _ = self.battery.read()
+            values = {"MEASURE:VOLTAGE?": voltage, "MEASURE:CURRENT?": current, "MEASURE:POWER?": voltage * current}
+            if header in values:
+                return f"{values[header]:.5f}"
+        elif header == "*IDN?":
+            return "ITECH Ltd.,IT6018C-SIM,000000000000000000,1.0"
+        elif header == "*OPC?":
+            return "1" #Commands are applied in order, everything before is complete
+        elif header == "*WAI":
+            return None
+        elif header == "SYSTEM:ERROR?":
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        elif header == "FUNCTION:MODE?":
+            return self.function_mode
+        elif header == "FUNCTION:MODE" and argument.upper() in ("FIXED", "BATTERY"):
+            if argument.upper() != self.function_mode:
+                time.sleep(self.mode_change_delay)
+            self.function_mode = argument.upper()
+            self._apply_source()
+            return None
+        elif header == "BATTERY:MODE" and argument.upper() in ("CHARGE", "DISCHARGE"):
+            self.battery_mode = argument.upper()
+            self._apply_source()
+            return None
+        elif header.startswith("BATTERY:") and header[len("BATTERY:"):] in self.settings:
+            try:
+                self.settings[header[len("BATTERY:"):]] = float(argument)
+                self._apply_source()
+                return None
+            except ValueError:
+                pass
+        elif header == "OUTPUT" and argument in ("0", "1", "ON", "OFF"):
+            self.output = argument in ("1", "ON")
+            self._apply_source()
+            return None
+        elif header in ("SYSTEM:REMOTE", "SYSTEM:LOCAL", "*CLS", "SYSTEM:TIME", "SYSTEM:DATE") or header.startswith("SENSE:"):
+            return None
+
+        self.errors.append(f'-113,"Undefined header;{command}"')
+        return None
+
+    def execute(self, line : str) -> Optional[str]:
+        replies = []
+        with self.lock:
+            self.commands.append(line)
+            for command in line.split(';'):
+                command = command.strip().lstrip(':')
+                if not command:
+                    continue
+                reply = self._execute_one(command)
+                if reply is not None:
+                    replies.append(reply)
+        return ';'.join(replies) if replies else None
+
+class PtySimulator(threading.Thread):
+    """Serial device behind a pseudo terminal. Subclasses answer complete lines in handle_line."""
+    def __init__(self, name : str):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        import tty #POSIX only
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+        self.running = True
+
+    def write(self, data : bytes):
+        os.write(self.master_fd, data)
+
+    def handle_line(self, line : bytes) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def run(self):
+        import select
+        partial = b""
+        while self.running:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.050)
+            if not readable:
+                continue
+            try:
+                partial += os.read(self.master_fd, 1024)
+            except OSError:
+                break
+            *lines, partial = partial.split(b"\n")
+            for line in lines:
+                reply = self.handle_line(line.rstrip(b"\r"))
+                if reply:
+                    self.write(reply)
+
+    def close(self):
+        self.running = False
+        self.join(timeout = 1.0)
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+class YokogawaSimulator(PtySimulator):
+    """
+    Multimeter measuring the battery voltage ("voltage") or current ("current"). Answers RR,1 with a
+    reading frame, or sends one every stream_interval real seconds when stream_interval is set.
+    """
+    def __init__(self, battery : BatteryModel, quantity : str, stream_interval : Optional[float] = None):
+        assert quantity in ("voltage", "current"), f"Invalid quantity: {quantity}"
+        PtySimulator.__init__(self, name = f"yokogawa-{quantity}")
+        self.battery = battery
+        self.quantity = quantity
+        self.stream_interval = stream_interval
+        self.requests = 0
+
+    def frame(self) -> bytes:
+        voltage, current, _ = self.battery.read()
+        if self.quantity == "voltage":
+            return f"RR,B,{voltage:+.4f} VDC4\r\n".encode()
+        return f"RR,B,{current:+.4f} ADC9\r\n".encode()
+
+    def handle_line(self, line : bytes) -> Optional[bytes]:
+        if line.strip() == b"RR,1":
+            self.requests += 1
+            return self.frame()
+        return None
+
+    def run(self):
+        if self.stream_interval:
+            #Talk-only: the meter sends readings on its own and ignores commands
+            while self.running:
+                time.sleep(self.stream_interval)
+                self.write(self.frame())
+        else:
+            PtySimulator.run(self)
+
+class RelaySimulator(PtySimulator):
+    """Relay board firmware: RELAY;<n>;<ON|OFF> switches a relay and replies "Relay <n> is <state>"."""
+    def __init__(self, relay_count : int = 4, on_change : Optional[Callable[[int, bool], None]] = None):
+        PtySimulator.__init__(self, name = "relay-simulator")
+        self.states = [False] * relay_count
+        self.on_change = on_change
+        self.write(b"RELAY MODULE | POWER CALCULATOR\r\n")
+
+    def handle_line(self, line : bytes) -> Optional[bytes]:
+        fields = line.decode(errors = 'replace').split(';')
+        if fields[0] != "RELAY" or len(fields) < 3:
+            return b"Invalid command\r\n"
+        try:
+            relay_number = int(fields[1])
+        except ValueError:
+            relay_number = 0
+        if not 1 <= relay_number <= len(self.states):
+            return b"Invalid relay number\r\n"
+        if fields[2] not in ("ON", "OFF"):
+            return b"Invalid relay state\r\n"
+
+        self.states[relay_number - 1] = fields[2] == "ON"
+        if self.on_change:
+            self.on_change(relay_number, self.states[relay_number - 1])
+        return f"Relay {relay_number} is {fields[2]}\r\n".encode()
+
+def relay_rig_source(battery : BatteryModel, relay_number : int, charge_current : float, charge_voltage : float, discharge_current : float,
+                     discharge_voltage : float) -> Callable[[int, bool], None]:
+    """on_change callback for a multimeter.py rig: the relay on connects the load, off leaves the battery on the charger."""
+    def on_change(number : int, state : bool):
+        if number != relay_number:
+            return
+        if state:
+            battery.constant_current(-abs(discharge_current), discharge_voltage)
+        else:
+            battery.constant_current(abs(charge_current), charge_voltage)
+    return on_change
+
+def main():
+    parser = argparse.ArgumentParser(description = "Start simulated instruments for hardware free runs")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "Virtual seconds per real second")
+    parser.add_argument("--capacity", type = float, default = 3.0, help = "Battery capacity in Ah")
+    parser.add_argument("--soc", type = float, default = 0.5, help = "Initial state of charge, 0 to 1")
+    parser.add_argument("--itech_port", type = int, default = 30000, help = "TCP port of the simulated ITech")
+    args = parser.parse_args()
+
+    clock = VirtualClock(args.scale)
+    itech = ITechSimulator(BatteryModel(capacity_ah = args.capacity, soc = args.soc, clock = clock), port = args.itech_port)
+    itech.start()
+
+    rig_battery = BatteryModel(capacity_ah = args.capacity, soc = args.soc, clock = clock)
+    rig_battery.constant_current(args.capacity / 2, 3.65)
+    voltmeter = YokogawaSimulator(rig_battery, "voltage")
+    ammeter = YokogawaSimulator(rig_battery, "current")
+    relay_board = RelaySimulator(on_change = relay_rig_source(rig_battery, 1, args.capacity / 2, 3.65, args.capacity / 2, 2.00))
+    for simulator in (voltmeter, ammeter, relay_board):
+        simulator.start()
+
+    print(f"ITech:       {itech.address[0]}:{itech.address[1]}")
+    print(f"Multimeters: {voltmeter.port_name} (voltage) {ammeter.port_name} (current)")
+    print(f"Relay board: {relay_board.port_name} (relay 1)")
+    print(f"python multimeter.py --multimeter_ports {voltmeter.port_name} {ammeter.port_name} --relay_port {relay_board.port_name} --relay_number 1 --time_scale {args.scale}")
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        itech.close()
+        for simulator in (voltmeter, ammeter, relay_board):
+            simulator.close()
+
+if __name__ == "__main__":
+    main()
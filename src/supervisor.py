@@ -0,0 +1,314 @@
+#Builtins
+import os
+import time
+import json
+import serial
+import argparse
+import threading
+from queue import Queue, Empty
+from typing import Callable
+
+#Third party
+from colorama import Fore, Style
+import matplotlib.pyplot as plot
+from matplotlib.animation import FuncAnimation
+
+#Locals
+from controllers import *
+from analyzers import *
+from threads import *
+from acquisition import MultimeterAcquisition
+from plot_buffer import PlotBuffer
+from log_sink import LogSink
+from metrics import MetricsRegistry, start_metrics_server
+from checkpoint import Checkpointer, load_checkpoint, CHECKPOINT_FILE
+from incremental_capacity import IncrementalCapacity
+from resistance import ResistanceEstimator
+from notifications import default_dispatcher
+from clock import VirtualClock
+
+'''
+Runs several relay rigs in one process, instead of one multimeter.py process per rig.
+
+All multimeters of all rigs are triggered together by a single acquisition scheduler, the relay board is
+opened once and shared by every rig through a locked RelayChannel, all logs go through one LogSink and a
+single window plots every rig. With "quiet" the samples are not printed and the status of every rig is
+served at http://127.0.0.1:<metrics_port>/metrics (Prometheus) and /status (JSON) instead; setting "metrics_port"
+also starts the server without "quiet". A port that is already in use only leaves the server out. Every rig writes a
+checkpoint to its folder every "checkpoint_interval" seconds; with "resume" the rigs continue from them in the
+existing folders.
+"time_scale" is the --scale of simulated instruments (python simulators.py): samples are then timestamped in
+simulated time, and the gap, cutoff and DC-IR windows stay the same in real seconds.
+
+Config file format (JSON):
+{
+    "relay_port": "COM31",
+    "measurement_interval": 0.100,
+    "quiet": false,
+    "metrics_port": 9100,
+    "resume": false,
+    "checkpoint_interval": 10.0,
+    "time_scale": 1.0,
+    "rigs": [
+        {"name": "rig1", "multimeter_ports": ["COM22", "COM21"], "relay_number": 1, "folder": "1S8P",
+         "add_current_calibration": 0.0, "charge_cutoff_voltage": 3.64, "charge_cutoff_current": 0.040,
+         "discharge_cutoff_voltage": 2.00, "log_format": "text", "dqdv_bin_width": 0.005, "dcir_min_step": 0.5,
+         "max_sample_gap": 30.0}
+    ]
+}
+'''
+
+#Thread safe queue of (rig index, voltage, current, relative timestamp) for the dashboard
+data_queue = Queue()
+
+class Rig:
+    def __init__(self, config : dict, relay_channel : RelayChannel, sink : LogSink, metrics_registry : MetricsRegistry, quiet : bool = False,
+                 resume : bool = False, checkpoint_interval : float = 10.0, time_scale : float = 1.0):
+        self.name : str = config["name"]
+        self.quiet = quiet
+        self.folder : str = config["folder"]
+        self.add_current_calibration = float(config.get("add_current_calibration", 0.0))
+        self.running = True
+
+        self.multimeter_ports = [serial.Serial(baudrate = 9600, timeout = 0.050) for _ in config["multimeter_ports"]]
+        for multimeter_port, port_name in zip(self.multimeter_ports, config["multimeter_ports"]):
+            multimeter_port.port = port_name
+        self.multimeters = [YokogawaController(multimeter_port) for multimeter_port in self.multimeter_ports]
+
+        self.relay_controller = RelayController(relay_channel.serial, relay_number = int(config["relay_number"]), channel = relay_channel)
+        #A longer interval, such as the downtime before a resume, is not integrated. Time limits are real seconds scaled to the clock
+        self.power_analyzer = PowerAnalyzer(max_gap = float(config.get("max_sample_gap", 30.0)) * time_scale)
+        self.logger = DataLogger(["terminal"], self.folder, sink = sink, resume = resume)
+        dqdv_bin_width = float(config.get("dqdv_bin_width", 0.005)) #0 to skip the dQ/dV curves
+        dcir_min_step = float(config.get("dcir_min_step", 0.5)) #0 to not measure the DC-IR
+        self.charge_controller = ChargeController(self.relay_controller, self.power_analyzer, self.logger,
+                                                  log_format = config.get("log_format", "text"),
+                                                  incremental_capacity = IncrementalCapacity(bin_width = dqdv_bin_width) if dqdv_bin_width > 0 else None,
+                                                  resistance_estimator = ResistanceEstimator(min_step_current = dcir_min_step, window_seconds = 2.0 * time_scale) if dcir_min_step > 0 else None,
+                                                  cutoff_detector = CutoffDetector(window_seconds = 1.0 * time_scale, min_samples = 3))
+        self.charge_controller.set_charge_threshold(float(config["charge_cutoff_voltage"]), float(config["charge_cutoff_current"]))
+        self.charge_controller.set_discharge_threshold(float(config["discharge_cutoff_voltage"]))
+        self.charge_controller.set_mode("monitor")
+        self.status = metrics_registry.register(self.name, sink)
+
+        checkpoint_path = os.path.join(self.logger.root_path, CHECKPOINT_FILE)
+        if resume:
+            self.charge_controller.restore(load_checkpoint(checkpoint_path))
+            if self.charge_controller.cycle_completed:
+                self.running = False
+                print(f"[SUPERVISOR]{self.name} already finished its cycle")
+        self.checkpointer = Checkpointer(checkpoint_path, self.charge_controller.snapshot, interval = checkpoint_interval)
+
+    def process_sample(self, index : int, data_points : list[DataPoint], timestamp : float, start_time : float):
+        #An error of one rig, such as an unacknowledged relay command, only stops that rig
+        try:
+            self._process_sample(index, data_points, timestamp, start_time)
+        except Exception as exception:
+            self.stop_on_error(exception)
+
+    def stop_on_error(self, exception : Exception):
+        self.running = False
+        print(Fore.RED + f"[SUPERVISOR]{self.name} stopped: {exception}" + Style.RESET_ALL)
+        log_exception(exception, self.name)
+        default_dispatcher().notify(f"[SUPERVISOR]{self.name} parou: {exception}", level = "error", key = f"{self.name}:stopped")
+        try:
+            self.relay_controller.set_relay("OFF")
+        except (RelayAcknowledgeError, serial.SerialException) as e:
+            print(Fore.RED + f"[SUPERVISOR]{self.name} could not turn its relay OFF: {e}" + Style.RESET_ALL)
+
+    def _process_sample(self, index : int, data_points : list[DataPoint], timestamp : float, start_time : float):
+        terminal_output_message = ""
+        self.status.tick()
+        for i, raw_data_point in enumerate(data_points):
+            if raw_data_point.value is None:
+                continue
+            if is_current_unit(raw_data_point.unit):
+                data_points[i] = DataPoint(raw_data_point.value + self.add_current_calibration, raw_data_point.unit, raw_data_point.timestamp)
+            if not self.quiet:
+                terminal_output_message += f"{self.multimeters[i].serial.port}: {data_points[i].value:.4f} {data_points[i].unit}\t"
+
+        is_power_available, voltage, current = check_if_power_available(data_points)
+        if is_power_available:
+            data_queue.put((index, voltage, current, timestamp - start_time))
+            self.power_analyzer.add_entry(voltage, current, timestamp)
+            try:
+                self.charge_controller.watch_values(voltage, current, timestamp)
+            except SystemExit:
+                #The controller exits once its cycle is completed, that only ends this rig
+                self.running = False
+                print(f"[SUPERVISOR]{self.name} finished its cycle")
+            self.checkpointer.maybe_save()
+
+            accumulated_energy, accumulated_capacity = self.power_analyzer.calculate_energy_capacity()
+            self.status.update(voltage, current, accumulated_energy, accumulated_capacity, self.charge_controller.mode,
+                               self.charge_controller.cycle_state, timestamp)
+            if not self.quiet:
+                terminal_output_message += f"Power: {voltage * current:.4f}W\t\tEnergy: {accumulated_energy:.4f}Wh"
+        else:
+            self.status.count_error("missing_reading")
+
+        if terminal_output_message:
+            message = f"[{self.name}]\t{terminal_output_message}\t{self.folder}\t{self.charge_controller.get_mode()}\t{timestamp - start_time:.2f}s"
+            print_and_log(self.logger, append_timestamp(timestamp, message))
+
+    def close(self):
+        self.checkpointer.save()
+        try:
+            self.charge_controller.set_mode("monitor")
+        except (RelayAcknowledgeError, serial.SerialException) as e:
+            #The other rigs are still closed
+            print(Fore.RED + f"[SUPERVISOR]{self.name} could not turn its relay OFF: {e}" + Style.RESET_ALL)
+        self.charge_controller.close()
+
+def log_exception(exception : Exception, rig_name : str = "supervisor.py"):
+    timestamp = time.strftime("%m-%d %H:%M:%S")
+    message = f"[{timestamp}]\t[{rig_name}]\tType: {type(exception).__name__}\tMessage: {exception}\n"
+    with open("error_log.txt", "a") as file:
+        file.write(message)
+
+def scheduler_loop(rigs : list[Rig], measurement_interval : float, clock : Callable[[], float] = time.time):
+    #Every multimeter of every rig is triggered in the same tick
+    multimeters = [multimeter for rig in rigs for multimeter in rig.multimeters]
+    rig_slices = []
+    first = 0
+    for rig in rigs:
+        rig_slices.append((first, first + len(rig.multimeters)))
+        first += len(rig.multimeters)
+
+    #Samples are timestamped with clock, the loop is paced in real time
+    acquisition = MultimeterAcquisition(multimeters, clock = clock)
+    start_time = clock()
+    for rig in rigs:
+        if rig.running:
+            rig.charge_controller.set_mode("cycle")
+    try:
+        while any(rig.running for rig in rigs):
+            tick_start = time.time()
+            sample = acquisition.acquire()
+            if sample.timestamp is not None:
+                for index, (rig, (first, last)) in enumerate(zip(rigs, rig_slices)):
+                    if rig.running:
+                        rig.process_sample(index, sample.data_points[first:last], sample.timestamp, start_time)
+            time.sleep(max(0.0, measurement_interval - (time.time() - tick_start)))
+
+    except (KeyboardInterrupt, SystemExit):
+        print(Fore.RED + "Exiting..." + Style.RESET_ALL)
+    except Exception as exception:
+        print(Fore.RED + f"Error: {exception}" + Style.RESET_ALL)
+        log_exception(exception)
+    finally:
+        acquisition.close()
+        for rig in rigs:
+            rig.close()
+        rigs[0].relay_controller.close() #Shared channel
+
+def supervisor_keyboard_callback(rigs : list[Rig], command : str):
+    #Commands are the multimeter.py commands followed by the rig number, e.g. K1 or R3
+    command = command.strip().upper()
+    if len(command) < 2 or not command[1:].isdigit():
+        print("[SUPERVISOR]Usage: K<rig number> or R<rig number>")
+        return
+    rig_number = int(command[1:])
+    if not 1 <= rig_number <= len(rigs):
+        print(f"[SUPERVISOR]Invalid rig number: {rig_number}")
+        return
+    keyboard_input_callback(rigs[rig_number - 1].charge_controller, command[0])
+
+def create_dashboard(rigs : list[Rig]):
+    figure, axes = plot.subplots(len(rigs), 2, figsize = (12, 3 * len(rigs)), squeeze = False)
+    plot_buffers = [PlotBuffer(channels = 2, max_buckets = 1024) for _ in rigs]
+    lines = []
+    for row, rig in enumerate(rigs):
+        axes[row][0].set_title(f"{rig.name} - Voltage")
+        axes[row][0].set_ylabel("Voltage (V)")
+        axes[row][1].set_title(f"{rig.name} - Current")
+        axes[row][1].set_ylabel("Current (A)")
+        line_voltage, = axes[row][0].plot([], [], label = "Voltage", color = "blue")
+        line_current, = axes[row][1].plot([], [], label = "Current", color = "red")
+        lines.append((line_voltage, line_current))
+    axes[-1][0].set_xlabel("Time (s)")
+    axes[-1][1].set_xlabel("Time (s)")
+
+    def update_dashboard(frame):
+        try:
+            while True:
+                index, voltage, current, timestamp = data_queue.get_nowait()
+                plot_buffers[index].append(timestamp, (voltage, current))
+        except Empty:
+            pass
+
+        for row, plot_buffer in enumerate(plot_buffers):
+            if len(plot_buffer) == 0:
+                continue
+            for column in range(2):
+                lines[row][column].set_data(*plot_buffer.get_series(column))
+                axes[row][column].set_xlim(plot_buffer.first_time, plot_buffer.last_time)
+                lowest, highest = plot_buffer.get_limits(column)
+                axes[row][column].set_ylim(lowest - 0.1, highest + 0.1)
+        return [line for rig_lines in lines for line in rig_lines]
+
+    animation = FuncAnimation(figure, update_dashboard, interval = 100, cache_frame_data = False)
+    return figure, animation
+
+def load_config(path : str) -> dict:
+    with open(path, 'r') as file:
+        config = json.load(file)
+    assert config.get("rigs"), "No rigs configured"
+    relay_numbers = [int(rig["relay_number"]) for rig in config["rigs"]]
+    assert len(set(relay_numbers)) == len(relay_numbers), "Each rig needs its own relay number"
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run several charge / discharge rigs from a single process")
+    parser.add_argument("--config", required = True, help = "Path to the JSON rig configuration")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    measurement_interval = float(config.get("measurement_interval", 0.100))
+
+    #One persistent relay board connection, shared and locked across every rig
+    relay_port = serial.Serial(baudrate = 9600, timeout = 0.100)
+    relay_port.port = config["relay_port"]
+    relay_channel = RelayChannel(relay_port)
+    relay_channel.open()
+
+    sink = LogSink()
+    quiet = bool(config.get("quiet", False))
+    metrics_registry = MetricsRegistry()
+    resume = bool(config.get("resume", False))
+    checkpoint_interval = float(config.get("checkpoint_interval", 10.0))
+    #Accelerated simulated instruments (python simulators.py --scale) are integrated in simulated time
+    time_scale = float(config.get("time_scale", 1.0))
+    clock = VirtualClock(time_scale).time if time_scale != 1.0 else time.time
+    rigs = [Rig(rig_config, relay_channel, sink, metrics_registry, quiet, resume, checkpoint_interval, time_scale) for rig_config in config["rigs"]]
+    metrics_server = None
+    if quiet or config.get("metrics_port") is not None:
+        metrics_server = start_metrics_server(metrics_registry, port = int(config.get("metrics_port", 9100)))
+    if metrics_server:
+        print(f"[SUPERVISOR]Rig status at http://{metrics_server.address[0]}:{metrics_server.address[1]}/metrics and /status")
+    for rig in rigs:
+        print(f"[SUPERVISOR]{rig.name}: multimeters {[port.port for port in rig.multimeter_ports]}, relay {rig.relay_controller.relay_number}, folder {rig.folder}")
+
+    serial_opener_threads = [SerialOpenerThread(port) for rig in rigs for port in rig.multimeter_ports]
+    for opener in serial_opener_threads:
+        opener.daemon = True
+        opener.start()
+
+    keyboard_listener_thread = KeyboardListenerThread(supervisor_keyboard_callback, rigs)
+    keyboard_listener_thread.start()
+
+    scheduler_thread = threading.Thread(target = scheduler_loop, args = (rigs, measurement_interval, clock))
+    scheduler_thread.daemon = True
+    scheduler_thread.start()
+
+    figure, animation = create_dashboard(rigs)
+    figure.canvas.manager.set_window_title("SUPERVISOR")
+    plot.tight_layout()
+    plot.show()
+    scheduler_thread.join()
+    if metrics_server:
+        metrics_server.close()
+    sink.close()
+
+if __name__ == '__main__':
+    main()
@@ -25,13 +25,14 @@ class TestYokogawaController(unittest.TestCase):
             "RR,B,-0.0008 ADC9"
         ]
 
+        #Values are normalized to base units
         expected_results = [
-            (0.0047, 'VACC'),
-            (1.978, 'mVAC'),
+            (0.0047, 'VAC'),
+            (1.978e-3, 'VAC'),
             (0.0, 'VDC'),
-            (-0.001, 'mVDC'),
-            (-0.01, 'uADC'),
-            (-0.002, 'mADC'),
+            (-0.001e-3, 'VDC'),
+            (-0.01e-6, 'ADC'),
+            (-0.002e-3, 'ADC'),
             (-0.0008, 'ADC')
         ]
 
@@ -40,7 +41,8 @@ class TestYokogawaController(unittest.TestCase):
         for response, expected in zip(responses, expected_results):
             mock_serial.readline.return_value = response.encode()
             value, unit, _ = controller.read_measurements()
-            self.assertEqual((value, unit), expected)
+            self.assertAlmostEqual(value, expected[0], places = 12)
+            self.assertEqual(unit, expected[1])
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,119 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock
+import time
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from controllers import YokogawaController, check_if_power_available
+from acquisition import MultimeterAcquisition, StreamingAcquisition
+
+def create_mock_serial(reply : bytes, delay : float):
+    mock_serial = MagicMock()
+    mock_serial.is_open = True
+    def readline():
+        time.sleep(delay)
+        return reply
+    mock_serial.readline.side_effect = readline
+    return mock_serial
+
+class TestMultimeterAcquisition(unittest.TestCase):
+
+    def test_meters_are_read_in_parallel(self):
+        voltage_serial = create_mock_serial(b"RR,B,+3.3000 VDC4\r\n", 0.100)
+        current_serial = create_mock_serial(b"RR,B,-0.5000 ADC9\r\n", 0.100)
+        acquisition = MultimeterAcquisition([YokogawaController(voltage_serial), YokogawaController(current_serial)])
+
+        time_begin = time.time()
+        sample = acquisition.acquire()
+        elapsed = time.time() - time_begin
+        acquisition.close()
+
+        self.assertLess(elapsed, 0.180) #Sequential polling would take at least 200 ms
+        self.assertLess(sample.skew, 0.180)
+        self.assertEqual(check_if_power_available(sample.data_points), (True, 3.3, -0.5))
+        voltage_serial.write.assert_called_once_with(b"RR,1\r\n")
+        current_serial.write.assert_called_once_with(b"RR,1\r\n")
+
+    def test_closed_meter_yields_no_reading(self):
+        voltage_serial = create_mock_serial(b"RR,B,+3.3000 VDC4\r\n", 0.0)
+        closed_serial = create_mock_serial(b"", 0.0)
+        closed_serial.is_open = False
+        acquisition = MultimeterAcquisition([YokogawaController(voltage_serial), YokogawaController(closed_serial)])
+
+        sample = acquisition.acquire()
+        acquisition.close()
+
+        self.assertEqual(sample.data_points[0].value, 3.3)
+        self.assertIsNone(sample.data_points[1].value)
+        closed_serial.write.assert_not_called()
+
+    def test_partial_reply_is_completed(self):
+        mock_serial = MagicMock()
+        mock_serial.is_open = True
+        mock_serial.readline.side_effect = [b"RR,B,+3.30", b"00 VDC4\r\n"]
+        acquisition = MultimeterAcquisition([YokogawaController(mock_serial)])
+
+        sample = acquisition.acquire()
+        acquisition.close()
+
+        self.assertEqual((sample.data_points[0].value, sample.data_points[0].unit), (3.3, "VDC"))
+
+def create_streaming_serial(chunks : list[bytes], interval : float):
+    mock_serial = MagicMock()
+    mock_serial.is_open = True
+    mock_serial.in_waiting = 0
+    pending = list(chunks)
+    def read(size):
+        time.sleep(interval)
+        return pending.pop(0) if pending else b""
+    mock_serial.read.side_effect = read
+    return mock_serial
+
+class TestStreamingAcquisition(unittest.TestCase):
+
+    def test_stream_is_framed_and_paired(self):
+        #Frames split across reads must be reassembled before decoding
+        voltage_serial = create_streaming_serial([b"RR,B,+3.30", b"00 VDC4\r\n", b"RR,B,+3.3100 VDC4\r\n"], 0.010)
+        current_serial = create_streaming_serial([b"RR,B,-500.0 mADC9\r\nRR,B,-0.6000 ADC9\r\n"], 0.010)
+        acquisition = StreamingAcquisition([YokogawaController(voltage_serial), YokogawaController(current_serial)], reply_timeout = 0.500)
+
+        time.sleep(0.100)
+        sample = acquisition.acquire()
+        acquisition.close()
+
+        self.assertEqual(check_if_power_available(sample.data_points), (True, 3.31, -0.6))
+        self.assertEqual(acquisition.superseded, 2)
+        voltage_serial.write.assert_not_called() #No per-sample command in talk-only mode
+
+    def test_missing_stream_times_out(self):
+        silent_serial = create_streaming_serial([], 0.010)
+        acquisition = StreamingAcquisition([YokogawaController(silent_serial)], reply_timeout = 0.050)
+
+        sample = acquisition.acquire()
+        acquisition.close()
+
+        self.assertIsNone(sample.timestamp)
+        self.assertIsNone(sample.data_points[0].value)
+
+    def test_closed_ports_wait_for_the_deadline(self):
+        closed_serial = create_streaming_serial([], 0.010)
+        closed_serial.is_open = False
+        acquisition = StreamingAcquisition([YokogawaController(closed_serial)], reply_timeout = 0.100)
+
+        start = time.perf_counter()
+        sample = acquisition.acquire()
+        elapsed = time.perf_counter() - start
+        acquisition.close()
+
+        self.assertIsNone(sample.timestamp)
+        self.assertGreaterEqual(elapsed, 0.090)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#Builtins
+import unittest
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Third party
+import numpy as np
+
+#Locals
+from analytics import load_run, analyze_steps, analyze_run, pair_cycles, RunArrays
+from analyzers import PowerAnalyzer
+from run_store import RunStoreWriter, encode_state
+from itech import PowerStates
+
+def cycle_steps() -> list[tuple[str, np.ndarray, np.ndarray, np.ndarray]]:
+    """Charge at 1 A for an hour then taper for half an hour, discharge at 1 A, then the same charge again."""
+    steps = []
+    start = 1000.0
+    for state in ["charge", "discharge", "charge"]:
+        if state == "charge":
+            timestamp = start + np.arange(0, 5400.0, 10.0)
+            current = np.where(timestamp - start < 3600.0, 1.0, np.exp(-(timestamp - start - 3600.0) / 600.0))
+            voltage = np.minimum(3.2 + (timestamp - start) / 3600.0 * 0.45, 3.65)
+        else:
+            timestamp = start + np.arange(0, 3400.0, 10.0)
+            current = np.full(len(timestamp), -1.0)
+            voltage = 3.3 - (timestamp - start) / 3400.0 * 0.5
+        steps.append((state, timestamp, voltage, current))
+        start = timestamp[-1] + 30.0
+    return steps
+
+def integrate(timestamp, voltage, current) -> tuple[float, float]:
+    power_analyzer = PowerAnalyzer()
+    for sample in zip(voltage, current, timestamp):
+        power_analyzer.add_entry(*map(float, sample))
+    return power_analyzer.calculate_energy_capacity()
+
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.directory = self.temporary_directory.name
+        self.steps = cycle_steps()
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def write_step_files(self):
+        for index, (state, timestamp, voltage, current) in enumerate(self.steps):
+            with open(os.path.join(self.directory, f"{index}_{state}.log"), 'w') as file:
+                file.write("voltage;current;power;ahour;whour;timestamp;is_valid\r\n")
+                for t, v, i in zip(timestamp.tolist(), voltage.tolist(), current.tolist()):
+                    file.write(f"{v!r};{i!r};{v * i!r};0.0;0.0;{t!r};True\r\n")
+
+    def check_steps(self, steps):
+        self.assertEqual([step.state for step in steps], [PowerStates.CHARGE, PowerStates.DISCHARGE, PowerStates.CHARGE])
+        for step, (_, timestamp, voltage, current) in zip(steps, self.steps):
+            energy, capacity = integrate(timestamp, voltage, current)
+            self.assertAlmostEqual(step.energy_wh, energy, places = 9)
+            self.assertAlmostEqual(step.capacity_ah, capacity, places = 9)
+            self.assertEqual(step.samples, len(timestamp))
+            self.assertEqual(step.end_voltage, voltage[-1])
+
+        charge = steps[0]
+        self.assertAlmostEqual(charge.cc_duration, 3600.0, delta = 20.0)
+        self.assertAlmostEqual(charge.cv_duration, 1790.0, delta = 20.0)
+        self.assertAlmostEqual(steps[1].cv_duration, 0.0)
+
+        cycles = pair_cycles(steps)
+        self.assertEqual(len(cycles), 1)
+        self.assertEqual((cycles[0].discharge_step, cycles[0].charge_step), (1, 2)) #Paired with the recharge
+        self.assertAlmostEqual(cycles[0].coulombic_efficiency, abs(steps[1].capacity_ah / steps[2].capacity_ah))
+
+    def test_step_files(self):
+        self.write_step_files()
+        steps, cycles = analyze_run(self.directory)
+        self.check_steps(steps)
+
+    def test_run_store_matches_step_files(self):
+        writer = RunStoreWriter(os.path.join(self.directory, "store"), segment_rows = 500)
+        for state, timestamp, voltage, current in self.steps:
+            power_analyzer = PowerAnalyzer()
+            for t, v, i in zip(timestamp, voltage, current):
+                power_analyzer.add_entry(v, i, t)
+                energy, capacity = power_analyzer.calculate_energy_capacity()
+                writer.append(t, v, i, v * i, energy, capacity, encode_state(state))
+        writer.close()
+        run = load_run(self.directory)
+        self.assertEqual(list(run.starts), [0, len(self.steps[0][1]), len(self.steps[0][1]) + len(self.steps[1][1])])
+        self.check_steps(analyze_steps(run))
+
+    def test_max_gap_is_not_integrated(self):
+        timestamp = np.array([0.0, 1.0, 100.0, 101.0])
+        run = RunArrays(timestamp, np.full(4, 2.0), np.full(4, 1.0), np.array([0]), [PowerStates.DISCHARGE])
+        step, = analyze_steps(run, max_gap = 30.0)
+        self.assertAlmostEqual(step.energy_wh, 2.0 * 2 / 3600)
+
+if __name__ == '__main__':
+    unittest.main()
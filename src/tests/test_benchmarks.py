@@ -0,0 +1,35 @@
+#Builtins
+import unittest
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from benchmarks import percentiles, run_multimeter_scenario, notifications_disabled
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_percentiles(self):
+        result = percentiles([index / 1000 for index in range(1, 1001)])
+        self.assertEqual(result["count"], 1000)
+        self.assertAlmostEqual(result["p50"], 501.0)
+        self.assertAlmostEqual(result["p99"], 991.0)
+        self.assertAlmostEqual(result["p999"], 1000.0)
+        self.assertEqual(percentiles([]), {"count": 0})
+
+    @unittest.skipUnless(hasattr(os, "openpty"), "Serial simulators need a pty")
+    def test_multimeter_scenario(self):
+        with tempfile.TemporaryDirectory() as directory, notifications_disabled():
+            result = run_multimeter_scenario(rig_count = 1, duration = 1.0, scale = 60.0, directory = directory)
+        self.assertGreater(result["samples"], 0)
+        self.assertGreater(result["samples_per_second"], 0.0)
+        self.assertEqual(result["reply_to_flush_latency_ms"]["count"], result["samples"])
+        self.assertGreater(result["reply_to_flush_latency_ms"]["p50"], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -115,6 +115,23 @@ class TestChargeController(unittest.TestCase):
             self.charge_controller.watch_values(voltage, current, timestamp)
 
 
+    def test_monitor_then_cycle_with_threshold_already_met(self):
+        controller = ChargeController(relay_controller = MagicMock(), power_analyzer = PowerAnalyzer(), logger = MagicMock())
+        controller.set_charge_threshold(max_charge_voltage = 3.65, charge_cutoff_current = 0.1)
+        controller.set_discharge_threshold(discharge_cutoff_voltage = 2.8)
+
+        timestamp = 1000.0
+        for _ in range(5):
+            timestamp += 0.5
+            controller.watch_values(3.66, 0.05, timestamp)
+        self.assertEqual(controller.cycle_state, "precharge")
+
+        controller.set_mode("cycle")
+        for _ in range(5):
+            timestamp += 0.5
+            controller.watch_values(3.66, 0.05, timestamp)
+        self.assertEqual(controller.cycle_state, "discharge")
+        controller.relay_controller.set_relay.assert_called_with("ON")
 
 if __name__ == '__main__':
     unittest.main()
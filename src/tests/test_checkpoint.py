@@ -0,0 +1,134 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock
+import logging
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from analyzers import PowerAnalyzer
+from controllers import ChargeController as RelayChargeController
+from checkpoint import save_checkpoint, load_checkpoint, CHECKPOINT_FILE
+from instrumentation import NullInstrumentation
+from log_sink import LogSink
+from itech import ChargeController, DataPointClass, PowerStates
+from run_store import RunStoreReader
+
+def samples(count : int, start : int = 0) -> list[tuple]:
+    return [(3.2 + 0.001 * index, 1.0 + 0.01 * (index % 7), 10.0 * (index + 1)) for index in range(start, count)]
+
+class TestPowerAnalyzerSnapshot(unittest.TestCase):
+
+    def test_restored_analyzer_matches_an_uninterrupted_one(self):
+        uninterrupted = PowerAnalyzer(rule = "simpson")
+        interrupted = PowerAnalyzer(rule = "simpson")
+        for sample in samples(101):
+            uninterrupted.add_entry(*sample)
+        for sample in samples(51):
+            interrupted.add_entry(*sample)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, CHECKPOINT_FILE)
+            save_checkpoint(path, interrupted.snapshot())
+            resumed = PowerAnalyzer(rule = "simpson")
+            resumed.restore(load_checkpoint(path))
+
+        for sample in samples(101, start = 51):
+            resumed.add_entry(*sample)
+        self.assertEqual(resumed.calculate_energy_capacity(), uninterrupted.calculate_energy_capacity())
+        self.assertEqual(resumed.start_time, 10.0)
+
+    def test_relay_controller_restores_cycle_state(self):
+        relay_controller = MagicMock()
+        controller = RelayChargeController(relay_controller, PowerAnalyzer(), MagicMock())
+        controller.set_discharge_threshold(2.50)
+        controller.restore({"mode": "cycle", "cycle_state": "discharge", "cycle_completed": False,
+                            "power_analyzer": PowerAnalyzer().snapshot()})
+        relay_controller.set_relay.assert_called_with("ON")
+        self.assertEqual(controller.cutoff_detector.rule.max_voltage, 2.50)
+
+class ScriptedSource:
+    """Data source and state manager replaying one sample every 0.1 s, raising once fail_after samples were read."""
+    def __init__(self, voltages : list[float], fail_after : int = None, clock_start : float = 0.0):
+        self.voltages = voltages
+        self.fail_after = fail_after
+        self.reads = 0
+        self.clock_start = clock_start
+        self.start_time = clock_start #Timestamps are relative to the creation of the source, like ITech6018Device
+        self.states = []
+
+    def read_measurements(self) -> DataPointClass:
+        if self.reads == self.fail_after:
+            raise ConnectionResetError("Power supply disconnected")
+        voltage = self.voltages[self.reads]
+        self.reads += 1
+        return DataPointClass(voltage, 1.0, voltage, None, None, self.clock_start + 0.1 * self.reads - self.start_time, True)
+
+    def set_state(self, state, current, cutoff_voltage, cutoff_current):
+        self.states.append(state)
+
+class TestSequenceResume(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def controller(self, source : ScriptedSource, sink : LogSink) -> ChargeController:
+        controller = ChargeController(source, source, logging.getLogger("test"), "resumed", log_sink = sink,
+                                      instrumentation = NullInstrumentation(), checkpoint_interval = 0.0)
+        controller.add_state(PowerStates.CHARGE, current = 1.0, cutoff_voltage = 3.60, cutoff_current = 2.0)
+        return controller
+
+    def test_resume_continues_the_step_and_its_log(self):
+        voltages = [3.30 + 0.01 * index for index in range(20)] + [3.65] * 15
+        sink = LogSink()
+        with self.assertRaises(ConnectionResetError):
+            self.controller(ScriptedSource(voltages, fail_after = 10), sink).execute_sequence()
+        sink.close()
+        checkpoint = load_checkpoint(f"logs/resumed/{CHECKPOINT_FILE}")
+        self.assertEqual(checkpoint["current_step"], 0)
+        self.assertAlmostEqual(checkpoint["power_analyzer"]["last_sample"][2], 1.0)
+
+        #A new source counts from its own creation, the restored origin keeps the timestamps increasing
+        source = ScriptedSource(voltages[10:], clock_start = 1.0)
+        sink = LogSink()
+        controller = self.controller(source, sink)
+        with self.assertRaises(FileExistsError):
+            controller.execute_sequence()
+        controller.execute_sequence(resume = True)
+        sink.close()
+
+        uninterrupted = PowerAnalyzer()
+        for index, voltage in enumerate(voltages[:source.reads + 10]):
+            uninterrupted.add_entry(voltage, 1.0, 0.1 * (index + 1))
+        with open("logs/resumed/0_charge.log") as file:
+            rows = file.read().splitlines()
+        self.assertEqual(len(rows), 1 + 10 + source.reads) #A single header, then the rows of both runs
+        self.assertAlmostEqual(float(rows[-1].split(';')[4]), uninterrupted.calculate_energy(), places = 9)
+        self.assertEqual(source.states[-1], PowerStates.PASSIVE)
+        self.assertEqual(load_checkpoint(f"logs/resumed/{CHECKPOINT_FILE}")["current_step"], 1)
+
+    def test_failed_sequence_closes_the_run_store(self):
+        source = ScriptedSource([3.30 + 0.01 * index for index in range(20)], fail_after = 7)
+        controller = ChargeController(source, source, logging.getLogger("test"), "failed", log_format = "binary", log_sink = LogSink(),
+                                      instrumentation = NullInstrumentation(), checkpoint_interval = 0.0)
+        controller.add_state(PowerStates.CHARGE, current = 1.0, cutoff_voltage = 3.60, cutoff_current = 2.0)
+        with self.assertRaises(ConnectionResetError):
+            controller.execute_sequence()
+
+        self.assertIsNone(controller.run_store)
+        self.assertEqual(len(RunStoreReader("logs/failed/store")), 7)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from cutoffs import RunningWindow, MedianFilter, EMAFilter, CutoffRule, CutoffDetector
+from controllers import ChargeController
+from analyzers import PowerAnalyzer
+
+class TestRunningWindow(unittest.TestCase):
+
+    def test_running_minimum_and_maximum(self):
+        window = RunningWindow(window_seconds = 2.0)
+        values = [5.0, 1.0, 3.0, 4.0, 2.0, 6.0]
+        for timestamp, value in enumerate(values):
+            window.append(value, float(timestamp))
+            recent = values[max(0, timestamp - 2):timestamp + 1]
+            self.assertEqual((window.minimum(), window.maximum()), (min(recent), max(recent)))
+        self.assertEqual(len(window), 3)
+
+class TestFilters(unittest.TestCase):
+
+    def test_median_filter_rejects_spike(self):
+        median_filter = MedianFilter(size = 3)
+        outputs = [median_filter.update(value, float(timestamp)) for timestamp, value in enumerate([3.0, 3.0, 9.0, 3.0, 3.0])]
+        self.assertEqual(outputs, [3.0, 3.0, 3.0, 3.0, 3.0])
+
+    def test_ema_filter_converges(self):
+        ema_filter = EMAFilter(time_constant = 1.0)
+        ema_filter.update(0.0, 0.0)
+        self.assertAlmostEqual(ema_filter.update(1.0, 1.0), 0.6321, places = 4)
+
+class TestCutoffDetector(unittest.TestCase):
+
+    def test_fires_once_after_debounce_with_latency(self):
+        detector = CutoffDetector(window_seconds = 1.0, min_samples = 3)
+        detector.set_rule(CutoffRule(max_voltage = 2.5))
+        voltages = [2.7, 2.6, 2.5, 2.6, 2.4, 2.4, 2.4, 2.3]
+        events = [detector.update(voltage, -1.0, timestamp * 0.5) for timestamp, voltage in enumerate(voltages)]
+
+        fired = [event for event in events if event]
+        self.assertEqual(len(fired), 1)
+        self.assertEqual(events.index(fired[0]), 6)
+        self.assertEqual(fired[0].first_qualifying_timestamp, 2.0)
+        self.assertEqual(fired[0].latency, 1.0)
+
+    def test_charge_rule_checks_current(self):
+        detector = CutoffDetector(window_seconds = 1.0, min_samples = 2)
+        detector.set_rule(CutoffRule(min_voltage = 3.65, max_abs_current = 0.1))
+        self.assertIsNone(detector.update(3.65, 0.5, 0.0))
+        self.assertIsNone(detector.update(3.65, 0.05, 0.5))
+        self.assertIsNone(detector.update(3.65, -0.05, 0.9)) #0.5 A sample still in the window
+        self.assertIsNotNone(detector.update(3.65, -0.05, 1.2))
+
+class TestChargeControllerCutoffs(unittest.TestCase):
+
+    def test_cycle_transitions(self):
+        relay_controller = MagicMock()
+        charge_controller = ChargeController(relay_controller, PowerAnalyzer(), MagicMock())
+        charge_controller.set_charge_threshold(max_charge_voltage = 3.65, charge_cutoff_current = 0.1)
+        charge_controller.set_discharge_threshold(discharge_cutoff_voltage = 2.8)
+        charge_controller.set_mode("cycle")
+
+        timestamp = 0.0
+        for voltage, current in [(3.60, 0.5)] * 3 + [(3.66, 0.05)] * 4:
+            timestamp += 0.4
+            charge_controller.watch_values(voltage, current, timestamp)
+        self.assertEqual(charge_controller.cycle_state, "discharge")
+        relay_controller.set_relay.assert_called_with("ON")
+        self.assertAlmostEqual(charge_controller.last_cutoff_event.latency, 0.8)
+
+        for voltage in [3.0, 2.9, 2.7, 2.7, 2.7]:
+            timestamp += 0.4
+            charge_controller.watch_values(voltage, -1.0, timestamp)
+        self.assertEqual(charge_controller.cycle_state, "recharge")
+        relay_controller.set_relay.assert_called_with("OFF")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#Builtins
+import unittest
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from decoders import decode_yokogawa, decode_scpi_numbers, decode_power_supply_reply, Reading
+from controllers import DataPoint, check_if_power_available, is_current_unit, is_voltage_unit
+
+class TestDecoders(unittest.TestCase):
+
+    def test_yokogawa_values_are_normalized(self):
+        self.assertEqual(decode_yokogawa(b"RR,B,+3.3000 VDC4\r\n"), Reading(3.3, "VDC"))
+        self.assertEqual(decode_yokogawa(b"RR,B,-00.500mADC0\r\n"), Reading(-0.0005, "ADC"))
+        self.assertAlmostEqual(decode_yokogawa(b"RR,B,+12.50uADC7").value, 12.5e-6)
+        self.assertEqual(decode_yokogawa(b"RR,B,+1.000kOHM1").unit, "OHM")
+        self.assertIsNone(decode_yokogawa(b"RR,B,OL\r\n"))
+        self.assertIsNone(decode_yokogawa(b"\xff\xfe"))
+
+    def test_unit_kinds(self):
+        self.assertTrue(is_voltage_unit("VAC"))
+        self.assertFalse(is_current_unit("VAC"))
+        self.assertTrue(is_current_unit("mADC"))
+        self.assertFalse(is_current_unit(None))
+
+    def test_millivolt_range_is_paired_in_volts(self):
+        data_points = [DataPoint(0.5, "VDC", 0.0), DataPoint(-0.002, "ADC", 0.0)]
+        self.assertEqual(check_if_power_available(data_points), (True, 0.5, -0.002))
+
+    def test_scpi_and_power_supply_replies(self):
+        self.assertEqual(decode_scpi_numbers(b"3.3;-1.5;-4.95"), (3.3, -1.5, -4.95))
+        self.assertEqual(decode_scpi_numbers(b"3.3,-1.5"), (3.3, -1.5))
+        self.assertEqual(decode_power_supply_reply([b"3.30\n", b"1.500\n"]), (3.3, 1.5))
+        with self.assertRaises(ValueError):
+            decode_power_supply_reply([b"3.30\n"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Third party
+import numpy as np
+
+#Locals
+from analyzers import PowerAnalyzer
+from incremental_capacity import IncrementalCapacity
+from controllers import ChargeController as RelayChargeController
+
+def plateau_voltage(fraction : float) -> float:
+    """Open circuit voltage of a cell with a flat plateau at 3.30 V between 30% and 70% state of charge."""
+    if fraction < 0.3:
+        return 3.0 + fraction
+    if fraction < 0.7:
+        return 3.3 + (fraction - 0.3) * 0.05
+    return 3.32 + (fraction - 0.7) * 1.0
+
+class TestIncrementalCapacity(unittest.TestCase):
+
+    def test_peak_is_written_at_reset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            incremental_capacity = IncrementalCapacity(directory, bin_width = 0.01, smoothing = 1.0)
+            incremental_capacity.step_name = lambda: "0_charge"
+            power_analyzer = PowerAnalyzer()
+            power_analyzer.add_listener(incremental_capacity)
+            for index in range(1001): #1 A for 1000 s
+                power_analyzer.add_entry(plateau_voltage(index / 1000), 1.0, 10.0 + index)
+            voltage, capacity, dqdv, smoothed = incremental_capacity.curve()
+            self.assertAlmostEqual(capacity.sum(), power_analyzer.calculate_energy_capacity()[1], places = 9)
+
+            power_analyzer.reset()
+            self.assertEqual(incremental_capacity.intervals, 0)
+            with open(os.path.join(directory, "dqdv_0_charge.csv")) as file:
+                rows = file.read().splitlines()
+        self.assertEqual(rows[0], "voltage;ah;dqdv;dqdv_smoothed")
+        written = np.array([[float(value) for value in row.split(';')] for row in rows[1:]])
+        self.assertAlmostEqual(written[np.argmax(written[:, 3]), 0], 3.305, places = 3)
+        self.assertEqual(len(written), len(voltage))
+
+    def test_relay_rig_curves_are_numbered(self):
+        #A state that comes back, or is resumed, must not overwrite the curve of its earlier step
+        with tempfile.TemporaryDirectory() as directory:
+            logger = MagicMock()
+            logger.root_path = directory
+            def controller() -> RelayChargeController:
+                return RelayChargeController(MagicMock(), PowerAnalyzer(), logger, incremental_capacity = IncrementalCapacity(bin_width = 0.01))
+            def run_step(charge_controller : RelayChargeController, start : float):
+                for second in range(10):
+                    charge_controller.power_analyzer.add_entry(3.30, 1.0, start + second)
+
+            interrupted = controller()
+            for index, mode in enumerate(["cycle", "monitor", "cycle"]):
+                run_step(interrupted, 10.0 * index)
+                interrupted.set_mode(mode)
+            resumed = controller()
+            resumed.restore(interrupted.snapshot())
+            run_step(resumed, 100.0)
+            resumed.set_mode("monitor")
+            written = sorted(os.listdir(directory))
+        self.assertEqual(written, ["dqdv_0_monitor.csv", "dqdv_1_precharge.csv", "dqdv_2_monitor.csv", "dqdv_4_precharge.csv"])
+
+    def test_smoothing_keeps_the_area(self):
+        incremental_capacity = IncrementalCapacity(bin_width = 0.01, smoothing = 2.0)
+        values = np.zeros(41)
+        values[20] = 1.0
+        smoothed = incremental_capacity._smooth(values)
+        self.assertAlmostEqual(smoothed.sum(), 1.0)
+        self.assertEqual(np.argmax(smoothed), 20)
+        #A flat curve stays flat up to its ends
+        np.testing.assert_allclose(incremental_capacity._smooth(np.ones(10)), np.ones(10))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#Builtins
+import unittest
+import tempfile
+import json
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from instrumentation import Instrumentation, NullInstrumentation, StageHistogram, bucket_index, bucket_upper_bound, BUCKET_COUNT
+
+class TestStageHistogram(unittest.TestCase):
+
+    def test_buckets_contain_their_durations(self):
+        for duration in [0.5e-6, 1e-6, 1.9e-6, 2e-6, 3.7e-5, 0.0123, 1.5, 40.0]:
+            index = bucket_index(duration)
+            self.assertLessEqual(duration, bucket_upper_bound(index))
+            if index > 0:
+                self.assertGreater(duration, bucket_upper_bound(index - 1) - 1e-15)
+        self.assertEqual(bucket_index(1e6), BUCKET_COUNT - 1)
+
+    def test_percentiles_within_bucket_resolution(self):
+        histogram = StageHistogram()
+        for microseconds in range(1, 1001):
+            histogram.record(microseconds * 1e-6)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.total / histogram.count, 500.5e-6)
+        #Four buckets per octave: the bound is at most 25% above the exact percentile
+        self.assertTrue(500e-6 <= histogram.percentile(0.50) <= 500e-6 * 1.25)
+        self.assertTrue(990e-6 <= histogram.percentile(0.99) <= 1000e-6)
+        self.assertEqual(histogram.percentile(1.0), histogram.maximum)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_laps_and_dump(self):
+        instrumentation = Instrumentation(["read", "write"])
+        times = iter([1.0, 1.001, 1.003])
+        instrumentation.clock = lambda: next(times)
+        start = instrumentation.clock()
+        start = instrumentation.lap("read", start)
+        instrumentation.lap("write", start)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "timings.json")
+            instrumentation.start_dumping(path, interval = 60.0)
+            instrumentation.close()
+            with open(path) as file:
+                stages = json.load(file)["stages"]
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+        self.assertEqual(stages["read"]["count"], 1)
+        self.assertAlmostEqual(stages["read"]["max_us"], 1000.0, places = 3)
+        self.assertAlmostEqual(stages["write"]["max_us"], 2000.0, places = 3)
+
+    def test_null_instrumentation_records_nothing(self):
+        instrumentation = NullInstrumentation()
+        start = instrumentation.clock()
+        self.assertEqual(instrumentation.lap("read", start), start)
+        self.assertEqual(instrumentation.to_dict(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#Builtins
+import unittest
+import socketserver
+import threading
+import time
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from itech import ITech6018Device
+
+class ScpiHandler(socketserver.StreamRequestHandler):
+    REPLIES = {
+        "MEASURE:VOLTAGE?": "3.3000",
+        "MEASURE:CURRENT?": "-1.5000",
+        "MEASURE:POWER?": "-4.9500",
+    }
+
+    def handle(self):
+        for line in self.rfile:
+            self.server.received.append(line.decode().strip())
+            queries = [query.lstrip(':') for query in line.decode().strip().split(';')]
+            replies = [self.REPLIES[query] for query in queries if query in self.REPLIES]
+            if replies:
+                reply = ';'.join(replies) + '\n'
+                #Split the reply to check that it is reassembled
+                self.wfile.write(reply[:3].encode())
+                self.wfile.flush()
+                self.wfile.write(reply[3:].encode())
+
+class GarbledHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if '?' in line.decode():
+                self.wfile.write(b"garbled\n")
+
+class ClosingHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        pass #The unit drops the connection
+
+class TestITech6018Device(unittest.TestCase):
+
+    def setUp(self):
+        self.start_server(ScpiHandler)
+
+    def start_server(self, handler):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.server.received = []
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_measurement_modes_agree(self):
+        for measurement_mode in ITech6018Device.MEASUREMENT_MODES:
+            device = ITech6018Device("127.0.0.1", self.port, measurement_mode = measurement_mode)
+            for _ in range(3):
+                data_point = device.read_measurements()
+                self.assertTrue(data_point.is_valid)
+                self.assertEqual((data_point.voltage, data_point.current), (3.3, -1.5))
+            device.drain_pipeline()
+            device.socket.close()
+
+    def test_compound_mode_uses_one_round_trip(self):
+        device = ITech6018Device("127.0.0.1", self.port, measurement_mode = "compound")
+        data_point = device.read_measurements()
+        device.socket.close()
+        self.assertEqual(data_point.power, -4.95)
+        queries = [line for line in self.server.received if '?' in line]
+        self.assertEqual(queries, ["MEASURE:VOLTAGE?;:MEASURE:CURRENT?;:MEASURE:POWER?"])
+
+    def test_pipelined_reply_has_the_time_of_its_query(self):
+        device = ITech6018Device("127.0.0.1", self.port, measurement_mode = "pipelined")
+        device.read_measurements()
+        next_query_time = time.time() - device.start_time
+        time.sleep(0.200) #The caller processes the sample while the next reply waits in the buffer
+        data_point = device.read_measurements()
+        device.drain_pipeline()
+        device.socket.close()
+        self.assertTrue(data_point.is_valid)
+        self.assertAlmostEqual(data_point.timestamp, next_query_time, delta = 0.050)
+
+    def test_closed_connection_raises(self):
+        self.tearDown()
+        self.start_server(ClosingHandler)
+        device = ITech6018Device("127.0.0.1", self.port)
+        with self.assertRaises(ConnectionError):
+            device.read_measurements()
+        device.socket.close()
+
+    def test_consecutive_errors_back_off_then_raise(self):
+        self.tearDown()
+        self.start_server(GarbledHandler)
+        device = ITech6018Device("127.0.0.1", self.port, max_consecutive_errors = 3, error_backoff = 0.050)
+        start = time.perf_counter()
+        data_points = [device.read_measurements() for _ in range(2)]
+        elapsed = time.perf_counter() - start
+        with self.assertRaises(ConnectionError):
+            device.read_measurements()
+        device.socket.close()
+        self.assertFalse(any(data_point.is_valid for data_point in data_points))
+        self.assertGreaterEqual(elapsed, 0.050 + 0.100)
+
+if __name__ == '__main__':
+    unittest.main()
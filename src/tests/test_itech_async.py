@@ -0,0 +1,167 @@
+#Builtins
+import unittest
+import asyncio
+import logging
+import tempfile
+import time
+import socket
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from simulators import VirtualClock, BatteryModel, ITechSimulator
+from itech_async import AsyncITech6018Device, AsyncChargeController, run_units
+from itech import PowerStates
+from log_sink import LogSink
+from notifications import NotificationDispatcher, set_default_dispatcher
+
+class TestAsyncITech(unittest.TestCase):
+
+    def setUp(self):
+        self.simulators = []
+        self.previous_dispatcher = set_default_dispatcher(NotificationDispatcher([])) #No alerts from the failing unit
+
+    def tearDown(self):
+        for simulator in self.simulators:
+            simulator.close()
+        set_default_dispatcher(self.previous_dispatcher)
+
+    def start_simulator(self, battery : BatteryModel, **kwargs) -> ITechSimulator:
+        simulator = ITechSimulator(battery, **kwargs)
+        simulator.start()
+        self.simulators.append(simulator)
+        return simulator
+
+    def test_units_are_polled_concurrently(self):
+        reply_delay, reads = 0.020, 10
+        devices = [AsyncITech6018Device(*self.start_simulator(BatteryModel(), reply_delay = reply_delay).address) for _ in range(8)]
+
+        async def poll():
+            await asyncio.gather(*(device.connect() for device in devices))
+            async def read(device):
+                return [await device.read_measurements() for _ in range(reads)]
+            time_begin = time.perf_counter()
+            data_points = await asyncio.gather(*(read(device) for device in devices))
+            elapsed = time.perf_counter() - time_begin
+            await asyncio.gather(*(device.close() for device in devices))
+            return data_points, elapsed
+
+        data_points, elapsed = asyncio.run(poll())
+        self.assertTrue(all(data_point.is_valid for unit in data_points for data_point in unit))
+        self.assertLess(elapsed, len(devices) * reads * reply_delay / 2) #One after the other would take 1.6s
+
+    def test_sequences_run_side_by_side(self):
+        clock = VirtualClock(scale = 3600.0)
+        batteries = [BatteryModel(capacity_ah = 0.02, soc = 0.5, clock = clock) for _ in range(3)]
+        failing = BatteryModel(capacity_ah = 0.02, soc = 0.5, clock = clock)
+        sink = LogSink()
+        controllers = []
+        for index, battery in enumerate(batteries + [failing]):
+            simulator = self.start_simulator(battery)
+            device = AsyncITech6018Device(*simulator.address, clock = clock.time)
+            controller = AsyncChargeController(device, device, logging.getLogger("test"), f"unit_{index}", log_sink = sink)
+            controller.add_state(PowerStates.CHARGE, current = 0.020, cutoff_voltage = 3.60, cutoff_current = 0.002)
+            controller.add_state(PowerStates.DISCHARGE, current = -0.020, cutoff_voltage = 2.60, cutoff_current = None)
+            controllers.append(controller)
+
+        async def run():
+            await asyncio.gather(*(controller.data_source.connect() for controller in controllers))
+            async def fail_later():
+                await asyncio.sleep(0.2)
+                raise ConnectionResetError("Power supply disconnected")
+            controllers[-1].data_source.read_measurements = fail_later
+            return await run_units(controllers)
+
+        previous_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results = asyncio.run(run())
+                sink.close()
+                step_files = [sorted(os.listdir(f"logs/unit_{index}")) for index in range(3)]
+            finally:
+                os.chdir(previous_directory)
+
+        self.assertEqual(results[:3], [None, None, None])
+        self.assertIsInstance(results[3], ConnectionResetError)
+        for files, battery, controller in zip(step_files, batteries, controllers):
+            self.assertIn("0_charge.log", files)
+            self.assertIn("1_discharge.log", files)
+            self.assertLess(battery.soc, 0.1)
+            self.assertEqual(controller.instrumentation.stages["transition"].count, 3) #Charge, discharge and passive
+        self.assertEqual(controllers[-1].data_source.state, PowerStates.PASSIVE) #The failed unit was stopped
+        self.assertIn("OUTPUT 0", self.simulators[-1].commands[-1])
+
+    def test_failed_reads_back_off_then_fail(self):
+        simulator = self.start_simulator(BatteryModel(), reply_delay = 0.300)
+        device = AsyncITech6018Device(*simulator.address, reply_timeout = 0.050, max_consecutive_errors = 3, error_backoff = 0.050)
+
+        async def read():
+            await device.connect()
+            data_points = []
+            time_begin = time.perf_counter()
+            with self.assertRaises(ConnectionError):
+                while True:
+                    data_points.append(await device.read_measurements())
+            elapsed = time.perf_counter() - time_begin
+            await device.close()
+            return data_points, elapsed
+
+        data_points, elapsed = asyncio.run(read())
+        self.assertEqual([data_point.is_valid for data_point in data_points], [False, False])
+        self.assertGreater(elapsed, 3 * 0.050 + 0.050 + 0.100) #Three timeouts and two backoffs
+
+    def test_late_reply_is_dropped(self):
+        simulator = self.start_simulator(BatteryModel(), reply_delay = 0.300)
+        device = AsyncITech6018Device(*simulator.address, reply_timeout = 0.200, error_backoff = 0.010)
+
+        async def read():
+            await device.connect()
+            late = await device.read_measurements()
+            simulator.reply_delay = 0.0
+            data_points = [await device.read_measurements() for _ in range(3)]
+            await device.close()
+            return late, data_points
+
+        late, data_points = asyncio.run(read())
+        self.assertFalse(late.is_valid)
+        self.assertTrue(all(data_point.is_valid for data_point in data_points))
+        self.assertFalse(device.out_of_sync)
+        self.assertIn(device.RESYNC_COMMAND.strip(), simulator.commands)
+
+    def test_unreachable_unit_fails_alone(self):
+        clock = VirtualClock(scale = 3600.0)
+        battery = BatteryModel(capacity_ah = 0.02, soc = 0.5, clock = clock)
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        unreachable_address = listener.getsockname()
+        listener.close() #Nothing listens there any more
+
+        sink = LogSink()
+        controllers = []
+        for index, address in enumerate([self.start_simulator(battery).address, unreachable_address]):
+            device = AsyncITech6018Device(*address, clock = clock.time)
+            controller = AsyncChargeController(device, device, logging.getLogger("test"), f"unit_{index}", log_sink = sink)
+            controller.add_state(PowerStates.CHARGE, current = 0.020, cutoff_voltage = 3.60, cutoff_current = 0.002)
+            controllers.append(controller)
+
+        previous_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results = asyncio.run(run_units(controllers, connect = True))
+                sink.close()
+            finally:
+                os.chdir(previous_directory)
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], ConnectionError)
+        self.assertGreater(battery.soc, 0.9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#Builtins
+import unittest
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from log_sink import LogSink
+from log_segments import RotationPolicy, SegmentCompressor, segment_paths
+from log_index import read_window, load_index, find_offset, data_logger_line_timestamp
+from itech import DataPointClass, DATA_POINT_FIELDS, data_point_row, serialize_to_csv
+
+def data_points(count : int) -> list[DataPointClass]:
+    return [DataPointClass(3.3, 1.5, 4.95, 0.1, 0.33, float(second), True) for second in range(count)]
+
+class TestLogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.directory = self.temporary_directory.name
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def timestamps(self, lines : list[str]) -> list[float]:
+        return [float(line.split(';')[5]) for line in lines]
+
+    def test_window_across_compressed_segments(self):
+        path = os.path.join(self.directory, "all_sequences.log")
+        compressor = SegmentCompressor()
+        sink = LogSink(flush_rows = 100000, flush_interval = 10.0, rotation = RotationPolicy(max_bytes = 20000), compressor = compressor,
+                       index_rows = 50, index_seconds = 3600.0)
+        sink.add_csv_destination(path, DATA_POINT_FIELDS)
+        for data_point in data_points(3000):
+            sink.write((path,), data_point_row(data_point))
+            if len(sink.pending) == 10:
+                sink.flush()
+        sink.close()
+        compressor.close()
+
+        segments = segment_paths(path)
+        self.assertGreater(len(segments), 3)
+        self.assertTrue(segments[0].endswith(".gz"))
+        timestamps, offsets = load_index(segments[1])
+        self.assertEqual(len(timestamps), len(set(timestamps)))
+        self.assertTrue(all(later - earlier >= 50 for earlier, later in zip(timestamps, timestamps[1:])))
+
+        window = list(read_window(path, 1234.0, 1300.0))
+        self.assertEqual(self.timestamps(window), [float(second) for second in range(1234, 1301)])
+        self.assertEqual(window[0], "3.3;1.5;4.95;0.1;0.33;1234.0;True\n")
+        self.assertEqual(self.timestamps(read_window(path, 2990.0, 5000.0)), [float(second) for second in range(2990, 3000)])
+        self.assertEqual(list(read_window(path, 5000.0, 6000.0)), [])
+
+    def test_data_logger_lines(self):
+        path = os.path.join(self.directory, "discharge.log")
+        sink = LogSink(flush_rows = 100000, flush_interval = 10.0, index_rows = 10000, index_seconds = 60.0)
+        sink.add_index(path, data_logger_line_timestamp)
+        for second in range(0, 1000, 5):
+            sink.write((path,), f"3.30V 1.000A 0.0000Wh\t{1700000000 + second}\t00:00:00\n")
+            if second % 100 == 95:
+                sink.flush()
+        sink.close()
+        self.assertEqual(load_index(path)[0][:3], [1700000000.0, 1700000100.0, 1700000200.0])
+        self.assertGreater(find_offset(path, 1700000500.0), 0)
+        lines = list(read_window(path, 1700000500.0, 1700000510.0))
+        self.assertEqual([data_logger_line_timestamp(line) for line in lines], [1700000500.0, 1700000505.0, 1700000510.0])
+
+    def test_serialize_to_csv_index(self):
+        path = os.path.join(self.directory, "steps.log")
+        for data_point in data_points(300):
+            serialize_to_csv(data_point, DataPointClass, path, index_seconds = 100.0)
+        self.assertEqual(load_index(path)[0], [0.0, 100.0, 200.0])
+        self.assertEqual(self.timestamps(read_window(path, 150.0, 152.0)), [150.0, 151.0, 152.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#Builtins
+import unittest
+import tempfile
+import time
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from log_sink import LogSink
+from log_segments import RotationPolicy, SegmentCompressor, read_lines, segment_paths, default_compressor
+from analytics import load_step_file
+from itech import DataPointClass, DATA_POINT_FIELDS, data_point_row, serialize_to_csv
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+class TestLogSink(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.directory = self.temporary_directory.name
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_matches_serialize_to_csv(self):
+        data_points = [DataPointClass(3.3, -1.5, -4.95, 0.1, 0.33, 12.5, True), DataPointClass(3.25, 0.0, 0.0, None, None, 13.0, True)]
+        expected_path = os.path.join(self.directory, "expected.log")
+        serialize_to_csv(data_points, DataPointClass, expected_path)
+
+        step_path = os.path.join(self.directory, "0_charge.log")
+        all_path = os.path.join(self.directory, "all_sequences.log")
+        sink = LogSink()
+        sink.add_csv_destination(step_path, DATA_POINT_FIELDS)
+        sink.add_csv_destination(all_path, DATA_POINT_FIELDS)
+        for data_point in data_points:
+            sink.write((step_path, all_path), data_point_row(data_point))
+        sink.close()
+
+        self.assertEqual(read_file(step_path), read_file(expected_path))
+        self.assertEqual(read_file(all_path), read_file(expected_path))
+
+    def test_header_is_not_repeated_on_existing_file(self):
+        path = os.path.join(self.directory, "steps.log")
+        for value in [1, 2]:
+            sink = LogSink()
+            sink.add_csv_destination(path, ("a", "b"))
+            sink.write((path,), (value, value * 2))
+            sink.close()
+        self.assertEqual(read_file(path).splitlines(), ["a;b", "1;2", "2;4"])
+
+    def test_rows_are_flushed_within_interval(self):
+        path = os.path.join(self.directory, "terminal.log")
+        sink = LogSink(flush_rows = 1000, flush_interval = 0.05)
+        sink.write((path,), "first line\n")
+        deadline = time.time() + 2.0
+        while time.time() < deadline and not (os.path.exists(path) and read_file(path)):
+            time.sleep(0.01)
+        self.assertEqual(read_file(path), "first line\n")
+        sink.close()
+
+    def test_flush_listeners_see_written_rows(self):
+        path = os.path.join(self.directory, "terminal.log")
+        flushed = []
+        sink = LogSink(flush_rows = 1000, flush_interval = 10.0)
+        sink.add_flush_listener(lambda batch, flush_time: flushed.extend(row for _, row in batch))
+        sink.write((path,), "a\n")
+        sink.write((path,), "b\n")
+        self.assertEqual(flushed, [])
+        sink.flush()
+        self.assertEqual(flushed, ["a\n", "b\n"])
+        self.assertEqual(read_file(path), "a\nb\n")
+        sink.close()
+
+    def test_rotated_segments_read_as_one_file(self):
+        path = os.path.join(self.directory, "0_charge.log")
+        compressor = SegmentCompressor()
+        sink = LogSink(flush_rows = 1000, flush_interval = 10.0, rotation = RotationPolicy(max_bytes = 300), compressor = compressor)
+        sink.add_csv_destination(path, DATA_POINT_FIELDS)
+        data_points = [DataPointClass(3.3 + index / 1000, 1.5, 4.95, 0.1, 0.33, 10.0 + index, True) for index in range(40)]
+        for data_point in data_points:
+            sink.write((path,), data_point_row(data_point))
+            if len(sink.pending) == 4:
+                sink.flush()
+        sink.close()
+        compressor.close()
+
+        segments = segment_paths(path)
+        self.assertGreater(sink.rotations, 3)
+        self.assertEqual(compressor.compressed, sink.rotations)
+        self.assertTrue(all(segment.endswith(".gz") for segment in segments[:-1]))
+        lines = list(read_lines(path))
+        self.assertEqual(lines[0].rstrip(), ";".join(DATA_POINT_FIELDS))
+        self.assertEqual(len(lines), 1 + len(data_points))
+        np_rows = load_step_file(path)
+        self.assertEqual(np_rows[0].tolist(), [data_point.timestamp for data_point in data_points])
+
+    def test_serialize_to_csv_rotates_by_size(self):
+        path = os.path.join(self.directory, "expected.log")
+        rotation = RotationPolicy(max_bytes = 100, compression = "lzma")
+        for index in range(6):
+            serialize_to_csv(DataPointClass(3.3, 1.0, 3.3, 0.1, 0.2, float(index), True), DataPointClass, path, rotation = rotation)
+        default_compressor().flush()
+        self.assertTrue(segment_paths(path)[0].endswith(".000001.xz"))
+        timestamps = [line.split(';')[5] for line in read_lines(path)][1:]
+        self.assertEqual(timestamps, [f"{float(index)}" for index in range(6)])
+
+if __name__ == '__main__':
+    unittest.main()
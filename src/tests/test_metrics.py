@@ -0,0 +1,63 @@
+#Builtins
+import unittest
+import json
+import urllib.request
+import urllib.error
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from metrics import MetricsRegistry, MetricsServer, start_metrics_server
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.status = self.registry.register("rig1")
+        self.status.update(3.5, -1.5, 0.25, 0.075, "cycle", "discharge", 1700000000.0)
+        self.status.count_error("missing_reading")
+        self.status.count_error("missing_reading")
+        self.server = MetricsServer(self.registry, port = 0)
+        self.base_url = f"http://{self.server.address[0]}:{self.server.address[1]}"
+
+    def tearDown(self):
+        self.server.close()
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout = 5) as response:
+            return response.headers["Content-Type"], response.read().decode()
+
+    def test_prometheus_text(self):
+        content_type, body = self.get("/metrics")
+        self.assertTrue(content_type.startswith("text/plain"))
+        self.assertIn('powercalc_voltage_volts{rig="rig1"} 3.5', body)
+        self.assertIn('powercalc_power_watts{rig="rig1"} -5.25', body)
+        self.assertIn('powercalc_samples_total{rig="rig1"} 1', body)
+        self.assertIn('powercalc_state_info{rig="rig1",mode="cycle",cycle_state="discharge"} 1', body)
+        self.assertIn('powercalc_errors_total{rig="rig1",kind="missing_reading"} 2', body)
+
+    def test_json_status_follows_updates(self):
+        self.status.update(3.2, -1.5, 0.30, 0.090, "cycle", "discharge", 1700000001.0)
+        content_type, body = self.get("/status")
+        self.assertEqual(content_type, "application/json")
+        rig = json.loads(body)["rigs"]["rig1"]
+        self.assertEqual(rig["voltage"], 3.2)
+        self.assertEqual(rig["samples"], 2)
+        self.assertEqual(rig["errors"], {"missing_reading": 2})
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.get("/unknown")
+        self.assertEqual(context.exception.code, 404)
+
+    def test_port_in_use_leaves_the_server_out(self):
+        self.assertIsNone(start_metrics_server(self.registry, port = self.server.address[1]))
+        self.assertEqual(self.get("/status")[0], "application/json") #The first server is unaffected
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#Builtins
+import unittest
+import threading
+import time
+import tempfile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from notifications import NotificationDispatcher, NtfySink, FileSink
+
+class NtfyStandIn(HTTPServer):
+    """Local HTTP server recording posted messages, failing the first fail_count requests."""
+    def __init__(self, fail_count : int = 0, delay : float = 0.0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), NtfyHandler)
+        self.fail_count = fail_count
+        self.delay = delay
+        self.messages = []
+        self.requests = 0
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/alertas"
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+class NtfyHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        if self.server.requests <= self.server.fail_count:
+            self.send_response(503)
+        else:
+            self.server.messages.append(body)
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def wait_until(condition, timeout : float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.010)
+    return True
+
+class TestNotificationDispatcher(unittest.TestCase):
+
+    def test_notify_does_not_wait_for_a_slow_server(self):
+        server = NtfyStandIn(delay = 0.5)
+        dispatcher = NotificationDispatcher([NtfySink(server.url, min_interval = 0.0)])
+        time_begin = time.perf_counter()
+        dispatcher.notify("Ciclo de carga completado", level = "success")
+        self.assertLess(time.perf_counter() - time_begin, 0.050)
+        self.assertTrue(wait_until(lambda: server.messages == ["Ciclo de carga completado"]))
+        dispatcher.close()
+        server.close()
+
+    def test_failed_posts_are_retried(self):
+        server = NtfyStandIn(fail_count = 2)
+        dispatcher = NotificationDispatcher([NtfySink(server.url, min_interval = 0.0)], backoff = 0.050)
+        dispatcher.notify("Error:timeout", level = "error")
+        self.assertTrue(wait_until(lambda: server.messages == ["Error:timeout"]))
+        self.assertEqual(server.requests, 3)
+        dispatcher.close()
+        server.close()
+
+    def test_duplicates_are_coalesced_while_rate_limited(self):
+        server = NtfyStandIn()
+        dispatcher = NotificationDispatcher([NtfySink(server.url, min_interval = 0.3)])
+        dispatcher.notify("first", level = "info")
+        self.assertTrue(wait_until(lambda: server.messages == ["first"]))
+        for _ in range(10):
+            dispatcher.notify("Error:SerialException", level = "error", key = "serial")
+        self.assertTrue(wait_until(lambda: len(server.messages) == 2))
+        self.assertEqual(server.messages[1], "Error:SerialException (x10)")
+        self.assertEqual(dispatcher.coalesced, 9)
+        dispatcher.close()
+        server.close()
+
+    def test_bounded_queue_and_file_sink_on_close(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "alerts.log")
+            dispatcher = NotificationDispatcher([FileSink(path, min_interval = 60.0)], max_pending = 3)
+            dispatcher.notify("first")
+            self.assertTrue(wait_until(lambda: dispatcher.sent == 1))
+            for index in range(5): #Held back by the rate limit
+                dispatcher.notify(f"alert {index}")
+            dispatcher.close() #Sends what is left regardless of the rate limit
+            with open(path) as file:
+                lines = file.readlines()
+        self.assertEqual(dispatcher.dropped, 2)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[-1].endswith("[INFO]\talert 2\n"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#Builtins
+import unittest
+import math
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from plot_buffer import PlotBuffer
+
+class TestPlotBuffer(unittest.TestCase):
+
+    def test_short_run_is_kept_as_is(self):
+        plot_buffer = PlotBuffer(channels = 1, max_buckets = 8)
+        for timestamp in range(5):
+            plot_buffer.append(float(timestamp), (timestamp * 2.0,))
+        times, values = plot_buffer.get_series(0)
+        self.assertEqual(times[::2], [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(values[::2], [0.0, 2.0, 4.0, 6.0, 8.0])
+
+    def test_size_is_bounded_and_spikes_survive(self):
+        plot_buffer = PlotBuffer(channels = 2, max_buckets = 64)
+        for timestamp in range(100_000):
+            spike = 10.0 if timestamp == 54_321 else 0.0
+            plot_buffer.append(float(timestamp), (math.sin(timestamp / 1000) + spike, -1.0))
+
+        times, values = plot_buffer.get_series(0)
+        self.assertLessEqual(len(times), 2 * 64 + 2)
+        self.assertEqual(times, sorted(times))
+        self.assertEqual((times[0], times[-1]), (0.0, 99_999.0))
+        self.assertGreater(max(values), 9.0)
+        self.assertEqual(plot_buffer.get_limits(1), (-1.0, -1.0))
+
+    def test_envelope_keeps_extremes_in_time_order(self):
+        plot_buffer = PlotBuffer(channels = 1, max_buckets = 2)
+        for timestamp, value in enumerate([0.0, 5.0, -5.0, 0.0]):
+            plot_buffer.append(float(timestamp), (value,))
+        _, values = plot_buffer.get_series(0)
+        self.assertEqual(values, [5.0, -5.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#Builtins
+import unittest
+import math
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from analyzers import PowerAnalyzer, CompensatedSum
+
+class TestPowerAnalyzer(unittest.TestCase):
+
+    def test_constant_power_trapezoid(self):
+        power_analyzer = PowerAnalyzer()
+        for second in range(3601):
+            power_analyzer.add_entry(4.0, 2.0, float(second))
+        energy, capacity = power_analyzer.calculate_energy_capacity()
+        self.assertAlmostEqual(energy, 8.0)
+        self.assertAlmostEqual(capacity, 2.0)
+
+    def test_memory_is_bounded(self):
+        power_analyzer = PowerAnalyzer(history_size = 5)
+        for second in range(1000):
+            power_analyzer.add_entry(3.3, 1.0, float(second))
+        self.assertEqual(len(power_analyzer.entries), 5)
+        self.assertEqual(power_analyzer.entries[-1], (3.3, 1.0, 999.0))
+        self.assertEqual(PowerAnalyzer().entries, [])
+
+    def test_simpson_is_exact_for_quadratic_current(self):
+        #Current ramps linearly, so energy at constant voltage is linear and capacity of I**2 is quadratic
+        trapezoid = PowerAnalyzer(rule = "trapezoid")
+        simpson = PowerAnalyzer(rule = "simpson")
+        timestamps = [0.0, 900.0, 1500.0, 2700.0, 3600.0]
+        for timestamp in timestamps:
+            current = (timestamp / 3600) ** 2
+            trapezoid.add_entry(1.0, current, timestamp)
+            simpson.add_entry(1.0, current, timestamp)
+        self.assertAlmostEqual(simpson.calculate_energy_capacity()[1], 1 / 3, places = 12)
+        self.assertGreater(abs(trapezoid.calculate_energy_capacity()[1] - 1 / 3), 1e-3)
+
+    def test_gaps_are_not_integrated(self):
+        power_analyzer = PowerAnalyzer(max_gap = 10.0)
+        for timestamp in [0.0, 1.0, 2.0, 3600.0, 3601.0]:
+            power_analyzer.add_entry(1.0, 3600.0, timestamp)
+        self.assertAlmostEqual(power_analyzer.calculate_energy(), 3.0)
+        self.assertEqual(power_analyzer.gap_count, 1)
+
+    def test_non_monotonic_samples_are_dropped(self):
+        power_analyzer = PowerAnalyzer()
+        for timestamp in [0.0, 1.0, 1.0, 0.5, 2.0]:
+            power_analyzer.add_entry(1.0, 3600.0, timestamp)
+        self.assertAlmostEqual(power_analyzer.calculate_energy(), 2.0)
+        self.assertEqual(power_analyzer.non_monotonic_count, 2)
+
+    def test_compensated_sum_does_not_drift(self):
+        compensated_sum = CompensatedSum(1e8)
+        for _ in range(1_000_000):
+            compensated_sum.add(1e-8)
+        self.assertEqual(compensated_sum.value(), math.fsum([1e8] + [1e-8] * 1_000_000))
+
+if __name__ == '__main__':
+    unittest.main()
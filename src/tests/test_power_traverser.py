@@ -0,0 +1,61 @@
+#Builtins
+import unittest
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from power_traverser import integrate_file, calculate_energy_from_file, process_directory
+
+class TestPowerTraverser(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.directory = self.temporary_directory.name
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def write_file(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write("\n".join(lines) + "\n")
+        return path
+
+    def test_all_formats_give_the_same_energy(self):
+        #One hour at 4 V and 2 A is 8 Wh and 2 Ah
+        text_path = self.write_file("run.txt", [f"31/12/2023 23:{minute:02d}:00 4.00V 2.00A" for minute in range(30, 60)]
+                                    + [f"01/01/2024 00:{minute:02d}:00 4.00V 2.00A" for minute in range(0, 31)])
+        data_logger_path = self.write_file("discharge.log", [f"4.00V 2.000A 0.0000Wh\t{1700000000 + second}\t00:00:00" for second in range(0, 3601, 60)])
+        csv_path = self.write_file("0_charge.log", ["voltage;current;power;ahour;whour;timestamp;is_valid"]
+                                   + [f"4.0;2.0;8.0;0.0;0.0;{second}.0;True" for second in range(0, 3601, 60)]
+                                   + [";;;;;3700.0;False"])
+
+        for path in [text_path, data_logger_path, csv_path]:
+            _, energy, capacity, samples = integrate_file(path)
+            self.assertAlmostEqual(energy, 8.0)
+            self.assertAlmostEqual(capacity, 2.0)
+            self.assertEqual(samples, 61)
+
+    def test_process_directory(self):
+        self.write_file("run.txt", ["01/01/2024 00:00:00 4.00V 2.00A", "01/01/2024 01:00:00 4.00V 2.00A"])
+        self.write_file("terminal.log", ["COM3: 4.0000 VDC\tCOM4: 2.0000 ADC\t1700000000.0\t00:00:00"])
+        os.makedirs(os.path.join(self.directory, "precharge"))
+        self.write_file(os.path.join("precharge", "precharge.log"), ["1.00V 1.000A 0.0000Wh\t0.0\t00:00:00", "1.00V 1.000A 0.0000Wh\t1800.0\t00:30:00"])
+        report_path = os.path.join(self.directory, "energy_report.txt")
+
+        process_directory(self.directory, report_path, workers = 2)
+
+        with open(report_path) as report:
+            lines = report.read().splitlines()
+        self.assertEqual(lines, [f"{os.path.join(self.directory, 'precharge', 'precharge.log')}: 0.500 Wh",
+                                 f"{os.path.join(self.directory, 'run.txt')}: 8.000 Wh"])
+        self.assertAlmostEqual(calculate_energy_from_file(os.path.join(self.directory, "run.txt")), 8.0)
+
+if __name__ == '__main__':
+    unittest.main()
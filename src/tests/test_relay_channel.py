@@ -0,0 +1,52 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from controllers import RelayChannel, RelayController, RelayAcknowledgeError
+
+def create_mock_serial(replies):
+    mock_serial = MagicMock()
+    mock_serial.is_open = True
+    mock_serial.readline.side_effect = replies
+    return mock_serial
+
+class TestRelayChannel(unittest.TestCase):
+
+    def test_relay_change_is_acknowledged(self):
+        mock_serial = create_mock_serial([b"RELAY MODULE | POWER CALCULATOR\r\n", b"Relay 2 is ON\r\n"])
+        channel = RelayChannel(mock_serial)
+        relay_controller = RelayController(mock_serial, relay_number = 2, channel = channel)
+
+        relay_controller.set_relay("ON")
+
+        mock_serial.write.assert_called_once_with(b"RELAY;2;ON\r\n")
+        mock_serial.close.assert_not_called()
+        self.assertEqual(relay_controller.get_relay_state(), "ON")
+        self.assertIsNotNone(relay_controller.last_transition_time)
+
+    def test_rejected_command_raises(self):
+        mock_serial = create_mock_serial([b"Invalid relay number\r\n"])
+        relay_controller = RelayController(mock_serial, relay_number = 1, channel = RelayChannel(mock_serial))
+        with self.assertRaises(RelayAcknowledgeError):
+            relay_controller.set_relay("ON")
+        self.assertEqual(relay_controller.get_relay_state(), "OFF")
+
+    def test_missing_acknowledgment_is_retried(self):
+        mock_serial = MagicMock()
+        mock_serial.is_open = True
+        mock_serial.readline.return_value = b""
+        channel = RelayChannel(mock_serial, ack_timeout = 0.050, retries = 1)
+        with self.assertRaises(RelayAcknowledgeError):
+            channel.send(1, "OFF")
+        self.assertEqual(mock_serial.write.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#Builtins
+import unittest
+import random
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Locals
+from resistance import ResistanceEstimator, LinearFit
+
+RESISTANCE = 0.050
+
+def cell_samples(steps : list[tuple[float, float]], end : float, rate : float = 10.0, noise : float = 0.0) -> list[tuple]:
+    """(voltage, current, timestamp) of a cell whose open circuit voltage drifts by 10mV/s, with current steps at the given times."""
+    generator = random.Random(1)
+    samples = []
+    for index in range(int(end * rate)):
+        timestamp = 100.0 + index / rate
+        current = [current for time, current in steps if time <= timestamp - 100.0][-1]
+        voltage = 3.30 + 0.010 * (timestamp - 100.0) + RESISTANCE * current + generator.gauss(0.0, noise)
+        samples.append((voltage, current, timestamp))
+    return samples
+
+class TestResistanceEstimator(unittest.TestCase):
+
+    def run_estimator(self, estimator : ResistanceEstimator, samples : list[tuple]) -> list:
+        estimates = []
+        for sample in samples:
+            estimate = estimator.update(*sample)
+            if estimate:
+                estimates.append(estimate)
+        return estimates
+
+    def test_steps_are_measured_despite_the_drift(self):
+        estimator = ResistanceEstimator(min_step_current = 0.5, window_seconds = 2.0, max_window_samples = 16, label = lambda: "discharge")
+        estimates = self.run_estimator(estimator, cell_samples([(0.0, 0.0), (5.05, -2.0), (12.05, 1.0)], end = 20.0, noise = 0.0005))
+        self.assertEqual(len(estimates), 2)
+        for estimate in estimates:
+            self.assertAlmostEqual(estimate.resistance, RESISTANCE, delta = 0.002)
+        self.assertAlmostEqual(estimates[0].delta_current, -2.0)
+        self.assertAlmostEqual(estimates[1].delta_current, 3.0)
+        self.assertEqual(estimates[0].samples_before, 16) #Bounded by max_window_samples
+        self.assertEqual(estimates[0].label, "discharge")
+        self.assertEqual(estimator.estimate_count, 2)
+
+    def test_step_inside_the_window_after_restarts_the_measure(self):
+        estimator = ResistanceEstimator(min_step_current = 0.5, window_seconds = 2.0)
+        estimates = self.run_estimator(estimator, cell_samples([(0.0, 0.0), (5.05, 2.0), (6.05, 0.0)], end = 12.0))
+        self.assertEqual(len(estimates), 1)
+        self.assertAlmostEqual(estimates[0].delta_current, -2.0)
+        self.assertAlmostEqual(estimates[0].resistance, RESISTANCE, places = 6)
+
+    def test_gap_is_not_a_step(self):
+        estimator = ResistanceEstimator(min_step_current = 0.5, window_seconds = 2.0)
+        samples = cell_samples([(0.0, 0.0)], end = 3.0) + [(3.5, 2.0, 200.0 + index * 0.1) for index in range(40)]
+        self.assertEqual(self.run_estimator(estimator, samples), [])
+
+    def test_linear_fit_extrapolates(self):
+        fit = LinearFit(origin = 1e9)
+        for x in range(5):
+            fit.add(1e9 + x, 2.0 + 0.5 * x)
+        self.assertAlmostEqual(fit.value_at(1e9 - 2), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
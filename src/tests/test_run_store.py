@@ -0,0 +1,70 @@
+#Builtins
+import unittest
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Third party
+import numpy as np
+
+#Locals
+from run_store import RunStoreWriter, RunStoreReader, encode_state, decode_state, list_segment_paths
+
+class TestRunStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.store_directory = os.path.join(self.temporary_directory.name, "store")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def write_rows(self, writer, first, count):
+        for i in range(first, first + count):
+            writer.append(float(i), 3.3, 1.0, 3.3, i * 0.1, i * 0.01, encode_state("discharge"))
+
+    def test_round_trip_is_zero_copy(self):
+        writer = RunStoreWriter(self.store_directory, segment_rows = 100, buffer_rows = 8)
+        self.write_rows(writer, 0, 50)
+        writer.close()
+
+        timestamps = RunStoreReader(self.store_directory).read_column("timestamp")
+        self.assertIsInstance(timestamps, np.memmap)
+        np.testing.assert_array_equal(timestamps, np.arange(50, dtype = np.float64))
+        states = RunStoreReader(self.store_directory).read_column("state")
+        self.assertEqual(decode_state(states[0]), "discharge")
+
+    def test_rows_spill_into_new_segments(self):
+        writer = RunStoreWriter(self.store_directory, segment_rows = 16, buffer_rows = 5)
+        self.write_rows(writer, 0, 40)
+        writer.close()
+
+        self.assertEqual(len(list_segment_paths(self.store_directory)), 3)
+        reader = RunStoreReader(self.store_directory)
+        self.assertEqual(len(reader), 40)
+        np.testing.assert_array_equal(reader.read()["timestamp"], np.arange(40, dtype = np.float64))
+
+    def test_unflushed_rows_are_not_visible(self):
+        writer = RunStoreWriter(self.store_directory, segment_rows = 100, buffer_rows = 10, fsync_interval = 3600)
+        self.write_rows(writer, 0, 15)
+        self.assertEqual(len(RunStoreReader(self.store_directory)), 10)
+        writer.close()
+        self.assertEqual(len(RunStoreReader(self.store_directory)), 15)
+
+    def test_reopened_store_continues_appending(self):
+        writer = RunStoreWriter(self.store_directory, segment_rows = 100)
+        self.write_rows(writer, 0, 30)
+        writer.close()
+        writer = RunStoreWriter(self.store_directory, segment_rows = 100)
+        self.write_rows(writer, 30, 30)
+        writer.close()
+
+        np.testing.assert_array_equal(RunStoreReader(self.store_directory).read_column("timestamp"), np.arange(60, dtype = np.float64))
+
+if __name__ == '__main__':
+    unittest.main()
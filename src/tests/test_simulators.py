@@ -0,0 +1,297 @@
+#Builtins
+import unittest
+import logging
+import tempfile
+import time
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+#Third party
+import serial
+
+#Locals
+from simulators import VirtualClock, BatteryModel, ITechSimulator, YokogawaSimulator, RelaySimulator
+from controllers import YokogawaController, RelayChannel, RelayAcknowledgeError, check_if_power_available
+from acquisition import MultimeterAcquisition
+from itech import ITech6018Device, PowerStates
+from analyzers import PowerAnalyzer
+
+class ManualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+class TestBatteryModel(unittest.TestCase):
+
+    def test_constant_current_then_constant_voltage(self):
+        clock = ManualClock()
+        battery = BatteryModel(capacity_ah = 1.0, soc = 0.5, clock = clock)
+        battery.constant_current(1.0, voltage_limit = 3.65)
+
+        clock.now = 600.0 #10 minutes at 1C: 1/6 of the capacity
+        voltage, current, _ = battery.read()
+        self.assertAlmostEqual(battery.soc, 0.5 + 1 / 6, places = 3)
+        self.assertEqual(current, 1.0)
+        self.assertLess(voltage, 3.65)
+
+        clock.now = 4 * 3600.0 #Long enough to reach the voltage limit and taper
+        voltage, current, _ = battery.read()
+        self.assertAlmostEqual(voltage, 3.65, places = 3)
+        self.assertLess(current, 0.05)
+
+    def test_discharge_stops_at_voltage_limit(self):
+        clock = ManualClock()
+        battery = BatteryModel(capacity_ah = 1.0, soc = 0.5, clock = clock)
+        battery.constant_current(-1.0, voltage_limit = 2.50)
+        clock.now = 3 * 3600.0
+        voltage, current, _ = battery.read()
+        self.assertGreaterEqual(voltage, 2.50 - 1e-6)
+        self.assertGreater(current, -0.05)
+
+    def test_virtual_clock_is_scaled(self):
+        clock = VirtualClock(scale = 1000.0)
+        start = clock.time()
+        time.sleep(0.020)
+        self.assertGreater(clock.time() - start, 15.0)
+
+class TestITechSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(scale = 3600.0)
+        self.battery = BatteryModel(capacity_ah = 0.05, soc = 0.5, clock = self.clock)
+        self.simulator = ITechSimulator(self.battery)
+        self.simulator.start()
+        self.host, self.port = self.simulator.address
+
+    def tearDown(self):
+        self.simulator.close()
+
+    def test_compound_query_and_errors(self):
+        device = ITech6018Device(self.host, self.port, measurement_mode = "compound", clock = self.clock.time)
+        data_point = device.read_measurements()
+        self.assertTrue(data_point.is_valid)
+        self.assertAlmostEqual(data_point.voltage, self.battery.open_circuit_voltage(0.5), places = 3)
+
+        device.send_command("BOGUS:COMMAND\n")
+        device.send_command("SYSTEM:ERROR?\n")
+        self.assertIn("Undefined header", device.receive_response())
+        device.send_command("SYSTEM:ERROR?\n")
+        self.assertEqual(device.receive_response(), '0,"No error"')
+
+    def test_battery_mode_charges(self):
+        device = ITech6018Device(self.host, self.port, clock = self.clock.time)
+        device.send_command("BATTERY:MODE CHARGE;:BATTERY:CHARGE:CURRENT 0.05;:BATTERY:CHARGE:VOLTAGE 3.65\n")
+        device.send_command("FUNCTION:MODE BATTERY\n")
+        time.sleep(0.050)
+        self.assertGreater(device.read_measurements().current, 0.0)
+
+        device.send_command("FUNCTION:MODE FIXED\n")
+        device.read_measurements() #Round trip so the previous command is applied
+        self.assertEqual(device.read_measurements().current, 0.0)
+
+@unittest.skipUnless(hasattr(os, "openpty"), "Serial simulators need a pty")
+class TestSerialSimulators(unittest.TestCase):
+
+    def test_multimeters_over_pty(self):
+        battery = BatteryModel(soc = 0.5)
+        battery.constant_current(-1.5)
+        simulators = [YokogawaSimulator(battery, "voltage"), YokogawaSimulator(battery, "current")]
+        ports = []
+        for simulator in simulators:
+            simulator.start()
+            ports.append(serial.Serial(simulator.port_name, baudrate = 9600, timeout = 0.050))
+
+        acquisition = MultimeterAcquisition([YokogawaController(port) for port in ports])
+        sample = acquisition.acquire()
+        acquisition.close()
+        for port, simulator in zip(ports, simulators):
+            port.close()
+            simulator.close()
+
+        is_power_available, voltage, current = check_if_power_available(sample.data_points)
+        self.assertTrue(is_power_available)
+        self.assertAlmostEqual(current, -1.5)
+        self.assertGreater(voltage, 3.0)
+
+    def test_accelerated_rig_integrates_in_simulated_time(self):
+        clock = VirtualClock(scale = 600.0)
+        battery = BatteryModel(capacity_ah = 3.0, soc = 0.5, clock = clock)
+        simulators = [YokogawaSimulator(battery, "voltage"), YokogawaSimulator(battery, "current")]
+        ports = []
+        for simulator in simulators:
+            simulator.start()
+            ports.append(serial.Serial(simulator.port_name, baudrate = 9600, timeout = 0.050))
+
+        acquisition = MultimeterAcquisition([YokogawaController(port) for port in ports], clock = clock.time)
+        power_analyzer = PowerAnalyzer()
+        battery.constant_current(-1.5)
+        soc_begin = battery.soc
+        for _ in range(5):
+            sample = acquisition.acquire()
+            _, voltage, current = check_if_power_available(sample.data_points)
+            power_analyzer.add_entry(voltage, current, sample.timestamp)
+            time.sleep(0.050)
+        soc_end = battery.soc
+        acquisition.close()
+        for port, simulator in zip(ports, simulators):
+            port.close()
+            simulator.close()
+
+        #About a minute of simulated discharge, measured as the battery model lost it
+        _, capacity = power_analyzer.calculate_energy_capacity()
+        self.assertAlmostEqual(capacity, (soc_end - soc_begin) * battery.capacity_ah, delta = 0.1 * abs(capacity))
+        self.assertLess(capacity, -0.01)
+
+    def test_relay_protocol(self):
+        changes = []
+        relay_board = RelaySimulator(on_change = lambda number, state: changes.append((number, state)))
+        relay_board.start()
+        relay_channel = RelayChannel(serial.Serial(baudrate = 9600, timeout = 0.050))
+        relay_channel.serial.port = relay_board.port_name
+        relay_channel.open()
+
+        relay_channel.send(2, "ON")
+        with self.assertRaises(RelayAcknowledgeError):
+            relay_channel.send(7, "ON")
+        relay_channel.serial.close()
+        relay_board.close()
+
+        self.assertEqual(changes, [(2, True)])
+        self.assertTrue(relay_board.states[1])
+
+class TestAcceleratedSequence(unittest.TestCase):
+
+    def test_itech_sequence_runs_in_accelerated_time(self):
+        from itech import ChargeController, PowerStates
+
+        clock = VirtualClock(scale = 3600.0)
+        battery = BatteryModel(capacity_ah = 0.02, soc = 0.5, clock = clock)
+        simulator = ITechSimulator(battery)
+        simulator.start()
+        device = ITech6018Device(*simulator.address, clock = clock.time)
+
+        previous_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                controller = ChargeController(device, device, logging.getLogger("test"), "simulated")
+                controller.add_state(PowerStates.CHARGE, current = 0.020, cutoff_voltage = 3.60, cutoff_current = 0.002)
+                controller.add_state(PowerStates.DISCHARGE, current = -0.020, cutoff_voltage = 2.60, cutoff_current = None)
+                time_begin = time.time()
+                controller.execute_sequence()
+                elapsed = time.time() - time_begin
+                controller.log_sink.close()
+                step_files = sorted(os.listdir("logs/simulated"))
+            finally:
+                os.chdir(previous_directory)
+                simulator.close()
+
+        self.assertLess(elapsed, 30.0) #About an hour of simulated cycling
+        self.assertIn("0_charge.log", step_files)
+        self.assertIn("1_discharge.log", step_files)
+        self.assertLess(battery.soc, 0.1)
+        self.assertEqual(controller.instrumentation.stages["transition"].count, 3) #Charge, discharge and passive
+
+    def test_transition_is_confirmed_by_the_next_read(self):
+        battery = BatteryModel(capacity_ah = 0.05, soc = 0.5)
+        simulator = ITechSimulator(battery, mode_change_delay = 0.100)
+        simulator.start()
+        device = ITech6018Device(*simulator.address)
+        confirmed = []
+        device.transition_listener = lambda state, latency, errors: confirmed.append((state, latency, errors))
+
+        time_begin = time.perf_counter()
+        device.set_state(PowerStates.CHARGE, 0.05, 3.60, 0.005)
+        self.assertLess(time.perf_counter() - time_begin, 0.050) #Sent in one write, not waited for
+        data_point = device.read_measurements()
+        simulator.close()
+
+        self.assertTrue(data_point.is_valid)
+        self.assertGreater(data_point.current, 0.0)
+        (state, latency, errors), = confirmed
+        self.assertEqual(state, PowerStates.CHARGE)
+        self.assertGreaterEqual(latency, 0.100)
+        self.assertEqual(errors, [])
+        transition_line = [command for command in simulator.commands if "BATTERY:MODE CHARGE" in command]
+        self.assertEqual(len(transition_line), 1)
+        self.assertTrue(transition_line[0].startswith("FUNCTION:MODE FIXED;*WAI;:BATTERY:MODE CHARGE"))
+        self.assertTrue(transition_line[0].endswith(";*OPC?;:SYSTEM:ERROR?"))
+
+    def test_transition_errors_fall_back_to_polling_the_mode(self):
+        battery = BatteryModel(capacity_ah = 0.05, soc = 0.5)
+        simulator = ITechSimulator(battery, mode_change_delay = 0.050)
+        simulator.start()
+        device = ITech6018Device(*simulator.address)
+
+        simulator.errors.append('-221,"Settings conflict"') #As if the battery settings came before FIXED mode took effect
+        device.set_state(PowerStates.CHARGE, 0.05, 3.60, 0.005)
+        device.read_measurements()
+        wai_errors = device.last_transition[2]
+        device.set_state(PowerStates.DISCHARGE, -0.05, 2.50, None)
+        data_point = device.read_measurements()
+        device.set_state(PowerStates.PASSIVE, None, None, None)
+        simulator.close()
+
+        self.assertTrue(wai_errors)
+        self.assertEqual(device.mode_change, "poll")
+        self.assertTrue(data_point.is_valid)
+        self.assertLess(data_point.current, 0.0)
+        commands = list(simulator.commands)
+        discharge_line = [command for command in commands if "BATTERY:MODE DISCHARGE" in command]
+        self.assertEqual(len(discharge_line), 1)
+        self.assertTrue(discharge_line[0].startswith("BATTERY:MODE DISCHARGE")) #No *WAI
+        index = commands.index(discharge_line[0])
+        self.assertEqual(commands[index - 2:index], ["FUNCTION:MODE FIXED", "FUNCTION:MODE?"])
+        self.assertEqual(device.last_transition[2], [])
+
+    def test_pipelined_parse_error_keeps_replies_in_order(self):
+        simulator = ITechSimulator(BatteryModel(capacity_ah = 0.05, soc = 0.5))
+        simulator.start()
+        device = ITech6018Device(*simulator.address, measurement_mode = "pipelined")
+        parse = device._parse_compound_response
+        calls = []
+        def parse_once_failing(response):
+            calls.append(response)
+            if len(calls) == 2:
+                raise ValueError("Garbled reply")
+            return parse(response)
+        device._parse_compound_response = parse_once_failing
+
+        data_points = [device.read_measurements() for _ in range(5)]
+        device.set_state(PowerStates.PASSIVE, None, None, None)
+        simulator.close()
+
+        self.assertEqual([data_point.is_valid for data_point in data_points], [True, False, True, True, True])
+        self.assertEqual(device.last_transition[2], []) #The *OPC? reply was not taken by a measurement
+        self.assertFalse(device.out_of_sync)
+
+    def test_transition_timeout_resynchronizes(self):
+        battery = BatteryModel(capacity_ah = 0.05, soc = 0.5)
+        simulator = ITechSimulator(battery, mode_change_delay = 0.300)
+        simulator.start()
+        device = ITech6018Device(*simulator.address, transition_timeout = 0.100)
+
+        device.set_state(PowerStates.CHARGE, 0.05, 3.60, 0.005)
+        #The *OPC? reply comes after the transition timeout, and so does the reply to the first resynchronization
+        data_point = device.read_measurements()
+        timed_out_errors = device.last_transition[2]
+        device.transition_timeout = 10.0
+        data_points = [device.read_measurements() for _ in range(3)]
+        device.set_state(PowerStates.PASSIVE, None, None, None)
+        simulator.close()
+
+        self.assertTrue(timed_out_errors)
+        self.assertFalse(data_point.is_valid)
+        self.assertTrue(all(data_point.is_valid for data_point in data_points))
+        self.assertEqual(len([command for command in simulator.commands if command == ITech6018Device.RESYNC_COMMAND.strip()]), 1)
+        self.assertEqual(device.last_transition[2], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#Builtins
+import unittest
+from unittest.mock import MagicMock, patch
+import tempfile
+
+import os
+import sys
+
+current_directory = os.path.dirname(__file__)
+src_directory = os.path.abspath(os.path.join(current_directory, os.pardir))
+sys.path.append(src_directory)
+
+os.environ.setdefault("MPLBACKEND", "Agg") #supervisor.py plots the dashboard with matplotlib
+
+#Locals
+from supervisor import Rig
+from controllers import DataPoint, RelayAcknowledgeError
+from metrics import MetricsRegistry
+from notifications import set_default_dispatcher
+
+RIG_CONFIG = {"multimeter_ports": ["COM1", "COM2"], "relay_number": 1, "charge_cutoff_voltage": 3.65,
+              "charge_cutoff_current": 0.1, "discharge_cutoff_voltage": 2.5}
+
+class TestRig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous_directory = os.getcwd()
+        os.chdir(self.directory.name) #error_log.txt is written to the working directory
+        self.dispatcher = MagicMock()
+        self.previous_dispatcher = set_default_dispatcher(self.dispatcher)
+        #The rig logs to a mocked DataLogger whose run folder is a temporary directory
+        patcher = patch("supervisor.DataLogger", side_effect = self.make_logger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        set_default_dispatcher(self.previous_dispatcher)
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def make_logger(self, log_directories, folder, sink = None, resume = False):
+        logger = MagicMock()
+        logger.root_path = os.path.join(self.directory.name, folder)
+        os.makedirs(logger.root_path, exist_ok = True)
+        return logger
+
+    def rig(self, name : str, registry : MetricsRegistry, resume : bool = False, relay_number : int = 1, relay_channel = None) -> Rig:
+        config = dict(RIG_CONFIG, name = name, folder = name, relay_number = relay_number)
+        return Rig(config, relay_channel or MagicMock(), MagicMock(), registry, quiet = True, resume = resume)
+
+    def sample(self, rig : Rig, voltage : float, current : float, timestamp : float):
+        data_points = [DataPoint(voltage, "VDC", timestamp), DataPoint(current, "ADC", timestamp)]
+        rig.process_sample(0, data_points, timestamp, 0.0)
+
+    def test_resume_does_not_integrate_the_downtime(self):
+        rig = self.rig("resumed", MetricsRegistry())
+        for second in range(10):
+            self.sample(rig, 3.30, 3.0, 1000.0 + second)
+        rig.checkpointer.save()
+        energy, capacity = rig.power_analyzer.calculate_energy_capacity()
+
+        #Ten minutes later the rig continues from its checkpoint
+        resumed = self.rig("resumed", MetricsRegistry(), resume = True)
+        self.sample(resumed, 3.30, 3.0, 1609.0)
+        self.sample(resumed, 3.30, 3.0, 1610.0)
+        resumed_energy, resumed_capacity = resumed.power_analyzer.calculate_energy_capacity()
+        self.assertAlmostEqual(resumed_capacity, capacity + 3.0 / 3600)
+        self.assertAlmostEqual(resumed_energy, energy + 3.30 * 3.0 / 3600)
+        self.assertEqual(resumed.power_analyzer.gap_count, 1)
+
+    def test_failing_rig_stops_alone(self):
+        registry, relay_channel = MetricsRegistry(), MagicMock()
+        rigs = [self.rig(f"rig{number}", registry, relay_number = number, relay_channel = relay_channel) for number in (1, 2, 3)]
+        for rig in rigs:
+            rig.charge_controller.set_mode("cycle")
+        rigs[1].charge_controller.watch_values = MagicMock(side_effect = RelayAcknowledgeError("No acknowledgment for relay 2 ON"))
+
+        for second in range(5):
+            for rig in rigs:
+                if rig.running:
+                    self.sample(rig, 3.30, 1.0, 1000.0 + second)
+
+        self.assertEqual([rig.running for rig in rigs], [True, False, True])
+        self.assertEqual(rigs[1].charge_controller.watch_values.call_count, 1)
+        self.assertGreater(rigs[0].power_analyzer.calculate_energy(), 0.0)
+        self.assertGreater(rigs[2].power_analyzer.calculate_energy(), 0.0)
+        relay_channel.send.assert_called_with(2, "OFF")
+        self.dispatcher.notify.assert_called_once()
+        self.assertEqual(self.dispatcher.notify.call_args.kwargs["level"], "error")
+        with open("error_log.txt") as file:
+            self.assertIn("[rig2]\tType: RelayAcknowledgeError", file.read())
+
+if __name__ == '__main__':
+    unittest.main()
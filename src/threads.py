@@ -6,11 +6,11 @@ import getpass
 
 #Third party
 import keyboard
-import chime
 
 #Locals
 from controllers import *
 from utils import *
+from notifications import default_dispatcher
 
 @retry(wait = wait_fixed(3))
 def open_serial_port(serial):
@@ -80,11 +80,8 @@ def handle_keyboard_input(charge_controller : ChargeController):
             if keyboard.is_pressed("ctrl+k"):
                 charge_controller.set_mode("cycle")
                 print("[CONTROLLER]Mode set to cycle")
-                previous_theme = chime.theme()
-                chime.theme('pokemon')
-                chime.success()
-                time.sleep(6.000)
-                chime.theme(previous_theme)
+                default_dispatcher().notify("Mode set to cycle", level = "success")
+                time.sleep(1.000)
 
             if keyboard.is_pressed("ctrl+r"):
                 charge_controller.flip_relay()
@@ -104,20 +101,11 @@ def keyboard_input_callback(charge_controller : ChargeController, command : str)
                 return
             charge_controller.set_mode("cycle")
             print("[CONTROLLER]Mode set to cycle")
-            previous_theme = chime.theme()
-            chime.theme('big-sur')
-            chime.success()
-            chime.theme(previous_theme)
+            default_dispatcher().notify("Mode set to cycle", level = "feedback")
         case 'R':
-            previous_theme = chime.theme()
-            chime.theme('big-sur')
-            chime.success()
-            chime.theme(previous_theme)
             charge_controller.flip_relay()
             print("[CONTROLLER]Relay flipped")
-            time.sleep(1.000)
-    
-    time.sleep(0.100)
+            default_dispatcher().notify("Relay flipped", level = "feedback")
     
 
 class KeyboardListenerThread(threading.Thread):